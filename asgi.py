@@ -0,0 +1,121 @@
+'''Serves the API as an ASGI application so that it can be run by an asyncio server, for example:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 8080
+
+The event loop looks after the connections (including keep-alive and slow clients) and each request is run
+through the same Flask app as main.py on a bounded thread pool. A slow call to the backend therefore only ties
+up one pool thread, and independent backend calls within a request are made at the same time by the processor'''
+import asyncio
+import concurrent.futures
+import io
+import sys
+import traceback
+import config_cosmos
+from main import app
+
+executor = concurrent.futures.ThreadPoolExecutor(config_cosmos.ASYNC_WORKER_THREADS)
+
+
+def build_environ(scope, body):
+    '''Builds the WSGI environ for an ASGI http scope'''
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+               'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope['query_string'].decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+               'REMOTE_ADDR': client[0],
+               'CONTENT_LENGTH': str(len(body)),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': io.BytesIO(body),
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue   # already set from the body that was read
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+def run_wsgi(environ, loop, queue):
+    '''Runs the Flask app in a pool thread and passes the ASGI messages for the response back to the event loop.
+    Waiting for each message to be queued stops a large streamed listing from being built up in memory faster than
+    the client reads it. None is always queued last'''
+    def put(message):
+        asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+    response = {'start': None, 'sent': False}
+
+    def start_response(status, headers, exc_info=None):
+        response['start'] = {'type': 'http.response.start',
+                             'status': int(status.split(' ', 1)[0]),
+                             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]}
+
+    def send_start():
+        if not response['sent']:
+            put(response['start'])
+            response['sent'] = True
+
+    try:
+        result = app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()   # start_response may be called as late as the first chunk
+                    put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        send_start()
+        put({'type': 'http.response.body', 'body': b''})
+    except Exception:
+        traceback.print_exc()
+        if not response['sent']:
+            put({'type': 'http.response.start', 'status': 500, 'headers': [(b'content-type', b'text/plain')]})
+            put({'type': 'http.response.body', 'body': b'Internal Server Error'})
+    finally:
+        put(None)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(config_cosmos.ASYNC_STREAM_BUFFER)
+    loop.run_in_executor(executor, run_wsgi, build_environ(scope, bytes(body)), loop, queue)
+    message = await queue.get()
+    try:
+        while message is not None:
+            await send(message)
+            message = await queue.get()
+    finally:
+        # if the client has gone away keep taking messages so that the pool thread can finish
+        while message is not None:
+            message = await queue.get()
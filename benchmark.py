@@ -0,0 +1,277 @@
+'''
+Load tests every route in main.py against a generated catalogue and reports the throughput and p50/p95/p99 latency
+of each one (other than /api/changes/stream, which never finishes). For example:
+
+    python benchmark.py --vms 5000 --subnets 4 --prefix 16 --rules 20000 --output results.json
+    python benchmark.py --output new.json --compare results.json
+
+By default the catalogue is generated into a fresh SQLite database and the app is served in this process. Use --url
+to test a server that is already running (e.g. under uvicorn, or against Cosmos DB) instead, in which case it must
+already hold a catalogue. The results are written as JSON so that runs of different versions can be compared, and
+--compare exits with status 1 if any route's throughput or p99 latency has got worse by more than --tolerance
+'''
+
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import classes.seedloader
+
+ASYNC = {'Prefer': 'respond-async'}    # asks for the operation to be queued as a job
+
+
+def load_sqlite(catalogue, database):
+    '''Creates a new SQLite database holding the catalogue'''
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    classes.seedloader.load_sqlite(catalogue, database)
+
+
+def start_local_server():
+    '''Serves main.py from a thread in this process and returns its base URL'''
+    import logging
+    import werkzeug.serving
+    import main
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)   # don't log every request
+    server = werkzeug.serving.make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:' + str(server.server_port)
+
+
+def wait_until_ready(base_url, timeout=60):
+    '''Waits for /api/ready to report that the server has warmed up'''
+    url = urllib.parse.urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+        try:
+            connection.request('GET', '/api/ready')
+            if connection.getresponse().status == 200:
+                return
+        except (OSError, http.client.HTTPException):
+            pass
+        finally:
+            connection.close()
+        time.sleep(0.5)
+    raise RuntimeError(base_url + ' did not become ready within ' + str(timeout) + ' seconds')
+
+
+def send(base_url, method, path, body=None, headers=None):
+    '''Makes a single request and returns the response, which has been read'''
+    url = urllib.parse.urlsplit(base_url)
+    headers = dict(headers or {})
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = connection.getresponse()
+        response.read()
+        return response
+    finally:
+        connection.close()
+
+
+def build_scenarios(base_url, catalogue):
+    '''Returns the routes to test as a list of (name, function returning (method, path, body) or (method, path, body,
+    headers), expected statuses)'''
+    rng = random.Random(1)
+    lock = threading.Lock()
+    vms = catalogue['vms']
+    subnets = catalogue['subnets']
+    deletable = iter([vm['id'] for vm in reversed(vms)])   # each VM can only be deleted once
+    # taken before any of the writes so that ?since= has the VMs created by the scenarios to return
+    sync_token = send(base_url, 'GET', '/api/vms/vm?limit=1').getheader('X-Sync-Token')
+    job_ids = list()
+
+    def any_vm():
+        with lock:
+            return rng.choice(vms)['id']
+
+    def next_deletable():
+        with lock:
+            return next(deletable, 'vm-0')
+
+    def new_vm():
+        with lock:
+            return {'name': 'bench', 'ipaddresses': [rng.choice(subnets)]}
+
+    def any_name_prefix():
+        with lock:
+            return urllib.parse.quote(rng.choice(vms)['name'][:4] + '*')
+
+    def any_ipaddress():
+        with lock:
+            return rng.choice(rng.choice(vms)['ip'])
+
+    def any_job():
+        with lock:
+            if not job_ids:
+                # jobs to read back, submitted the first time one is needed
+                for vmid in rng.sample([vm['id'] for vm in vms], min(20, len(vms))):
+                    response = send(base_url, 'POST', '/api/service-operations/restart-vm/' + vmid, headers=ASYNC)
+                    job_ids.append(response.getheader('Location').rsplit('/', 1)[1])
+            return rng.choice(job_ids)
+
+    def flows():
+        with lock:
+            return [{'from': rng.choice(rng.choice(vms)['ip']), 'to': rng.choice(vms)['id']} for _ in range(100)]
+
+    return [
+        ('GET /api/test', lambda: ('GET', '/api/test', None), (200,)),
+        ('GET /api/ready', lambda: ('GET', '/api/ready', None), (200,)),
+        ('GET /api/cache/stats', lambda: ('GET', '/api/cache/stats', None), (200,)),
+        ('GET /api/vms/vm', lambda: ('GET', '/api/vms/vm', None), (200,)),
+        ('GET /api/vms/vm?limit=100', lambda: ('GET', '/api/vms/vm?limit=100', None), (200,)),
+        ('GET /api/vms/vm?format=ndjson', lambda: ('GET', '/api/vms/vm?format=ndjson', None), (200,)),
+        ('POST /api/vms/vm', lambda: ('POST', '/api/vms/vm', new_vm()), (201,)),
+        ('POST /api/vms/batch', lambda: ('POST', '/api/vms/batch', [new_vm() for _ in range(10)]), (201,)),
+        ('POST /api/vms/vm (job)', lambda: ('POST', '/api/vms/vm', new_vm(), ASYNC), (202,)),
+        ('GET /api/jobs', lambda: ('GET', '/api/jobs/' + any_job(), None), (200,)),
+        # after the POSTs so that there are changes to return
+        ('GET /api/vms/vm?since=', lambda: ('GET', '/api/vms/vm?since=' + urllib.parse.quote(sync_token), None), (200,)),
+        ('GET /api/vms/vm?name=', lambda: ('GET', '/api/vms/vm?name=' + any_name_prefix(), None), (200,)),
+        ('GET /api/vms/vm?state=', lambda: ('GET', '/api/vms/vm?state=on', None), (200,)),
+        ('GET /api/vms/vm?ip=', lambda: ('GET', '/api/vms/vm?ip=' + urllib.parse.quote(subnets[0]), None), (200,)),
+        ('GET /api/network/ipaddresses', lambda: ('GET', '/api/network/ipaddresses/' + any_ipaddress(), None), (200,)),
+        ('GET /api/network/subnets', lambda: ('GET', '/api/network/subnets', None), (200,)),
+        ('POST /api/service-operations/restart-vm', lambda: ('POST', '/api/service-operations/restart-vm/' + any_vm(), None), (200,)),
+        ('GET /api/network/firewall/rules/rule', lambda: ('GET', '/api/network/firewall/rules/rule', None), (200,)),
+        ('GET /api/network/firewall/rules/rule?limit=100', lambda: ('GET', '/api/network/firewall/rules/rule?limit=100', None), (200,)),
+        ('POST /api/network/firewall/rules/rule', lambda: ('POST', '/api/network/firewall/rules/rule',
+                                                           {'name': 'bench', 'from': subnets[0], 'to': any_vm(), 'action': 'allow'}), (201,)),
+        ('POST /api/network/firewall/evaluate (100 flows)', lambda: ('POST', '/api/network/firewall/evaluate', flows()), (200,)),
+        ('GET /metrics', lambda: ('GET', '/metrics', None), (200,)),
+        # last so that the other routes only ever refer to VMs that exist
+        ('DELETE /api/vms/vm', lambda: ('DELETE', '/api/vms/vm/' + next_deletable(), None), (204,)),
+    ]
+
+
+def percentile(ordered, fraction):
+    '''Nearest rank percentile of an already sorted list'''
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run_scenario(base_url, request, expected, concurrency, count):
+    '''Makes count requests from concurrency threads, each with its own kept-alive connection'''
+    url = urllib.parse.urlsplit(base_url)
+    latencies = list()
+    errors = [0]
+    remaining = iter(range(count))
+    lock = threading.Lock()
+
+    def worker():
+        connection = http.client.HTTPConnection(url.hostname, url.port)
+        timings = list()
+        failed = 0
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    break
+            method, path, body, *extra = request()
+            headers = dict(extra[0]) if extra else {}
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+            start = time.perf_counter()
+            try:
+                connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status not in expected:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection(url.hostname, url.port)
+            timings.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(timings)
+            errors[0] += failed
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': errors[0],
+            'throughput': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2)}
+
+
+def compare(results, baseline, tolerance):
+    '''Returns a list of descriptions of the routes that are slower than in the baseline by more than tolerance'''
+    regressions = list()
+    for name, result in results['routes'].items():
+        previous = baseline.get('routes', {}).get(name)
+        if previous is None:
+            continue
+        if result['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(name + ': throughput ' + str(previous['throughput']) + ' -> ' + str(result['throughput']) + ' req/s')
+        if result['p99_ms'] > previous['p99_ms'] * (1 + tolerance):
+            regressions.append(name + ': p99 ' + str(previous['p99_ms']) + ' -> ' + str(result['p99_ms']) + ' ms')
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks every route of the service catalogue')
+    parser.add_argument('--vms', type=int, default=2000, help='number of VMs to generate')
+    parser.add_argument('--subnets', type=int, default=2, help='number of subnets to generate')
+    parser.add_argument('--prefix', type=int, default=16, help='prefix length of the generated subnets')
+    parser.add_argument('--rules', type=int, default=10000, help='number of firewall rules to generate')
+    parser.add_argument('--requests', type=int, default=500, help='requests to make to each route')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of clients making requests at once')
+    parser.add_argument('--url', help='base URL of an already running server to test instead of a local one')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--compare', help='results file from an earlier run to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='fraction a route may get slower by before it is reported')
+    args = parser.parse_args()
+
+    catalogue = classes.seedloader.generate_catalogue(args.vms, args.subnets, args.prefix, args.rules)
+    base_url = args.url
+    if base_url is None:
+        import config_cosmos
+        config_cosmos.STORAGE_BACKEND = 'sqlite'
+        config_cosmos.SQLITE_DATABASE = os.path.join(tempfile.mkdtemp(), 'benchmark.db')
+        start = time.perf_counter()
+        load_sqlite(catalogue, config_cosmos.SQLITE_DATABASE)
+        print('loaded catalogue in %.1fs' % (time.perf_counter() - start))
+        base_url = start_local_server()
+    wait_until_ready(base_url)
+
+    results = {'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+               'routes': dict()}
+    for name, request, expected in build_scenarios(base_url, catalogue):
+        result = run_scenario(base_url, request, expected, args.concurrency, args.requests)
+        results['routes'][name] = result
+        print('%-55s %8.1f req/s  p50 %7.2f  p95 %7.2f  p99 %7.2f ms  errors %d'
+              % (name, result['throughput'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['errors']))
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
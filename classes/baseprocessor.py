@@ -0,0 +1,185 @@
+import base64
+import binascii
+import config_cosmos
+
+# The fields of each kind of document that are returned to clients. Anything else (such as the Cosmos DB
+# system properties that begin with "_") is never selected from the backend
+VM_FIELDS = ('id', 'name', 'ip', 'state')
+RULE_FIELDS = ('id', 'name', 'from', 'to', 'action')
+
+
+def encode_cursor(position):
+    '''Turns a backend position into an opaque cursor string that is safe to put in a URL'''
+    return base64.urlsafe_b64encode(str(position).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''Turns a cursor back into the backend position. Raises ValueError if it is not a valid cursor'''
+    try:
+        return base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+    except (TypeError, UnicodeError, binascii.Error):
+        raise ValueError('Invalid cursor ' + str(cursor))
+
+
+class SyncTokenExpired(Exception):
+    '''Raised when asked for the changes since a point that is older than the deletions are remembered for'''
+
+
+class BackendBusy(Exception):
+    '''Raised when the backend is too busy to take a call. retry_after is the number of seconds to wait before trying again'''
+
+    def __init__(self, retry_after):
+        Exception.__init__(self, 'Backend busy, retry after ' + str(retry_after) + ' seconds')
+        self.retry_after = retry_after
+
+
+class BaseProcessor():
+    '''The interface that the Flask routes use to talk to the storage backend. Each backend provides a
+    Processor class that inherits from this and implements all of these methods with the same semantics'''
+
+    def __init__(self):
+        self.listeners = list()
+        self.warm = False    # True once warm_up has run
+
+
+    def add_listener(self, listener):
+        '''Registers a function to be called as listener(collection, change, document) after every write.
+        change is 'created' or 'deleted' and collection is the Cosmos DB collection name'''
+        self.listeners.append(listener)
+
+
+    def notify(self, collection, change, document):
+        '''Tells the listeners about a write. Backends call this once the write has been committed'''
+        for listener in self.listeners:
+            listener(collection, change, document)
+
+
+    def warm_up(self):
+        '''Does the work that would otherwise be done by the first requests (such as reading collection metadata)
+        so that the service can be marked as ready. Backends override this and then call it to set warm'''
+        self.warm = True
+
+
+    def save_job(self, job):
+        '''Creates or replaces a job document (see classes.jobqueue). Jobs are removed once they are JOB_RETENTION
+        seconds old'''
+        raise NotImplementedError
+
+
+    def get_job(self, job_id):
+        '''Returns a job document, or None if there is no such job'''
+        raise NotImplementedError
+
+
+    def before_fork(self):
+        '''Called in a pre-forking server's master before each worker is forked from it. Backends override this
+        to close connections that must not be shared with the workers'''
+        pass
+
+
+    def after_fork(self):
+        '''Called in each worker once it has been forked. Backends override this to replace anything that
+        belongs to the master, such as thread pools and blocks of IDs'''
+        pass
+
+
+    def get_all_vms(self):
+        '''Returns all VMs as a list of documents with id, name, ip and state keys'''
+        raise NotImplementedError
+
+
+    def get_vms_page(self, limit, cursor=None, fields=VM_FIELDS):
+        '''Returns a page of up to limit VMs starting after cursor (None for the first page) and the cursor
+        for the next page, or None if this is the last page. Only the fields listed are returned'''
+        raise NotImplementedError
+
+
+    def iter_vms(self, fields=VM_FIELDS):
+        '''Returns a generator over all of the VMs that fetches them a page at a time'''
+        return self.iter_pages(self.get_vms_page, fields)
+
+
+    def iter_pages(self, get_page, fields):
+        cursor = None
+        while True:
+            documents, cursor = get_page(config_cosmos.PAGE_SIZE, cursor, fields)
+            for document in documents:
+                yield document
+            if cursor is None:
+                break
+
+
+    def add_vm(self, name, subnets):
+        '''Creates a VM with one IP address reserved from each of the subnets.
+        Returns the new vmid, or False if a subnet does not exist or has no free addresses'''
+        raise NotImplementedError
+
+
+    def add_vms(self, specs):
+        '''Creates many VMs. specs is a list of (name, subnets) tuples. Returns a list with the new vmid, or False,
+        for each spec in the same order. Backends override this to allocate everything in one pass; this
+        version just calls add_vm for each one'''
+        return [self.add_vm(name, subnets) for name, subnets in specs]
+
+
+    def delete_vm(self, vm_id):
+        '''Deletes a VM and frees its IP addresses. Returns True if it was deleted or False if it was not found'''
+        raise NotImplementedError
+
+
+    def restart_vm(self, vm_id):
+        '''Restarts a VM. Returns 'success', 'off' if the VM is turned off or 'notfound' if it does not exist'''
+        raise NotImplementedError
+
+
+    def get_all_rules(self):
+        '''Returns all firewall rules as a list of documents with id, name, from, to and action keys'''
+        raise NotImplementedError
+
+
+    def get_rules_page(self, limit, cursor=None, fields=RULE_FIELDS):
+        '''Returns a page of up to limit firewall rules in the same way as get_vms_page'''
+        raise NotImplementedError
+
+
+    def iter_rules(self, fields=RULE_FIELDS):
+        '''Returns a generator over all of the firewall rules that fetches them a page at a time'''
+        return self.iter_pages(self.get_rules_page, fields)
+
+
+    def add_rule(self, name, destination, target, action):
+        '''Creates a firewall rule and returns the new fwid'''
+        raise NotImplementedError
+
+
+    def get_subnets(self):
+        '''Returns the capacity of every subnet, ordered by subnet: a dict with subnet, total, used and free address
+        counts and the largest_free_block ({'first': ipaddress, 'size': n}, or None if the subnet is full). The counts
+        are the ones kept up to date as addresses are reserved and released, not recounted'''
+        raise NotImplementedError
+
+
+    def reconcile_subnets(self, confirmed=()):
+        '''Checks every subnet's bitmap and used count against the addresses that the VMs hold and repairs any drift
+        (see classes.ipallocator.reconcile). Addresses marked used that no VM holds are only freed if they are in
+        confirmed. Returns the report for each subnet'''
+        raise NotImplementedError
+
+
+    def sync_token(self):
+        '''Returns the current position in the history of changes as an integer. Anything changed after this call
+        is returned by get_vm_changes / get_rule_changes when passed this position'''
+        raise NotImplementedError
+
+
+    def get_vm_changes(self, since, fields=VM_FIELDS):
+        '''Returns the VMs created, changed or deleted after the position since as a list of (position, document)
+        tuples, oldest first. A deleted VM is returned as a tombstone {'id': vmid, 'deleted': True}. Raises
+        SyncTokenExpired if since is older than deletions are remembered for (SYNC_RETENTION)'''
+        raise NotImplementedError
+
+
+    def get_rule_changes(self, since, fields=RULE_FIELDS):
+        '''Returns the firewall rules created, changed or deleted after the position since in the same way as
+        get_vm_changes'''
+        raise NotImplementedError
@@ -0,0 +1,23 @@
+import threading
+
+
+class ChangeNotifier():
+    '''Lets the change streams sleep until this process writes something, rather than only finding out about the
+    write the next time they poll the backend. It is registered as a processor listener'''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0    # goes up by one with every write
+
+
+    def handle_change(self, collection, change, document):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+
+    def wait(self, version, timeout):
+        '''Waits until there has been a write since version was read, or for timeout seconds. Returns the new version'''
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
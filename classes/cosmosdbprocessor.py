@@ -1,106 +1,525 @@
+import concurrent.futures
 import config_cosmos
+import json
+import os
+import requests.adapters
+import threading
+import time
 import pydocumentdb.document_client as document_client
+import pydocumentdb.documents as documents
+import pydocumentdb.errors as errors
+import pydocumentdb.retry_options as retry_options
 from netaddr import IPNetwork
+import classes.metrics
+import classes.governor
+import classes.throttlesimulator
+from classes.baseprocessor import BaseProcessor, SyncTokenExpired, encode_cursor, decode_cursor, VM_FIELDS, RULE_FIELDS
+from classes.idallocator import IDBlockAllocator
+from classes.ipallocator import IPAllocator, SubnetBitmap, build_bitmap, distribute, reconcile
+from classes.unitofwork import UnitOfWork
+from collections import Counter
+
+MAX_CONFLICT_RETRIES = 10   # how many times to retry a conditional write that lost a race with another worker
+CLOCK_MARGIN = 60           # seconds that this machine's clock may be ahead of Cosmos DB's when handing out sync tokens
+
+COLLECTIONS = (config_cosmos.COSMOSDB_COLLECTION_VM, config_cosmos.COSMOSDB_COLLECTION_VMID,
+               config_cosmos.COSMOSDB_COLLECTION_SUBNET, config_cosmos.COSMOSDB_COLLECTION_IP,
+               config_cosmos.COSMOSDB_COLLECTION_FW, config_cosmos.COSMOSDB_COLLECTION_FWID,
+               config_cosmos.COSMOSDB_COLLECTION_TOMBSTONE, config_cosmos.COSMOSDB_COLLECTION_JOB)
+
+# collections that start out empty, which the Processor creates itself if they are missing (e.g. in a deployment
+# made before they were added) rather than needing setup.py to be run again
+CREATED_ON_DEMAND = (config_cosmos.COSMOSDB_COLLECTION_TOMBSTONE, config_cosmos.COSMOSDB_COLLECTION_JOB)
+
+shared_client = None    # the DocumentClient, created by get_client the first time it is needed
+governor = None         # the Governor that every call made by the client goes through
+client_lock = threading.Lock()
+
+
+def get_client():
+    '''Returns the DocumentClient shared by every Processor, creating it on first use so that importing this module
+    doesn't do any work'''
+    global shared_client, governor
+    with client_lock:
+        if shared_client is None:
+            # throttled calls are retried by the governor rather than by the client
+            connection_policy = documents.ConnectionPolicy()
+            connection_policy.RetryOptions = retry_options.RetryOptions(0)
+            client = document_client.DocumentClient(config_cosmos.COSMOSDB_HOST, {'masterKey': config_cosmos.COSMOSDB_KEY},
+                                                    connection_policy)
+            # requests only keeps 10 connections alive per host by default, so size the pool to the number of calls that
+            # can be made at once. Anything over the pool size would be opened and closed again for every call
+            transport = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config_cosmos.COSMOSDB_CONCURRENCY)
+            # each process that shares the account gets an equal part of the throughput
+            shared_by = config_cosmos.COSMOSDB_THROUGHPUT_SHARED_BY
+            if config_cosmos.COSMOSDB_SIMULATED_THROUGHPUT:
+                transport = classes.throttlesimulator.ThrottlingTransport(transport, config_cosmos.COSMOSDB_SIMULATED_THROUGHPUT / shared_by)
+            throughput = config_cosmos.COSMOSDB_THROUGHPUT / shared_by if config_cosmos.COSMOSDB_THROUGHPUT else None
+            governor = classes.governor.Governor(throughput, config_cosmos.COSMOSDB_CONCURRENCY,
+                                                 config_cosmos.COSMOSDB_READ_WAIT, config_cosmos.COSMOSDB_WRITE_WAIT)
+            classes.metrics.metrics.governor = governor
+            client._requests_session.mount('https://', classes.governor.GovernedAdapter(governor, transport))
+            client._requests_session.hooks['response'].append(classes.metrics.cosmos_response)
+            shared_client = client
+        return shared_client
+
+
+def collection_definition(collection_name):
+    '''Returns the definition to create a collection with. If COSMOSDB_PARTITIONED is set it has the partition key
+    from the config so that the Processor can do single partition point reads and queries'''
+    definition = {'id': collection_name}
+    # Cosmos DB deletes the tombstones and jobs once they expire
+    if collection_name == config_cosmos.COSMOSDB_COLLECTION_TOMBSTONE:
+        definition['defaultTtl'] = config_cosmos.SYNC_RETENTION
+    elif collection_name == config_cosmos.COSMOSDB_COLLECTION_JOB:
+        definition['defaultTtl'] = config_cosmos.JOB_RETENTION
+    if config_cosmos.COSMOSDB_PARTITIONED and collection_name in config_cosmos.COSMOSDB_PARTITION_KEYS:
+        definition['partitionKey'] = {'paths': [config_cosmos.COSMOSDB_PARTITION_KEYS[collection_name]], 'kind': 'Hash'}
+    return definition
+
+
+class Processor(BaseProcessor):
+    '''Creates an object to perform all of the interactions with Cosmos DB.
+    Nothing is read from Cosmos DB until it is needed, or until warm_up is called'''
+    client = property(lambda self: get_client())
+
+    # the collection documents, each read the first time it is used
+    collection_vm = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_VM))
+    collection_vmid = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_VMID))
+    collection_subnet = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_SUBNET))
+    collection_ip = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_IP))
+    collection_fw = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_FW))
+    collection_fwid = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_FWID))
+    collection_tombstone = property(lambda self: self.collection(config_cosmos.COSMOSDB_COLLECTION_TOMBSTONE))
 
-class Processor():
-    '''Creates an object to perform all of the interactions with Cosmos DB'''
-    client = document_client.DocumentClient(config_cosmos.COSMOSDB_HOST, {'masterKey': config_cosmos.COSMOSDB_KEY})
-    
     def __init__(self):
-        db_link = 'dbs/' + config_cosmos.COSMOSDB_DATABASE
-        db = self.client.ReadDatabase(db_link)
+        BaseProcessor.__init__(self)
+        # thread pool for making independent calls to Cosmos DB at the same time
+        self.executor = concurrent.futures.ThreadPoolExecutor(config_cosmos.COSMOSDB_CONCURRENCY)
+        self.db_link = 'dbs/' + config_cosmos.COSMOSDB_DATABASE
+        self.collections = self.read_metadata_cache()    # collection name -> collection document
+
+        # The free/used bitmap of every subnet is loaded the first time an address is allocated or released
+        # so that addresses can be allocated without scanning
+        self.allocator = IPAllocator()
+        self.subnets_loaded = False
+        self.subnets_lock = threading.Lock()
+        self.subnet_locks = dict()    # subnet -> Lock held while the subnet is changed and saved
+        # subnet -> (_etag, capacity) of the subnet document last reported on by get_subnets, so that a subnet's
+        # largest free block is only worked out again once its document has changed
+        self.capacities = dict()
+
+        # vmids and fwids are handed out from blocks leased from the counter documents
+        self.vmids = IDBlockAllocator(lambda size: self.lease_ids(self.collection_vmid, 'nextvmid', "vm-", size),
+                                      config_cosmos.ID_BLOCK_SIZE)
+        self.fwids = IDBlockAllocator(lambda size: self.lease_ids(self.collection_fwid, 'nextfwid', "fw-", size),
+                                      config_cosmos.ID_BLOCK_SIZE)
+
+
+    def warm_up(self):
+        '''Reads every collection and loads the subnet bitmaps, all at the same time'''
+        futures = [classes.metrics.submit(self.executor, self.collection, name) for name in COLLECTIONS]
+        futures.append(classes.metrics.submit(self.executor, self.ensure_subnets))
+        for future in futures:
+            future.result()
+        BaseProcessor.warm_up(self)
+
+
+    def before_fork(self):
+        '''Closes the kept-alive connections so that the workers each open their own rather than sharing sockets.
+        The collection metadata and subnet bitmaps that warm_up loaded are kept for the workers to start with'''
+        get_client()._requests_session.close()
+
+
+    def after_fork(self):
+        # the master's pool threads don't exist in the worker
+        self.executor = concurrent.futures.ThreadPoolExecutor(config_cosmos.COSMOSDB_CONCURRENCY)
+        self.vmids.discard()
+        self.fwids.discard()
+
+
+    def collection(self, collection_name):
+        '''Returns the collection document, reading it from Cosmos DB the first time it is asked for. The collections
+        in CREATED_ON_DEMAND are created if they don't exist'''
+        document = self.collections.get(collection_name)
+        if document is None:
+            # two threads may both read it the first time, which does no harm
+            try:
+                document = self.client.ReadCollection(self.collection_link(collection_name))
+            except errors.HTTPFailure as e:
+                if e.status_code != 404 or collection_name not in CREATED_ON_DEMAND:
+                    raise
+                document = self.create_collection(collection_name)
+            self.collections[collection_name] = document
+            self.write_metadata_cache()
+        return document
+
+
+    def create_collection(self, collection_name):
+        '''Creates a missing collection and returns its document'''
+        print("creating the missing collection " + collection_name)
+        try:
+            return self.client.CreateCollection(self.db_link, collection_definition(collection_name))
+        except errors.HTTPFailure as e:
+            if e.status_code != 409:   # 409 Conflict means another worker has just created it
+                raise
+            return self.client.ReadCollection(self.collection_link(collection_name))
+
 
-        collection_vm_link = db_link + '/colls/' + config_cosmos.COSMOSDB_COLLECTION_VM
-        self.collection_vm = self.client.ReadCollection(collection_vm_link)
+    def read_metadata_cache(self):
+        '''Returns the collection documents saved by a previous run, if COSMOSDB_METADATA_CACHE is set'''
+        if config_cosmos.COSMOSDB_METADATA_CACHE and os.path.exists(config_cosmos.COSMOSDB_METADATA_CACHE):
+            try:
+                with open(config_cosmos.COSMOSDB_METADATA_CACHE) as cache_file:
+                    cached = json.load(cache_file)
+                if cached.get('database') == config_cosmos.COSMOSDB_DATABASE:
+                    return {name: document for name, document in cached['collections'].items() if name in COLLECTIONS}
+            except (OSError, ValueError, AttributeError, KeyError):
+                pass   # a damaged cache is just ignored and the collections are read again
+        return dict()
 
-        collection_vmid_link = db_link + '/colls/' + config_cosmos.COSMOSDB_COLLECTION_VMID
-        self.collection_vmid = self.client.ReadCollection(collection_vmid_link)
 
-        collection_subnet_link = db_link + '/colls/' + config_cosmos.COSMOSDB_COLLECTION_SUBNET
-        self.collection_subnet = self.client.ReadCollection(collection_subnet_link)
+    def write_metadata_cache(self):
+        if config_cosmos.COSMOSDB_METADATA_CACHE:
+            # written to a temporary file and moved into place so that another worker never reads half a file
+            temp_path = config_cosmos.COSMOSDB_METADATA_CACHE + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+            try:
+                with open(temp_path, 'w') as cache_file:
+                    json.dump({'database': config_cosmos.COSMOSDB_DATABASE, 'collections': dict(self.collections)}, cache_file)
+                os.replace(temp_path, config_cosmos.COSMOSDB_METADATA_CACHE)
+            except OSError as e:
+                print("unable to write the metadata cache: " + str(e))
 
-        collection_ip_link = db_link + '/colls/' + config_cosmos.COSMOSDB_COLLECTION_IP
-        self.collection_ip = self.client.ReadCollection(collection_ip_link)
 
-        collection_fw_link = db_link + '/colls/' + config_cosmos.COSMOSDB_COLLECTION_FW
-        self.collection_fw = self.client.ReadCollection(collection_fw_link)
+    def ensure_subnets(self):
+        '''Loads every subnet bitmap if that hasn't been done yet'''
+        with self.subnets_lock:
+            if not self.subnets_loaded:
+                self.load_subnets()
+                self.subnets_loaded = True
 
-        collection_fwid_link = db_link + '/colls/' + config_cosmos.COSMOSDB_COLLECTION_FWID
-        self.collection_fwid = self.client.ReadCollection(collection_fwid_link)
+
+    def collection_link(self, collection_name):
+        '''Returns the name based link to a collection'''
+        return self.db_link + '/colls/' + collection_name
+
+
+    def document_link(self, collection_name, document_id):
+        '''Returns the name based link to a document so that it can be addressed by id without reading it first'''
+        return self.collection_link(collection_name) + '/docs/' + document_id
+
+
+    def partition_options(self, collection_name, partition_key):
+        '''Returns the request options needed to address a single partition of a partitioned collection'''
+        if config_cosmos.COSMOSDB_PARTITIONED and collection_name in config_cosmos.COSMOSDB_PARTITION_KEYS:
+            return {'partitionKey': partition_key}
+        return {}
+
+
+    def read_document(self, collection_name, document_id, partition_key=None):
+        '''Point read of a single document by id. Returns None if it does not exist'''
+        if partition_key is None:
+            partition_key = document_id   # collections that are partitioned on /id
+        try:
+            return self.client.ReadDocument(self.document_link(collection_name, document_id),
+                                            self.partition_options(collection_name, partition_key))
+        except errors.HTTPFailure as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+
+    def query_documents(self, collection, where, parameters, partition_key=None):
+        '''Runs a parameterised query against a collection so that the filtering is done by the database
+        using its indexes. parameters is a dict of @name -> value'''
+        query = {'query': 'SELECT * FROM c WHERE ' + where,
+                 'parameters': [{'name': name, 'value': value} for name, value in parameters.items()]}
+        if partition_key is None:
+            options = {'enableCrossPartitionQuery': True}
+        else:
+            options = self.partition_options(collection['id'], partition_key)
+        return self.client.QueryDocuments(collection['_self'], query, options)
+
+
+    def load_subnets(self, subnets=None):
+        '''(Re)loads the subnet bitmaps, migrating any subnet that is still only held as one document per IP.
+        If subnets is given then only those subnets are loaded'''
+        if subnets is None:
+            documents = self.client.ReadDocuments(self.collection_subnet['_self'])
+        else:
+            documents = self.query_documents(self.collection_subnet, 'ARRAY_CONTAINS(@subnets, c.subnet)',
+                                             {'@subnets': list(subnets)})
+        for document in documents:
+            if not self.allocator.load(document):
+                self.migrate_subnet(document)
+
+
+    def migrate_subnet(self, subnet_document):
+        '''Builds the bitmap for a subnet from the one document per IP address layout and stores it in the
+        subnet document. Only the used addresses are read and this is only done the first time a subnet is seen'''
+        network = IPNetwork(subnet_document['subnet'])
+        used_addresses = [doc['id'] for doc in self.query_documents(self.collection_ip, 'c.usedby != ""', {})
+                          if doc['id'] in network]
+        bitmap = build_bitmap(subnet_document['subnet'], used_addresses)
+        bitmap.to_document(subnet_document)
+        self.allocator.load(self.client.ReplaceDocument(subnet_document['_self'], subnet_document))
+
+
+    def update_subnet(self, subnet, change):
+        '''Applies change (a function taking the SubnetBitmap) and persists the bitmap. The write is conditional on
+        the document not having been changed by another worker since it was read. If it has then the subnet is
+        reloaded and the change applied again. Returns whatever change returns.
+        The threads of this process change a subnet one at a time, and the change is made to a copy of the bitmap
+        that only replaces the held one once it has been saved, so a failed write never leaves reservations behind.
+        A change that leaves the bitmap as it was (e.g. allocating from a full subnet) isn't written'''
+        with self.subnet_locks.setdefault(subnet, threading.Lock()):
+            reread = False
+            for attempt in range(MAX_CONFLICT_RETRIES):
+                held = self.allocator.get(subnet)
+                bitmap = held.copy()
+                result = change(bitmap)
+                if bitmap.bits == held.bits:
+                    # another worker may have changed the subnet since it was read, so only trust that there is
+                    # nothing to do once it has been reread. A read costs a fraction of a write
+                    if reread:
+                        return result
+                    self.reload_subnet(self.allocator.documents[subnet]['_self'])
+                    reread = True
+                    continue
+                document = bitmap.to_document(dict(self.allocator.documents[subnet]))
+                try:
+                    self.allocator.load(self.client.ReplaceDocument(document['_self'], document,
+                                        {'accessCondition': {'type': 'IfMatch', 'condition': document['_etag']}}))
+                    return result
+                except errors.HTTPFailure as e:
+                    # reread it whatever the failure, as the write may have been made even though the call failed
+                    self.reload_subnet(document['_self'])
+                    if e.status_code != 412:   # 412 Precondition Failed means someone else updated the subnet first
+                        raise
+            raise RuntimeError('Unable to update subnet ' + subnet + ' due to contention')
+
+
+    def reload_subnet(self, link):
+        '''Rereads a subnet document after a failed write. If that fails too the held bitmap is kept, and the next
+        conditional write of it fails with 412 and rereads it again'''
+        try:
+            self.allocator.load(self.client.ReadDocument(link))
+        except errors.HTTPFailure as e:
+            print("unable to reload subnet " + link + ": " + str(e))
+
+
+    def lease_ids(self, collection, key, prefix, block_size):
+        '''Reserves a block of IDs by moving the counter document on by block_size. The write is conditional
+        on no other worker having moved the counter since it was read. Returns the first ID in the block'''
+        for attempt in range(MAX_CONFLICT_RETRIES):
+            document = next(doc for doc in self.client.ReadDocuments(collection['_self']))
+            first_id = int(document[key][3:])  # grab just the numeric part of the ID as an integer
+            document[key] = prefix + str(first_id + block_size)
+            try:
+                self.client.ReplaceDocument(document['_self'], document,
+                                            {'accessCondition': {'type': 'IfMatch', 'condition': document['_etag']}})
+                return first_id
+            except errors.HTTPFailure as e:
+                if e.status_code != 412:
+                    raise
+        raise RuntimeError('Unable to lease IDs from ' + collection['id'] + ' due to contention')
 
 
     def get_all_vms(self):
         '''Returns all VMs from the collection'''
-        query = {'query': 'SELECT * FROM ' + config_cosmos.COSMOSDB_COLLECTION_VM}
-        docs = self.client.QueryDocuments(self.collection_vm['_self'], query)
-        return list(docs)  # must cast it to a list before it is readable as a list of records
+        return list(self.iter_vms())  # must cast it to a list before it is readable as a list of records
+
+
+    def projection(self, fields):
+        '''Builds a SELECT VALUE object that holds just the fields asked for, so that neither the other fields nor
+        the system properties are sent back by Cosmos DB. The fields are quoted as "from" and "to" are reserved words'''
+        return 'VALUE {' + ', '.join('"' + field + '": c["' + field + '"]' for field in fields) + '}'
+
+
+    def query_page(self, collection, limit, cursor, fields):
+        '''Returns a page of documents ordered by id. pydocumentdb does not let a query be resumed from a
+        continuation token so the cursor holds the last id returned and the next page starts after it'''
+        selected = fields if 'id' in fields else ('id',) + tuple(fields)   # the id is needed for the cursor
+        if cursor is None:
+            query = {'query': 'SELECT TOP @limit ' + self.projection(selected) + ' FROM c ORDER BY c.id',
+                     'parameters': [{'name': '@limit', 'value': limit}]}
+        else:
+            query = {'query': 'SELECT TOP @limit ' + self.projection(selected) + ' FROM c WHERE c.id > @after ORDER BY c.id',
+                     'parameters': [{'name': '@limit', 'value': limit}, {'name': '@after', 'value': decode_cursor(cursor)}]}
+        # the VM and rule collections may be partitioned on /id, so a listing has to be allowed to span partitions
+        documents = list(self.client.QueryDocuments(collection['_self'], query,
+                                                    {'maxItemCount': limit, 'enableCrossPartitionQuery': True}))
+        next_cursor = None
+        if len(documents) == limit:
+            next_cursor = encode_cursor(documents[-1]['id'])
+        if 'id' not in fields:
+            for document in documents:
+                del document['id']
+        return documents, next_cursor
+
+
+    def get_vms_page(self, limit, cursor=None, fields=VM_FIELDS):
+        '''Returns a page of VMs from the collection'''
+        return self.query_page(self.collection_vm, limit, cursor, fields)
+
+
+    def iter_vms(self, fields=VM_FIELDS):
+        '''Returns all VMs from the collection, fetching them from Cosmos DB a page at a time as they are used'''
+        query = {'query': 'SELECT ' + self.projection(fields) + ' FROM c'}
+        return iter(self.client.QueryDocuments(self.collection_vm['_self'], query,
+                                               {'maxItemCount': config_cosmos.PAGE_SIZE, 'enableCrossPartitionQuery': True}))
 
 
+    @classes.governor.write_priority
     def add_vm(self, name, subnets):
         '''Adds a new document to the virtualmachines collection'''
-        # Get the next vmid
-        vmid_document = next(doc for doc in self.client.ReadDocuments(self.collection_vmid['_self']))
-        next_vmid = int(vmid_document['nextvmid'][3:])  # grab just the numeric part of the ID as an integer
-
-        # Confirm that the subnets provided are available in the database and get next available address if so
-        ipaddresses = list()
-        for subnet in subnets:
-            # check whether the subnet is in the database. Return default of False if not found to avoid a StopIteration error
-            if next((doc for doc in self.client.ReadDocuments(self.collection_subnet['_self']) if doc['subnet'] == subnet), False):
-                # it is so get the first available IP address
-                #ipaddresses.append(next(doc['id'] for doc in self.client.ReadDocuments(self.collection_ip['_self']) if doc['usedby'] == "" if '10.220.30.' in doc['id']))
-                # Get the list of IP addresses that are in this subnet
-                IPs_in_subnet = list()
-                for ipaddress in IPNetwork(subnet):
-                    IPs_in_subnet.append(str(ipaddress))
-
-                # Strip out the first and last address in the range as these are not usable
-                IPs_in_subnet = IPs_in_subnet[1:-1]
-
-                # Get the next available IP address from the database
-                ipaddresses.append(next(doc['id'] for doc in self.client.ReadDocuments(self.collection_ip['_self']) if doc['usedby'] == "" if doc['id'] in IPs_in_subnet))
-            else:
+        self.ensure_subnets()
+        # Confirm that the subnets provided are available in the database. Reload once in case another
+        # worker has added a subnet since they were loaded
+        missing = [subnet for subnet in subnets if subnet not in self.allocator]
+        if missing:
+            self.load_subnets(missing)
+            if not all(subnet in self.allocator for subnet in subnets):
                 return False
 
-        # Update vmid collection
-        vmid_document['nextvmid'] = "vm-" + str(next_vmid + 1)
-        new_vmid = self.client.ReplaceDocument(vmid_document['_self'], vmid_document)
+        # Reserve the next available IP address in each subnet
+        allocations, unused = distribute([(name, subnets)], self.reserve_addresses(Counter(subnets)))
+        ipaddresses = allocations[0]
+        if ipaddresses is None:
+            # a subnet is full so give back anything already reserved for this VM
+            self.release_addresses(unused)
+            return False
+
+        # Get the next vmid
+        next_vmid = self.vmids.next_id()
+        try:
+            return self.write_vm("vm-" + str(next_vmid), name, subnets, ipaddresses)
+        except errors.HTTPFailure:
+            # the writes have been undone so give the addresses back as well
+            self.release_after_commit(ipaddresses)
+            raise
+
 
-        # Update ipaddress collection so that correct documents are registered against this new vmid
-        for ipaddress in ipaddresses:
-            ipaddress_document = next(doc for doc in self.client.ReadDocuments(self.collection_ip['_self']) if doc['id'] == ipaddress)
-            ipaddress_document['usedby'] = "vm-" + str(next_vmid)
-            new_ipaddress_reserved = self.client.ReplaceDocument(ipaddress_document['_self'], ipaddress_document)
+    @classes.governor.write_priority
+    def add_vms(self, specs):
+        '''Adds many new documents to the virtualmachines collection. The IP addresses for all of them are reserved
+        with a single write per subnet and the vmids are taken as one contiguous range'''
+        self.ensure_subnets()
+        demand = Counter(subnet for name, subnets in specs for subnet in subnets)
+        missing = [subnet for subnet in demand if subnet not in self.allocator]
+        if missing:
+            self.load_subnets(missing)
+
+        allocations, unused = distribute(specs, self.reserve_addresses(demand))
+
+        vmids = iter(self.vmids.next_ids(sum(1 for ipaddresses in allocations if ipaddresses is not None)))
+        results = list()
+        for (name, subnets), ipaddresses in zip(specs, allocations):
+            if ipaddresses is None:
+                results.append(False)
+                continue
+            try:
+                results.append(self.write_vm("vm-" + str(next(vmids)), name, subnets, ipaddresses))
+            except errors.HTTPFailure:
+                # report this VM as failed and give its addresses back rather than failing the whole batch
+                unused.extend(ipaddresses)
+                results.append(False)
+
+        if unused:
+            self.release_after_commit(unused)
+        return results
+
+
+    def reserve_addresses(self, demand):
+        '''Reserves as many of the addresses needed from each subnet as are free. demand is a Counter of subnet -> number
+        of addresses. The subnets are updated at the same time. Returns a dict of subnet -> reserved addresses'''
+        futures = {subnet: classes.metrics.submit(self.executor, self.update_subnet, subnet,
+                                                  lambda bitmap, count=count: bitmap.allocate(min(count, bitmap.free())))
+                   for subnet, count in demand.items() if subnet in self.allocator}
+        reserved = dict()
+        failure = None
+        for subnet, future in futures.items():
+            try:
+                reserved[subnet] = future.result()
+            except (errors.HTTPFailure, RuntimeError) as e:
+                failure = failure or e
+        if failure is not None:
+            # don't keep hold of what the other subnets reserved
+            self.release_addresses([ipaddress for addresses in reserved.values() for ipaddress in addresses])
+            raise failure
+        return reserved
+
+
+    def write_vm(self, vmid, name, subnets, ipaddresses):
+        '''Registers the reserved IP addresses against the vmid and creates the virtualmachines document.
+        The writes are made as one unit of work so that either all of them happen or none do'''
+        unit_of_work = UnitOfWork(self)
+
+        # Update ipaddress collection so that correct documents are registered against this new vmid.
+        # The document id is the IP address so it can be written directly without reading it first
+        for subnet, ipaddress in zip(subnets, ipaddresses):
+            unit_of_work.upsert(config_cosmos.COSMOSDB_COLLECTION_IP, {'id': ipaddress, 'subnet': subnet, 'usedby': vmid},
+                                partition_key=subnet, previous={'id': ipaddress, 'subnet': subnet, 'usedby': ""})
 
         # Create new virtualmachines document
-        new_vm = self.client.CreateDocument(self.collection_vm['_self'],{
-                                                                'id': "vm-" + str(next_vmid),
-                                                                'name': name,
-                                                                'ip': ipaddresses,
-                                                                'state': "off"})
+        new_vm = {'id': vmid,
+                  'name': name,
+                  'ip': ipaddresses,
+                  'state': "off"}
+        unit_of_work.create(config_cosmos.COSMOSDB_COLLECTION_VM, new_vm, partition_key=vmid)
+
+        unit_of_work.commit()
+        self.notify(config_cosmos.COSMOSDB_COLLECTION_VM, 'created', new_vm)
         return new_vm['id']
 
 
+    @classes.governor.write_priority
     def delete_vm(self, vm_id):
         '''Deletes a VM from the database'''
-        vm_to_delete = next((doc for doc in self.client.ReadDocuments(self.collection_vm['_self']) if doc['id'] == vm_id), None)
+        vm_to_delete = self.read_document(config_cosmos.COSMOSDB_COLLECTION_VM, vm_id)
         if vm_to_delete is not None:
+            unit_of_work = UnitOfWork(self)
+
             # Free up any IP addresses it holds
-            documents = [doc for doc in self.client.ReadDocuments(self.collection_ip['_self']) if doc['usedby'] == vm_to_delete['id']]
+            documents = list(self.query_documents(self.collection_ip, 'c.usedby = @vmid', {'@vmid': vm_to_delete['id']}))
             for document in documents:
-                document['usedby'] = ""
-                replaced_document = self.client.ReplaceDocument(document['_self'], document)
+                unit_of_work.upsert(config_cosmos.COSMOSDB_COLLECTION_IP, dict(document, usedby=""),
+                                    partition_key=document.get('subnet'), previous=document)
+
+            unit_of_work.delete(config_cosmos.COSMOSDB_COLLECTION_VM, vm_to_delete, partition_key=vm_id)
+            # so that clients syncing with ?since= find out it has gone
+            unit_of_work.upsert(config_cosmos.COSMOSDB_COLLECTION_TOMBSTONE,
+                                {'id': vm_id, 'collection': config_cosmos.COSMOSDB_COLLECTION_VM}, partition_key=vm_id)
+            unit_of_work.commit()
 
-            self.client.DeleteDocument(vm_to_delete['_self'])
+            # only give the addresses back once the VM is definitely gone
+            self.release_after_commit(vm_to_delete['ip'])
+            self.notify(config_cosmos.COSMOSDB_COLLECTION_VM, 'deleted', vm_to_delete)
 
             return True
         else:
             return False
 
 
+    def release_addresses(self, ipaddresses):
+        '''Frees IP addresses in the subnet bitmaps'''
+        self.ensure_subnets()
+        for subnet, offsets in self.allocator.group_by_subnet(ipaddresses).items():
+            self.update_subnet(subnet, lambda bitmap: bitmap.release(offsets))
+
+
+    def release_after_commit(self, ipaddresses):
+        '''Frees IP addresses once the document writes have been committed or undone. Those can't be taken back, so a
+        failure here is only logged and the addresses stay marked used until reconcile_subnets frees them'''
+        try:
+            self.release_addresses(ipaddresses)
+        except (errors.HTTPFailure, RuntimeError) as e:
+            print("unable to release " + ", ".join(ipaddresses) + ": " + str(e))
+
+
     def restart_vm(self, vm_id):
         '''Restart a VM'''
-        vm_to_restart = next((doc for doc in self.client.ReadDocuments(self.collection_vm['_self']) if doc['id'] == vm_id), None)
+        vm_to_restart = self.read_document(config_cosmos.COSMOSDB_COLLECTION_VM, vm_id)
         if vm_to_restart is not None:
             if vm_to_restart['state'] == "on":
                 return 'success'
@@ -112,20 +531,26 @@ class Processor():
     
     def get_all_rules(self):
         '''Retrieve all of the firewall rules'''
-        query = {'query': 'SELECT * FROM ' + config_cosmos.COSMOSDB_COLLECTION_FW}
-        docs = self.client.QueryDocuments(self.collection_fw['_self'], query)
-        return list(docs)  # must cast it to a list before it is readable as a list of records
+        return list(self.iter_rules())  # must cast it to a list before it is readable as a list of records
+
+
+    def get_rules_page(self, limit, cursor=None, fields=RULE_FIELDS):
+        '''Returns a page of firewall rules from the collection'''
+        return self.query_page(self.collection_fw, limit, cursor, fields)
 
 
+    def iter_rules(self, fields=RULE_FIELDS):
+        '''Returns all firewall rules, fetching them from Cosmos DB a page at a time as they are used'''
+        query = {'query': 'SELECT ' + self.projection(fields) + ' FROM c'}
+        return iter(self.client.QueryDocuments(self.collection_fw['_self'], query,
+                                               {'maxItemCount': config_cosmos.PAGE_SIZE, 'enableCrossPartitionQuery': True}))
+
+
+    @classes.governor.write_priority
     def add_rule(self, name, destination, target, action):
         '''Adds a new document to the firewallrules collection'''
         # Get the next fwid
-        fwid_document = next(doc for doc in self.client.ReadDocuments(self.collection_fwid['_self']))
-        next_fwid = int(fwid_document['nextfwid'][3:])  # grab just the numeric part of the ID as an integer
-        
-        # Update fwid collection
-        fwid_document['nextfwid'] = "fw-" + str(next_fwid + 1)
-        new_fwid = self.client.ReplaceDocument(fwid_document['_self'], fwid_document)
+        next_fwid = self.fwids.next_id()
 
         # Create new firewallrules document
         new_fw = self.client.CreateDocument(self.collection_fw['_self'],{
@@ -134,5 +559,80 @@ class Processor():
                                                                 'from': destination,
                                                                 'to': target,
                                                                 'action': action})
+        self.notify(config_cosmos.COSMOSDB_COLLECTION_FW, 'created', new_fw)
 
         return new_fw['id']
+
+
+    def get_subnets(self):
+        '''Reports on the subnet documents as they are in Cosmos DB, which may be newer than the bitmaps held here'''
+        self.ensure_subnets()    # so that any subnet still held as one document per IP has been migrated
+        capacities = list()
+        for document in self.client.ReadDocuments(self.collection_subnet['_self']):
+            cached = self.capacities.get(document['subnet'])
+            if cached is None or cached[0] != document['_etag']:
+                bitmap = SubnetBitmap.from_document(document)
+                if bitmap is None:
+                    continue
+                cached = self.capacities[document['subnet']] = (document['_etag'], bitmap.capacity())
+            capacities.append(cached[1])
+        return sorted(capacities, key=lambda capacity: capacity['subnet'])
+
+
+    @classes.governor.write_priority
+    def reconcile_subnets(self, confirmed=()):
+        '''The subnet documents are read before the VMs, so an address reserved in between for a VM that is being
+        created shows up as leaked rather than missing, and is left alone unless it is confirmed. Any repair is made
+        with update_subnet, so it is applied to the latest bitmap'''
+        self.ensure_subnets()
+        bitmaps = [SubnetBitmap.from_document(document) for document in self.client.ReadDocuments(self.collection_subnet['_self'])]
+        allocator = IPAllocator()
+        allocator.subnets = {bitmap.subnet: bitmap for bitmap in bitmaps if bitmap is not None}
+        held = allocator.group_by_subnet(ipaddress for vm in self.iter_vms(('ip',)) for ipaddress in vm['ip'])
+        reports = list()
+        for subnet in sorted(allocator.subnets):
+            reports.append(reconcile(allocator.get(subnet), held.get(subnet, ()), confirmed))
+            if reports[-1]['repaired'] and subnet in self.allocator:
+                reports[-1] = self.update_subnet(subnet, lambda bitmap, subnet=subnet: reconcile(bitmap, held.get(subnet, ()), confirmed))
+        return reports
+
+
+    def sync_token(self):
+        '''Cosmos DB stamps each write with the second it was made (_ts), so the position is a time. It is taken from
+        a little in the past in case this machine's clock is ahead'''
+        return int(time.time()) - CLOCK_MARGIN
+
+
+    def query_changes(self, collection, since, fields):
+        '''Returns the documents written and tombstones created since the time since. _ts is only to the second so
+        the changes made in the second of since itself are included, and may have been sent before'''
+        if since < time.time() - config_cosmos.SYNC_RETENTION:
+            raise SyncTokenExpired('Deletions since ' + str(since) + ' are no longer known')
+        query = {'query': 'SELECT ' + self.projection(tuple(fields) + ('_ts',)) + ' FROM c WHERE c._ts >= @since',
+                 'parameters': [{'name': '@since', 'value': since}]}
+        changes = [(document.pop('_ts'), document) for document in
+                   self.client.QueryDocuments(collection['_self'], query, {'enableCrossPartitionQuery': True})]
+        changes.extend((document['_ts'], {'id': document['id'], 'deleted': True}) for document in self.query_documents(
+            self.collection_tombstone, 'c.collection = @collection AND c._ts >= @since', {'@collection': collection['id'], '@since': since}))
+        return sorted(changes, key=lambda change: change[0])
+
+
+    def get_vm_changes(self, since, fields=VM_FIELDS):
+        return self.query_changes(self.collection_vm, since, fields)
+
+
+    def get_rule_changes(self, since, fields=RULE_FIELDS):
+        return self.query_changes(self.collection_fw, since, fields)
+
+
+    @classes.governor.write_priority
+    def save_job(self, job):
+        self.client.UpsertDocument(self.collection_link(config_cosmos.COSMOSDB_COLLECTION_JOB), job,
+                                   self.partition_options(config_cosmos.COSMOSDB_COLLECTION_JOB, job['id']))
+
+
+    def get_job(self, job_id):
+        document = self.read_document(config_cosmos.COSMOSDB_COLLECTION_JOB, job_id)
+        if document is None:
+            return None
+        return {key: value for key, value in document.items() if not key.startswith('_')}
@@ -0,0 +1,212 @@
+import socket
+import threading
+import time
+import config_cosmos
+from classes.baseprocessor import SyncTokenExpired
+from classes.validation import parse_network
+
+# MASKS[n] is the netmask of a /n as an integer
+MASKS = [(0xffffffff << (32 - length)) & 0xffffffff for length in range(33)]
+
+
+def ip_to_int(ipaddress):
+    '''Converts a dotted IPv4 address to an integer. Raises ValueError if it is not a valid address'''
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ipaddress), 'big')
+    except (OSError, TypeError):
+        raise ValueError('Invalid IP address ' + str(ipaddress))
+
+
+class FirewallEngine():
+    '''Answers whether traffic from one address to another is allowed by the firewall rules.
+
+    The rules are compiled into one hash table per (from prefix length, to prefix length) pair that is in use,
+    keyed on the masked (from, to) network addresses. Checking a flow is then one lookup per table, however
+    many rules there are. vmids in rules are expanded to the VM's IP addresses as /32s.
+
+    The most specific matching rule wins (longest from prefix plus longest to prefix), with ties going to the
+    earliest rule, so "default rule" style 0.0.0.0/0 rules only apply when nothing more specific matches.
+    Traffic that matches no rule is denied. Flows are IPv4 only, so IPv6 rules are accepted but never match.
+
+    The processor's listener keeps the tables up to date with writes made by this process, and the changes made by
+    other workers (from get_rule_changes and get_vm_changes) are applied every FIREWALL_REFRESH seconds'''
+
+    def __init__(self):
+        self.tables = dict()        # (from length, to length) -> {(from network, to network): [(rule number, fwid, action)]}
+        self.table_order = list()   # (total length, from length, to length, table) most specific first
+        self.rules = dict()         # fwid -> rule document
+        self.vm_ips = dict()        # vmid -> list of IP addresses as integers
+        self.vm_rules = dict()      # vmid -> set of fwids of the rules that refer to it
+        self.positions = dict()     # collection -> sync position that the other workers' changes have been applied up to
+        self.checked = 0.0          # time.monotonic() of the last check for their changes
+        self.loaded = False
+        self.lock = threading.Lock()
+
+
+    def load(self, position, rules, vms):
+        '''Compiles the full set of rules. vms are needed to resolve the vmids used in rules. position is the sync
+        token taken before the rules and VMs were read'''
+        with self.lock:
+            self.tables = dict()
+            self.rules = dict()
+            self.vm_rules = dict()
+            self.vm_ips = {vm['id']: [ip_to_int(ipaddress) for ipaddress in vm['ip']] for vm in vms}
+            for rule in rules:
+                self.insert_rule(rule)
+            self.order_tables()
+            self.positions = {config_cosmos.COSMOSDB_COLLECTION_FW: position, config_cosmos.COSMOSDB_COLLECTION_VM: position}
+            self.checked = time.monotonic()
+            self.loaded = True
+
+
+    def handle_change(self, collection, change, document):
+        '''Processor listener that keeps the compiled rules up to date as rules and VMs are written'''
+        if not self.loaded:
+            return   # nothing to update until the first flow check builds the tables
+        with self.lock:
+            self.apply(collection, None if change == 'deleted' else document, document['id'])
+            self.order_tables()
+
+
+    def refresh(self, get_rule_changes, get_vm_changes):
+        '''Applies the changes made since the last refresh, if it was more than FIREWALL_REFRESH seconds ago.
+        If they are no longer available the engine is marked as not loaded so that it gets built again'''
+        with self.lock:
+            if not self.loaded or time.monotonic() - self.checked < config_cosmos.FIREWALL_REFRESH:
+                return
+            self.checked = time.monotonic()
+            positions = dict(self.positions)
+        try:
+            changes = {config_cosmos.COSMOSDB_COLLECTION_FW: get_rule_changes(positions[config_cosmos.COSMOSDB_COLLECTION_FW]),
+                       config_cosmos.COSMOSDB_COLLECTION_VM: get_vm_changes(positions[config_cosmos.COSMOSDB_COLLECTION_VM])}
+        except SyncTokenExpired:
+            self.loaded = False
+            return
+        with self.lock:
+            for collection, collection_changes in changes.items():
+                for change_position, document in collection_changes:
+                    self.apply(collection, None if document.get('deleted') else document, document['id'])
+                    self.positions[collection] = max(self.positions[collection], change_position)
+            self.order_tables()
+
+
+    def apply(self, collection, document, document_id):
+        '''Brings a rule or VM up to date with its latest version, or removes it if document is None. Applying the
+        same change twice (from the listener and then from a refresh) leaves the tables as they were. Called with
+        the lock held'''
+        if collection == config_cosmos.COSMOSDB_COLLECTION_FW:
+            if document_id in self.rules:
+                self.remove_rule(self.rules.pop(document_id))
+            if document is not None:
+                self.insert_rule(document)
+        elif collection == config_cosmos.COSMOSDB_COLLECTION_VM:
+            # re-add any rules that refer to this VM so that they pick up (or drop) its addresses
+            affected = [self.rules[fwid] for fwid in self.vm_rules.get(document_id, ()) if fwid in self.rules]
+            for rule in affected:
+                self.remove_rule(rule)
+            if document is not None:
+                self.vm_ips[document_id] = [ip_to_int(ipaddress) for ipaddress in document['ip']]
+            else:
+                self.vm_ips.pop(document_id, None)
+            for rule in affected:
+                self.insert_rule(rule)
+
+
+    def expand(self, endpoint):
+        '''Returns the list of (network, prefix length) that a rule endpoint covers'''
+        if endpoint.startswith('vm-'):
+            return [(ipaddress, 32) for ipaddress in self.vm_ips.get(endpoint, [])]
+        network = parse_network(endpoint)
+        if network.version != 4:
+            return []    # flows are IPv4 so an IPv6 rule never matches
+        return [(network.first, network.prefixlen)]
+
+
+    def rule_entries(self, rule):
+        '''Generates the (table key, entry key, entry) for every from/to combination a rule covers'''
+        entry = (int(rule['id'][3:]), rule['id'], rule['action'])
+        for from_network, from_length in self.expand(rule['from']):
+            for to_network, to_length in self.expand(rule['to']):
+                yield (from_length, to_length), (from_network, to_network), entry
+
+
+    def insert_rule(self, rule):
+        self.rules[rule['id']] = rule
+        for endpoint in (rule['from'], rule['to']):
+            if endpoint.startswith('vm-'):
+                self.vm_rules.setdefault(endpoint, set()).add(rule['id'])
+        for table_key, entry_key, entry in self.rule_entries(rule):
+            entries = self.tables.setdefault(table_key, dict()).setdefault(entry_key, [])
+            entries.append(entry)
+            entries.sort()   # earliest rule first so that entries[0] is the one that applies
+
+
+    def remove_rule(self, rule):
+        for table_key, entry_key, entry in self.rule_entries(rule):
+            entries = self.tables[table_key][entry_key]
+            entries.remove(entry)
+            if not entries:
+                del self.tables[table_key][entry_key]
+
+
+    def order_tables(self):
+        # built as a new list and swapped in so that flow checks running at the same time see a consistent list
+        self.table_order = sorted(((from_length + to_length, from_length, to_length, table)
+                                   for (from_length, to_length), table in self.tables.items() if table),
+                                  key=lambda item: -item[0])
+
+
+    def check(self, source, destination):
+        '''Checks one flow between two IP addresses given as integers. Returns (action, fwid of the rule that applied)'''
+        best = None
+        best_length = None
+        for total_length, from_length, to_length, table in self.table_order:
+            if best is not None and total_length < best_length:
+                break   # every remaining table is less specific than the match already found
+            entries = table.get((source & MASKS[from_length], destination & MASKS[to_length]))
+            if entries and (best is None or entries[0] < best):
+                best = entries[0]
+                best_length = total_length
+        if best is None:
+            return 'deny', None
+        return best[2], best[1]
+
+
+    def resolve(self, endpoint):
+        '''Returns the IP addresses (as integers) of a flow endpoint, which is an IP address or a vmid.
+        Raises ValueError if it is neither or the VM does not exist'''
+        if endpoint.startswith('vm-'):
+            if endpoint not in self.vm_ips:
+                raise ValueError('Unknown VM ' + endpoint)
+            return self.vm_ips[endpoint]
+        return [ip_to_int(endpoint)]
+
+
+    def evaluate(self, flows):
+        '''Checks a batch of (from, to) flows. A flow involving a VM is only allowed if traffic between every
+        pair of its addresses is allowed. Returns a list of (action, fwid, error) in the same order, where error
+        says why a flow could not be checked (an address that isn't valid or a VM that doesn't exist), or is None'''
+        results = list()
+        resolved = dict()   # endpoints often repeat within a batch so only resolve each one once
+        for source, destination in flows:
+            for endpoint in (source, destination):
+                if endpoint not in resolved:
+                    try:
+                        resolved[endpoint] = self.resolve(endpoint)
+                    except ValueError as e:
+                        resolved[endpoint] = e
+            failed = next((resolved[endpoint] for endpoint in (source, destination)
+                           if isinstance(resolved[endpoint], ValueError)), None)
+            if failed is not None:
+                results.append((None, None, str(failed)))
+                continue
+            result = ('deny', None)
+            for source_ip in resolved[source]:
+                for destination_ip in resolved[destination]:
+                    result = self.check(source_ip, destination_ip)
+                    if result[0] != 'allow':
+                        break
+                if result[0] != 'allow':
+                    break
+            results.append(result + (None,))
+        return results
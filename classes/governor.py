@@ -0,0 +1,181 @@
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+import requests.adapters
+import pydocumentdb.errors as errors
+import config_cosmos
+import classes.tracing
+from classes.baseprocessor import BackendBusy
+
+DEFAULT_RETRY_AFTER = 1.0    # seconds to wait after a 429 that didn't say how long to wait
+
+# True while running an operation that writes, so that the reads it makes are given the priority of writes too and
+# it isn't left half done. Calls made on other threads on its behalf inherit it if run through classes.metrics.submit
+writing = contextvars.ContextVar('writing', default=False)
+
+
+class Overloaded(errors.HTTPFailure, BackendBusy):
+    '''Raised instead of making a call that can't be made in time, or once a call has been throttled too often.
+    It is a 429 HTTPFailure so that the processor's clean up of failed calls applies to it'''
+
+    def __init__(self, retry_after):
+        errors.HTTPFailure.__init__(self, 429, 'Request rate is large', {'x-ms-retry-after-ms': str(int(retry_after * 1000))})
+        self.retry_after = retry_after
+
+
+def write_priority(method):
+    '''Decorator for the Processor methods that write'''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        token = writing.set(True)
+        try:
+            return method(*args, **kwargs)
+        finally:
+            writing.reset(token)
+    return wrapper
+
+
+class Governor():
+    '''Decides when each call to Cosmos DB can be made, so that the process stays within its throughput rather than
+    finding out it has gone over from a flood of 429s:
+
+    - a token bucket of request units that refills at throughput RU/s. A call can start while the bucket isn't empty
+      and what it cost (x-ms-request-charge) is taken out once it is back, so a costly call can leave it in debt
+    - a limit on the calls in flight that is halved when a call is throttled and grows back by one every limit
+      calls that aren't, between 1 and max_limit
+    - a throttled call pauses every call for the x-ms-retry-after-ms that Cosmos DB asked for
+    - waiting writes are let in before any read, and a read gives up after read_wait seconds where a write waits up
+      to write_wait, so that when there isn't enough throughput the reads are shed first'''
+
+    def __init__(self, throughput, max_limit, read_wait, write_wait):
+        self.throughput = throughput    # None for no token bucket
+        self.tokens = throughput or 0.0
+        self.refilled = time.monotonic()
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.paused_until = 0.0         # time.monotonic() that the last throttled call asked everything to wait until
+        self.read_wait = read_wait
+        self.write_wait = write_wait
+        self.waiting_writes = 0
+        self.condition = threading.Condition()
+        # totals reported on /metrics
+        self.throttled = 0
+        self.retries = 0
+        self.shed = {'read': 0, 'write': 0}
+
+
+    def refill(self, now):
+        if self.throughput is not None:
+            self.tokens = min(self.throughput, self.tokens + (now - self.refilled) * self.throughput)
+        self.refilled = now
+
+
+    def ready_at(self, now):
+        '''The time at which the bucket and any pause will let another call start. Called with the lock held'''
+        ready = self.paused_until
+        if self.throughput is not None and self.tokens <= 0:
+            ready = max(ready, now + (-self.tokens + 1) / self.throughput)
+        return ready
+
+
+    def acquire(self, write):
+        '''Waits until a call can be made. Raises Overloaded if it can't be made within the read or write wait'''
+        kind = 'write' if write else 'read'
+        deadline = time.monotonic() + (self.write_wait if write else self.read_wait)
+        with self.condition:
+            if write:
+                self.waiting_writes += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    ready = self.ready_at(now)
+                    if ready <= now and self.in_flight < int(self.limit) and (write or not self.waiting_writes):
+                        self.in_flight += 1
+                        return
+                    if now >= deadline or ready > deadline:
+                        # give up straight away rather than waiting for something that won't come in time
+                        self.shed[kind] += 1
+                        raise Overloaded(max(ready - now, DEFAULT_RETRY_AFTER))
+                    self.condition.wait((ready if ready > now else deadline) - now)
+            finally:
+                if write:
+                    self.waiting_writes -= 1
+                    self.condition.notify_all()
+
+
+    def release(self, charge=0.0, retry_after=None):
+        '''Records the outcome of a call started with acquire. retry_after is set if the call was throttled'''
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self.refill(now)
+            self.tokens -= charge
+            if retry_after is not None:
+                self.throttled += 1
+                if now >= self.paused_until:
+                    # only back off once for the calls that were throttled together
+                    self.limit = max(1.0, self.limit / 2)
+                self.paused_until = max(self.paused_until, now + retry_after)
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+    @contextlib.contextmanager
+    def call(self, write):
+        '''Context manager for making one call. Yields a dict in which to put the charge and, if throttled, retry_after'''
+        self.acquire(write)
+        outcome = {'charge': 0.0, 'retry_after': None}
+        try:
+            yield outcome
+        finally:
+            self.release(outcome['charge'], outcome['retry_after'])
+
+
+def is_write(request):
+    '''True for anything but point reads, feeds and queries (which are POSTs with the x-ms-documentdb-isquery header)'''
+    if writing.get():
+        return True
+    return request.method not in ('GET', 'HEAD') and request.headers.get('x-ms-documentdb-isquery') is None
+
+
+class GovernedAdapter(requests.adapters.BaseAdapter):
+    '''requests transport adapter that sends every call made by the DocumentClient (including each page of a query)
+    through the Governor, and retries throttled calls after the x-ms-retry-after-ms that Cosmos DB sends, up to
+    COSMOSDB_MAX_RETRIES times or COSMOSDB_MAX_RETRY_WAIT seconds of waiting in total. transport is the adapter
+    that actually sends them'''
+
+    def __init__(self, governor, transport):
+        requests.adapters.BaseAdapter.__init__(self)
+        self.governor = governor
+        self.transport = transport
+
+
+    def send(self, request, **kwargs):
+        write = is_write(request)
+        waited = 0.0
+        for attempt in range(config_cosmos.COSMOSDB_MAX_RETRIES + 1):
+            with self.governor.call(write) as outcome:
+                response = self.transport.send(request, **kwargs)
+                outcome['charge'] = float(response.headers.get('x-ms-request-charge', 0))
+                if response.status_code != 429:
+                    return response
+                retry_after = int(response.headers.get('x-ms-retry-after-ms', DEFAULT_RETRY_AFTER * 1000)) / 1000
+                outcome['retry_after'] = retry_after
+            response.close()
+            classes.tracing.record('cosmosdb', 'throttled ' + request.method + ' ' + request.path_url, 0.0,
+                                   status=429, retry_after=retry_after)
+            waited += retry_after
+            if waited > config_cosmos.COSMOSDB_MAX_RETRY_WAIT or attempt == config_cosmos.COSMOSDB_MAX_RETRIES:
+                break
+            with self.governor.condition:
+                self.governor.retries += 1    # the next acquire waits out the pause
+        raise Overloaded(retry_after)
+
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,45 @@
+import threading
+
+
+class IDBlockAllocator():
+    '''Hands out IDs from blocks leased from a shared counter (hi/lo) so that the counter is only written
+    once per block rather than once per ID. IDs left in a block when the process stops are never used,
+    which is fine as IDs are not reused anyway'''
+
+    def __init__(self, lease, block_size):
+        self.lease = lease             # function taking a block size and returning the first ID of the block it reserved
+        self.block_size = block_size
+        self.next = 0                  # next ID to hand out
+        self.limit = 0                 # first ID that is not in the current block
+        self.lock = threading.Lock()
+
+
+    def next_id(self):
+        '''Returns the next ID as an integer, leasing a new block if the current one is used up'''
+        with self.lock:
+            if self.next >= self.limit:
+                self.next = self.lease(self.block_size)
+                self.limit = self.next + self.block_size
+            next_id = self.next
+            self.next += 1
+            return next_id
+
+
+    def next_ids(self, count):
+        '''Returns a range of count consecutive IDs. They come from the current block if it has room,
+        otherwise a block of exactly count IDs is leased so that the range is contiguous'''
+        with self.lock:
+            if self.limit - self.next >= count:
+                first_id = self.next
+                self.next += count
+            else:
+                first_id = self.lease(count)
+            return range(first_id, first_id + count)
+
+
+    def discard(self):
+        '''Drops the current block so that the next ID comes from a new one. A forked worker calls this so that it
+        doesn't hand out the same IDs as the process it was forked from'''
+        with self.lock:
+            self.next = 0
+            self.limit = 0
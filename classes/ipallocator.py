@@ -0,0 +1,246 @@
+import base64
+import copy
+from collections import Counter
+from netaddr import IPNetwork, IPAddress
+
+
+class SubnetBitmap():
+    '''Tracks which host addresses in a single subnet are in use as a compact bitmap.
+    Bit n represents the nth usable address, i.e. the network and broadcast addresses are never included'''
+
+    def __init__(self, subnet, bitmap=None, used=None):
+        network = IPNetwork(subnet)
+        self.subnet = subnet
+        self.first = network.first + 1           # first usable address as an integer
+        self.size = max(network.size - 2, 0)     # number of usable addresses in the subnet
+        if bitmap is None:
+            self.bits = bytearray((self.size + 7) // 8)
+        else:
+            self.bits = bytearray(base64.b64decode(bitmap))
+        # the count saved with the bitmap is kept up to date by reserve and release, so it is only worked out from the
+        # bits if there isn't one. reconcile_subnets checks that the two agree
+        self.used = self.count_used() if used is None else used
+        self.hint = 0    # every byte before this index is known to be full so searches can start here
+        self.largest = None    # (offset, length) of the largest block of free addresses, worked out when first asked for
+
+
+    @classmethod
+    def from_document(cls, document):
+        '''Builds a bitmap from a subnet document. Returns None if the document has not been migrated yet'''
+        if 'bitmap' not in document:
+            return None
+        return cls(document['subnet'], document['bitmap'], document.get('used'))
+
+
+    def to_document(self, document):
+        '''Writes the bitmap into the subnet document so that it can be persisted'''
+        document['bitmap'] = base64.b64encode(bytes(self.bits)).decode('ascii')
+        document['used'] = self.used
+        return document
+
+
+    def copy(self):
+        '''Returns a copy that can be changed without changing this bitmap'''
+        bitmap = copy.copy(self)
+        bitmap.bits = bytearray(self.bits)
+        return bitmap
+
+
+    def __contains__(self, ipaddress):
+        return 0 <= int(IPAddress(ipaddress)) - self.first < self.size
+
+
+    def address(self, offset):
+        '''Returns the IP address string for a bit offset'''
+        return str(IPAddress(self.first + offset))
+
+
+    def offset(self, ipaddress):
+        '''Returns the bit offset for an IP address string'''
+        return int(IPAddress(ipaddress)) - self.first
+
+
+    def is_used(self, offset):
+        return bool(self.bits[offset >> 3] & (0x80 >> (offset & 7)))
+
+
+    def free(self):
+        return self.size - self.used
+
+
+    def count_used(self):
+        '''Counts the used addresses from the bits themselves'''
+        return sum(bin(byte).count('1') for byte in self.bits)
+
+
+    def bit_string(self):
+        '''The bitmap as a string of '0' and '1' characters, one per usable address'''
+        return format(int.from_bytes(self.bits, 'big'), '0' + str(len(self.bits) * 8) + 'b')[:self.size]
+
+
+    def used_offsets(self):
+        return {offset for offset, bit in enumerate(self.bit_string()) if bit == '1'}
+
+
+    def largest_free(self):
+        '''Returns the (offset, length) of the largest block of contiguous free addresses. It is worked out from the
+        bits when first asked for and then only again after a change that may have altered it'''
+        if self.largest is None:
+            bits = self.bit_string()
+            length = max(len(run) for run in bits.split('1'))
+            self.largest = (bits.find('0' * length) if length else 0, length)
+        return self.largest
+
+
+    def capacity(self):
+        '''Returns the total, used and free address counts and the largest block of free addresses'''
+        offset, length = self.largest_free()
+        return {'subnet': self.subnet, 'total': self.size, 'used': self.used, 'free': self.free(),
+                'largest_free_block': {'first': self.address(offset), 'size': length} if length else None}
+
+
+    def find_free(self, count=1):
+        '''Returns the offsets of the next count free addresses without reserving them.
+        Returns an empty list if there are not enough free addresses'''
+        if count > self.free():
+            return []
+
+        offsets = list()
+        index = self.hint
+        while len(offsets) < count:
+            if index >= len(self.bits):
+                return []    # the used count was out of step with the bits
+            # skip over the full bytes at C speed rather than testing them one bit at a time
+            remaining = self.bits[index:]
+            index += len(remaining) - len(remaining.lstrip(b'\xff'))
+            if len(offsets) == 0:
+                self.hint = index
+            byte = self.bits[index]
+            for bit in range(8):
+                offset = (index << 3) + bit
+                if offset < self.size and not byte & (0x80 >> bit):
+                    offsets.append(offset)
+                    if len(offsets) == count:
+                        break
+            index += 1
+        return offsets
+
+
+    def reserve(self, offsets):
+        '''Marks the offsets as used'''
+        for offset in offsets:
+            if not self.is_used(offset):
+                self.bits[offset >> 3] |= 0x80 >> (offset & 7)
+                self.used += 1
+                # only a reservation inside the largest free block can make it smaller
+                if self.largest is not None and self.largest[0] <= offset < self.largest[0] + self.largest[1]:
+                    self.largest = None
+
+
+    def release(self, offsets):
+        '''Marks the offsets as free'''
+        for offset in offsets:
+            if self.is_used(offset):
+                self.bits[offset >> 3] &= ~(0x80 >> (offset & 7)) & 0xff
+                self.used -= 1
+                self.hint = min(self.hint, offset >> 3)
+                self.largest = None
+
+
+    def allocate(self, count=1):
+        '''Reserves the next count free addresses and returns them as IP address strings'''
+        offsets = self.find_free(count)
+        self.reserve(offsets)
+        return [self.address(offset) for offset in offsets]
+
+
+class IPAllocator():
+    '''Holds a SubnetBitmap for every subnet in the catalogue so that free addresses can be found
+    without reading the ipaddresses collection'''
+
+    def __init__(self):
+        self.subnets = dict()     # subnet string -> SubnetBitmap
+        self.documents = dict()   # subnet string -> the subnet document the bitmap was loaded from
+
+
+    def load(self, document):
+        '''Loads (or reloads) a subnet from its document. Returns False if the document has no bitmap yet'''
+        bitmap = SubnetBitmap.from_document(document)
+        if bitmap is None:
+            return False
+        self.subnets[bitmap.subnet] = bitmap
+        self.documents[bitmap.subnet] = document
+        return True
+
+
+    def __contains__(self, subnet):
+        return subnet in self.subnets
+
+
+    def get(self, subnet):
+        return self.subnets.get(subnet)
+
+
+    def subnet_for(self, ipaddress):
+        '''Returns the bitmap of the subnet that holds this IP address, or None if it is not in a known subnet'''
+        for bitmap in self.subnets.values():
+            if ipaddress in bitmap:
+                return bitmap
+        return None
+
+
+    def group_by_subnet(self, ipaddresses):
+        '''Groups a list of IP addresses into a dict of subnet -> bit offsets so they can be reserved or
+        released in bulk. Addresses that are not in a known subnet are ignored'''
+        grouped = dict()
+        for ipaddress in ipaddresses:
+            bitmap = self.subnet_for(ipaddress)
+            if bitmap is not None:
+                grouped.setdefault(bitmap.subnet, []).append(bitmap.offset(ipaddress))
+        return grouped
+
+
+def build_bitmap(subnet, used_addresses):
+    '''Builds a SubnetBitmap from the IP addresses that are in use. Used to migrate from the one document
+    per IP address layout where the used addresses are those with a non-empty usedby'''
+    bitmap = SubnetBitmap(subnet)
+    bitmap.reserve([bitmap.offset(ipaddress) for ipaddress in used_addresses if ipaddress in bitmap])
+    return bitmap
+
+
+def reconcile(bitmap, held, confirmed=()):
+    '''Repairs a subnet's bitmap against the addresses that the VMs actually hold in it (held, a collection of bit
+    offsets). Held addresses that are marked free are marked used. Addresses that are marked used but not held by any
+    VM are freed only if they are in confirmed, as a VM that is being created holds its addresses before it exists.
+    The used count is recounted from the bits. Returns a report of the drift found'''
+    held = set(held)
+    used = bitmap.used_offsets()
+    missing = sorted(held - used)
+    leaked = sorted(used - held)
+    freed = [offset for offset in leaked if bitmap.address(offset) in confirmed]
+    counted = bitmap.count_used()
+    report = {'subnet': bitmap.subnet, 'used': bitmap.used, 'counted': counted,
+              'missing': [bitmap.address(offset) for offset in missing],
+              'leaked': [bitmap.address(offset) for offset in leaked],
+              'freed': [bitmap.address(offset) for offset in freed],
+              'repaired': bool(missing or freed or counted != bitmap.used)}
+    bitmap.used = counted
+    bitmap.reserve(missing)
+    bitmap.release(freed)
+    return report
+
+
+def distribute(specs, reserved):
+    '''Hands out addresses that were reserved in bulk to each VM in order. specs is a list of (name, subnets) and
+    reserved is a dict of subnet -> reserved addresses. Returns a list with the addresses for each spec (or None if
+    one of its subnets ran out) and the list of reserved addresses that were not handed out and need releasing'''
+    pools = {subnet: list(reversed(addresses)) for subnet, addresses in reserved.items()}
+    allocations = list()
+    for name, subnets in specs:
+        needed = Counter(subnets)
+        if all(len(pools.get(subnet, [])) >= count for subnet, count in needed.items()):
+            allocations.append([pools[subnet].pop() for subnet in subnets])
+        else:
+            allocations.append(None)
+    unused = [ipaddress for pool in pools.values() for ipaddress in pool]
+    return allocations, unused
@@ -0,0 +1,131 @@
+import threading
+import time
+import traceback
+import uuid
+import config_cosmos
+
+
+class QueueFull(Exception):
+    '''Raised when JOB_QUEUE_SIZE jobs are already waiting'''
+
+
+class JobQueue():
+    '''Runs VM operations in the background on JOB_WORKERS threads, saving each job's progress through save so that
+    any worker can report on it. A job document holds the operation, the vmid it acts on (if any), its status
+    ('queued', 'running', 'finished' or 'failed') and once finished the result: the status and body the request
+    would have got had it been run straight away.
+
+    Jobs on the same VM run one at a time in the order they were submitted. Submitting an operation that is already
+    waiting for the same VM returns the waiting job rather than queueing it again, and the waiting jobs of an
+    operation in coalesce are run together with a single call to its handler'''
+
+    def __init__(self, save, handlers, coalesce=()):
+        self.save = save              # function that writes a job document to the backend
+        self.handlers = handlers      # operation -> function taking a list of jobs and returning a (body, status) for each
+        self.coalesce = coalesce
+        self.condition = threading.Condition()
+        self.waiting = list()         # jobs that haven't started, oldest first
+        self.unsaved = set()          # ids of waiting jobs whose first save hasn't finished, which can't start yet
+        self.busy = set()             # vmids that have a job running
+        self.running = 0
+        self.threads = list()
+
+
+    def submit(self, operation, vmid=None, parameters=None):
+        '''Queues an operation and returns its job document. Raises QueueFull if the queue is full'''
+        with self.condition:
+            if vmid is not None:
+                for job in self.waiting:
+                    if job['operation'] == operation and job['vmid'] == vmid:
+                        return dict(job)
+            if len(self.waiting) >= config_cosmos.JOB_QUEUE_SIZE:
+                raise QueueFull()
+            now = time.time()
+            job = {'id': 'job-' + uuid.uuid4().hex, 'operation': operation, 'vmid': vmid, 'parameters': parameters,
+                   'status': 'queued', 'result': None, 'error': None, 'created': now, 'updated': now}
+            self.waiting.append(job)
+            self.unsaved.add(job['id'])
+            if not self.threads:
+                # started on first use so that a pre-forking master never has any
+                for number in range(config_cosmos.JOB_WORKERS):
+                    self.threads.append(threading.Thread(target=self.work, daemon=True))
+                    self.threads[-1].start()
+
+        # saved outside the lock so that submissions aren't held up by each other's writes
+        try:
+            self.save(dict(job))
+        except Exception:
+            with self.condition:
+                self.waiting.remove(job)
+                self.unsaved.discard(job['id'])
+            raise
+        with self.condition:
+            self.unsaved.discard(job['id'])
+            self.condition.notify_all()
+        return dict(job)
+
+
+    def take(self):
+        '''Removes and returns the next jobs that can be run, or None if there are none. Called with the lock held'''
+        blocked = set()    # vmids with an earlier job still waiting
+        for job in self.waiting:
+            if job['id'] in self.unsaved or job['vmid'] in self.busy or job['vmid'] in blocked:
+                if job['vmid'] is not None:
+                    blocked.add(job['vmid'])
+                continue
+            if job['operation'] in self.coalesce:
+                jobs = [other for other in self.waiting if other['operation'] == job['operation'] and
+                        other['id'] not in self.unsaved][:config_cosmos.MAX_BATCH_SIZE]
+            else:
+                jobs = [job]
+            for taken in jobs:
+                self.waiting.remove(taken)
+                if taken['vmid'] is not None:
+                    self.busy.add(taken['vmid'])
+            return jobs
+        return None
+
+
+    def work(self):
+        while True:
+            with self.condition:
+                jobs = self.take()
+                while jobs is None:
+                    self.condition.wait()
+                    jobs = self.take()
+                self.running += 1
+            try:
+                self.run(jobs)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.busy.difference_update(job['vmid'] for job in jobs)
+                    self.condition.notify_all()
+
+
+    def run(self, jobs):
+        for job in jobs:
+            self.update(job, status='running')
+        try:
+            results = self.handlers[jobs[0]['operation']](jobs)
+        except Exception as e:
+            traceback.print_exc()
+            for job in jobs:
+                self.update(job, status='failed', error=str(e))
+            return
+        for job, (body, status) in zip(jobs, results):
+            self.update(job, status='finished', result={'status': status, 'body': body})
+
+
+    def update(self, job, **changes):
+        job.update(changes, updated=time.time())
+        try:
+            self.save(dict(job))
+        except Exception as e:
+            print("unable to save job " + job['id'] + ": " + str(e))
+
+
+    def wait(self, timeout):
+        '''Waits up to timeout seconds for every queued job to finish. Registered to run when the process exits'''
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.waiting and self.running == 0, timeout)
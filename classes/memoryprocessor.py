@@ -0,0 +1,247 @@
+import collections
+import itertools
+import threading
+import time
+import config_cosmos
+import classes.metrics
+from classes.baseprocessor import BaseProcessor, encode_cursor, decode_cursor, VM_FIELDS, RULE_FIELDS
+from classes.ipallocator import IPAllocator, SubnetBitmap, distribute, reconcile
+from classes.seedloader import next_id, owners
+from collections import Counter
+
+
+class Table():
+    '''Documents kept in the order they were added so that they can be paged through. A document's position never
+    changes, so a deleted one leaves a gap in order rather than moving the documents after it'''
+
+    def __init__(self):
+        self.documents = dict()   # id -> document
+        self.order = list()       # ids in the order they were added, with None where one has been deleted
+        self.positions = dict()   # id -> index in order
+
+
+    def put(self, document):
+        if document['id'] not in self.documents:
+            self.positions[document['id']] = len(self.order)
+            self.order.append(document['id'])
+        self.documents[document['id']] = document
+
+
+    def remove(self, document_id):
+        self.order[self.positions.pop(document_id)] = None
+        return self.documents.pop(document_id)
+
+
+    def page(self, limit, cursor):
+        '''Returns up to limit documents after the cursor position and the position of the last one, or None if
+        there are no more'''
+        index = 0 if cursor is None else int(decode_cursor(cursor)) + 1
+        if index < 0:
+            raise ValueError('Invalid cursor ' + cursor)
+        documents = list()
+        while index < len(self.order) and len(documents) < limit:
+            if self.order[index] is not None:
+                documents.append(self.documents[self.order[index]])
+            index += 1
+        if index >= len(self.order):
+            return documents, None
+        return documents, encode_cursor(index - 1)
+
+
+class Processor(BaseProcessor):
+    '''Holds the whole catalogue in memory with the same semantics as the database backends: IDs are allocated from
+    counters, IP addresses from subnet bitmaps and deleted VMs give their addresses back. Nothing is persisted, so
+    it is used by main-stub.py for client teams to develop and load test against without a database'''
+
+    def __init__(self, catalogue=None):
+        BaseProcessor.__init__(self)
+        self.lock = threading.Lock()    # held for every read and write so that pages are consistent
+        self.vms = Table()
+        self.rules = Table()
+        self.allocator = IPAllocator()
+        self.vmids = itertools.count(1)
+        self.fwids = itertools.count(1)
+        # (collection, id) -> (position, deleted) of the latest change to each document, oldest first. Nothing is
+        # kept after the process stops so tombstones are never removed
+        self.changes = collections.OrderedDict()
+        self.position = 0
+        self.jobs = dict()
+        if catalogue is not None:
+            self.load(catalogue)
+
+
+    def load(self, catalogue):
+        '''Loads a catalogue (see classes.seedloader) on top of what is already held'''
+        seed_owners = owners(catalogue)
+        with self.lock:
+            for subnet in catalogue['subnets']:
+                if subnet not in self.allocator:
+                    self.allocator.subnets[subnet] = SubnetBitmap(subnet)
+            for subnet, offsets in self.allocator.group_by_subnet(seed_owners).items():
+                self.allocator.get(subnet).reserve(offsets)
+            for vm in catalogue['vms']:
+                self.vms.put(dict(vm))
+                self.record_change(config_cosmos.COSMOSDB_COLLECTION_VM, vm['id'])
+            for rule in catalogue['rules']:
+                self.rules.put(dict(rule))
+                self.record_change(config_cosmos.COSMOSDB_COLLECTION_FW, rule['id'])
+            # vmids and fwids are not reused so the counters only move forwards
+            self.vmids = itertools.count(max(next(self.vmids), next_id(catalogue['vms'])))
+            self.fwids = itertools.count(max(next(self.fwids), next_id(catalogue['rules'])))
+
+
+    def record_change(self, collection, document_id, deleted=False):
+        '''Moves the document to the end of changes with the next position. Called with the lock held'''
+        self.position += 1
+        self.changes.pop((collection, document_id), None)
+        self.changes[(collection, document_id)] = (self.position, deleted)
+
+
+    def project(self, documents, fields):
+        '''Copies just the fields asked for so that callers can't change the stored documents'''
+        classes.metrics.add_to_account(calls=1, documents=len(documents))
+        return [{field: document[field] for field in fields} for document in documents]
+
+
+    def get_all_vms(self):
+        with self.lock:
+            return self.project(list(self.vms.documents.values()), VM_FIELDS)
+
+
+    def get_vms_page(self, limit, cursor=None, fields=VM_FIELDS):
+        with self.lock:
+            documents, next_cursor = self.vms.page(limit, cursor)
+            return self.project(documents, fields), next_cursor
+
+
+    def add_vm(self, name, subnets):
+        return self.add_vms([(name, subnets)])[0]
+
+
+    def add_vms(self, specs):
+        '''Reserves the addresses for all of the VMs at once in the same way as the database backends'''
+        demand = Counter(subnet for name, subnets in specs for subnet in subnets)
+        with self.lock:
+            reserved = dict()
+            for subnet, count in demand.items():
+                bitmap = self.allocator.get(subnet)
+                if bitmap is not None:
+                    reserved[subnet] = bitmap.allocate(min(count, bitmap.free()))
+            allocations, unused = distribute(specs, reserved)
+            for subnet, offsets in self.allocator.group_by_subnet(unused).items():
+                self.allocator.get(subnet).release(offsets)
+
+            results = list()
+            new_vms = list()
+            for (name, subnets), ipaddresses in zip(specs, allocations):
+                if ipaddresses is None:
+                    results.append(False)
+                    continue
+                vm = {'id': 'vm-' + str(next(self.vmids)), 'name': name, 'ip': ipaddresses, 'state': "off"}
+                self.vms.put(vm)
+                self.record_change(config_cosmos.COSMOSDB_COLLECTION_VM, vm['id'])
+                new_vms.append(vm)
+                results.append(vm['id'])
+
+        for vm in new_vms:
+            self.notify(config_cosmos.COSMOSDB_COLLECTION_VM, 'created', dict(vm))
+        return results
+
+
+    def delete_vm(self, vm_id):
+        with self.lock:
+            if vm_id not in self.vms.documents:
+                return False
+            vm = self.vms.remove(vm_id)
+            self.record_change(config_cosmos.COSMOSDB_COLLECTION_VM, vm_id, deleted=True)
+            for subnet, offsets in self.allocator.group_by_subnet(vm['ip']).items():
+                self.allocator.get(subnet).release(offsets)
+        self.notify(config_cosmos.COSMOSDB_COLLECTION_VM, 'deleted', dict(vm))
+        return True
+
+
+    def restart_vm(self, vm_id):
+        with self.lock:
+            vm = self.vms.documents.get(vm_id)
+        if vm is None:
+            return 'notfound'
+        elif vm['state'] == "on":
+            return 'success'
+        else:
+            return 'off'
+
+
+    def get_all_rules(self):
+        with self.lock:
+            return self.project(list(self.rules.documents.values()), RULE_FIELDS)
+
+
+    def get_rules_page(self, limit, cursor=None, fields=RULE_FIELDS):
+        with self.lock:
+            documents, next_cursor = self.rules.page(limit, cursor)
+            return self.project(documents, fields), next_cursor
+
+
+    def add_rule(self, name, destination, target, action):
+        rule = {'id': None, 'name': name, 'from': destination, 'to': target, 'action': action}
+        with self.lock:
+            rule['id'] = 'fw-' + str(next(self.fwids))
+            self.rules.put(rule)
+            self.record_change(config_cosmos.COSMOSDB_COLLECTION_FW, rule['id'])
+        self.notify(config_cosmos.COSMOSDB_COLLECTION_FW, 'created', dict(rule))
+        return rule['id']
+
+
+    def get_subnets(self):
+        with self.lock:
+            return [self.allocator.get(subnet).capacity() for subnet in sorted(self.allocator.subnets)]
+
+
+    def reconcile_subnets(self, confirmed=()):
+        with self.lock:
+            held = self.allocator.group_by_subnet(ipaddress for vm in self.vms.documents.values() for ipaddress in vm['ip'])
+            return [reconcile(self.allocator.get(subnet), held.get(subnet, ()), confirmed)
+                    for subnet in sorted(self.allocator.subnets)]
+
+
+    def sync_token(self):
+        return self.position
+
+
+    def query_changes(self, collection, table, since, fields):
+        '''Walks back from the newest change until it reaches since'''
+        with self.lock:
+            changes = list()
+            for (change_collection, document_id), (position, deleted) in reversed(self.changes.items()):
+                if position <= since:
+                    break
+                if change_collection != collection:
+                    continue
+                if deleted:
+                    changes.append((position, {'id': document_id, 'deleted': True}))
+                else:
+                    changes.append((position, self.project([table.documents[document_id]], fields)[0]))
+        return changes[::-1]
+
+
+    def get_vm_changes(self, since, fields=VM_FIELDS):
+        return self.query_changes(config_cosmos.COSMOSDB_COLLECTION_VM, self.vms, since, fields)
+
+
+    def get_rule_changes(self, since, fields=RULE_FIELDS):
+        return self.query_changes(config_cosmos.COSMOSDB_COLLECTION_FW, self.rules, since, fields)
+
+
+    def save_job(self, job):
+        with self.lock:
+            self.jobs[job['id']] = dict(job)
+            # jobs are kept in the order they were created so the expired ones are at the front
+            cutoff = time.time() - config_cosmos.JOB_RETENTION
+            while self.jobs and next(iter(self.jobs.values()))['created'] < cutoff:
+                del self.jobs[next(iter(self.jobs))]
+
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
@@ -0,0 +1,402 @@
+import bisect
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import urllib.parse
+import config_cosmos
+import classes.tracing
+
+ARCHIVE = 'stopped.json'    # holds the counters of the workers that have stopped, in the metrics directory
+
+# Upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The Processor methods that are accounted for. These are the BaseProcessor interface
+PROCESSOR_METHODS = ('get_all_vms', 'get_vms_page', 'iter_vms', 'add_vm', 'add_vms', 'delete_vm', 'restart_vm',
+                     'get_all_rules', 'get_rules_page', 'iter_rules', 'add_rule', 'warm_up', 'sync_token',
+                     'get_vm_changes', 'get_rule_changes', 'save_job', 'get_job', 'get_subnets', 'reconcile_subnets')
+
+# The Account that backend calls are being added to, i.e. the Processor method that is running. Calls made on other
+# threads on its behalf are only counted if they are run in a copy of the context (see submit)
+current_account = contextvars.ContextVar('current_account', default=None)
+
+
+class Histogram():
+    '''Latency histogram with the fixed BUCKETS. Counts are kept per bucket and only made cumulative when rendered'''
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)    # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def merge(self, counts, total, count):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, counts)]
+        self.sum += total
+        self.count += count
+
+
+    def render(self, name, labels):
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(name + '_bucket{' + labels + ',le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append(name + '_sum{' + labels + '} ' + repr(self.sum))
+        lines.append(name + '_count{' + labels + '} ' + str(self.count))
+        return lines
+
+
+class Account():
+    '''What one call to a Processor method did in the backend'''
+
+    def __init__(self):
+        self.calls = 0         # requests made to Cosmos DB, or statements run by SQLite
+        self.documents = 0     # documents (or rows) read
+        self.charge = 0.0      # Cosmos DB request units
+        self.lock = threading.Lock()
+
+
+    def add(self, calls=0, documents=0, charge=0.0):
+        with self.lock:
+            self.calls += calls
+            self.documents += documents
+            self.charge += charge
+
+
+class BackendStats():
+    def __init__(self):
+        self.latency = Histogram()
+        self.calls = 0
+        self.documents = 0
+        self.charge = 0.0
+
+
+class Metrics():
+    '''Collects the request and backend metrics and renders them in the Prometheus text format. The metrics of
+    several workers are added up by merging their snapshots into one Metrics (see collect)'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = dict()     # (route, method, status) -> Histogram
+        self.in_flight = dict()    # route -> number of requests being handled
+        self.backend = dict()      # (backend, processor method) -> BackendStats
+        self.governor = None       # the Cosmos DB classes.governor.Governor, once there is one
+        self.cache = None          # the listing classes.responsecache.ResponseCache
+        # the governor's and cache's figures, when added up from snapshots
+        self.cosmosdb = None
+        self.cache_stats = {'hits': 0, 'misses': 0, 'entries': 0}
+
+
+    def request_started(self, route):
+        with self.lock:
+            self.in_flight[route] = self.in_flight.get(route, 0) + 1
+
+
+    def request_finished(self, route):
+        with self.lock:
+            self.in_flight[route] -= 1
+
+
+    def observe_request(self, route, method, status, duration):
+        with self.lock:
+            histogram = self.requests.get((route, method, status))
+            if histogram is None:
+                histogram = self.requests[(route, method, status)] = Histogram()
+            histogram.observe(duration)
+
+
+    def observe_backend(self, backend, method, duration, account):
+        with self.lock:
+            stats = self.backend.get((backend, method))
+            if stats is None:
+                stats = self.backend[(backend, method)] = BackendStats()
+            stats.latency.observe(duration)
+            stats.calls += account.calls
+            stats.documents += account.documents
+            stats.charge += account.charge
+
+
+    def snapshot(self):
+        '''Returns everything collected so far as a dict that can be saved as JSON'''
+        with self.lock:
+            snapshot = {'requests': [[route, method, status, histogram.counts, histogram.sum, histogram.count]
+                                     for (route, method, status), histogram in self.requests.items()],
+                        'in_flight': dict(self.in_flight),
+                        'backend': [[backend, method, stats.latency.counts, stats.latency.sum, stats.latency.count,
+                                     stats.calls, stats.documents, stats.charge]
+                                    for (backend, method), stats in self.backend.items()]}
+        governor = self.governor
+        if governor is not None:
+            with governor.condition:
+                snapshot['cosmosdb'] = {'throttled': governor.throttled, 'retries': governor.retries,
+                                        'shed': dict(governor.shed), 'limit': int(governor.limit)}
+        if self.cache is not None:
+            snapshot['cache'] = self.cache.stats()
+        return snapshot
+
+
+    def merge(self, snapshot, running=True):
+        '''Adds a snapshot to these metrics. The gauges (requests in flight, the concurrency limit and the cached
+        entries) are only added if running, as they don't mean anything once a worker has stopped'''
+        with self.lock:
+            for route, method, status, counts, total, count in snapshot['requests']:
+                histogram = self.requests.get((route, method, status))
+                if histogram is None:
+                    histogram = self.requests[(route, method, status)] = Histogram()
+                histogram.merge(counts, total, count)
+            for route, count in snapshot['in_flight'].items():
+                self.in_flight[route] = self.in_flight.get(route, 0) + (count if running else 0)
+            for backend, method, counts, total, count, calls, documents, charge in snapshot['backend']:
+                stats = self.backend.get((backend, method))
+                if stats is None:
+                    stats = self.backend[(backend, method)] = BackendStats()
+                stats.latency.merge(counts, total, count)
+                stats.calls += calls
+                stats.documents += documents
+                stats.charge += charge
+            if 'cosmosdb' in snapshot:
+                if self.cosmosdb is None:
+                    self.cosmosdb = {'throttled': 0, 'retries': 0, 'shed': {'read': 0, 'write': 0}, 'limit': 0}
+                self.cosmosdb['throttled'] += snapshot['cosmosdb']['throttled']
+                self.cosmosdb['retries'] += snapshot['cosmosdb']['retries']
+                for kind, count in snapshot['cosmosdb']['shed'].items():
+                    self.cosmosdb['shed'][kind] = self.cosmosdb['shed'].get(kind, 0) + count
+                self.cosmosdb['limit'] += snapshot['cosmosdb']['limit'] if running else 0
+            if 'cache' in snapshot:
+                self.cache_stats['hits'] += snapshot['cache']['hits']
+                self.cache_stats['misses'] += snapshot['cache']['misses']
+                self.cache_stats['entries'] += snapshot['cache']['entries'] if running else 0
+
+
+    def render(self):
+        '''Renders metrics that have been merged from snapshots'''
+        with self.lock:
+            lines = ['# HELP servicecatalogue_http_request_duration_seconds Time taken to handle requests',
+                     '# TYPE servicecatalogue_http_request_duration_seconds histogram']
+            for (route, method, status), histogram in sorted(self.requests.items()):
+                labels = 'route="' + route + '",method="' + method + '",status="' + str(status) + '"'
+                lines.extend(histogram.render('servicecatalogue_http_request_duration_seconds', labels))
+
+            lines.extend(['# HELP servicecatalogue_http_requests_in_flight Requests currently being handled',
+                          '# TYPE servicecatalogue_http_requests_in_flight gauge'])
+            for route, count in sorted(self.in_flight.items()):
+                lines.append('servicecatalogue_http_requests_in_flight{route="' + route + '"} ' + str(count))
+
+            lines.extend(['# HELP servicecatalogue_backend_duration_seconds Time taken by each Processor method',
+                          '# TYPE servicecatalogue_backend_duration_seconds histogram'])
+            for (backend, method), stats in sorted(self.backend.items()):
+                lines.extend(stats.latency.render('servicecatalogue_backend_duration_seconds',
+                                                  'backend="' + backend + '",method="' + method + '"'))
+            for name, help_text, attribute in (
+                    ('servicecatalogue_backend_calls_total', 'Calls made to the backend by each Processor method', 'calls'),
+                    ('servicecatalogue_backend_documents_read_total', 'Documents read from the backend by each Processor method', 'documents'),
+                    ('servicecatalogue_backend_request_charge_total', 'Cosmos DB request units used by each Processor method', 'charge')):
+                lines.extend(['# HELP ' + name + ' ' + help_text, '# TYPE ' + name + ' counter'])
+                for (backend, method), stats in sorted(self.backend.items()):
+                    lines.append(name + '{backend="' + backend + '",method="' + method + '"} ' + str(getattr(stats, attribute)))
+
+            cosmosdb = self.cosmosdb
+            if cosmosdb is not None:
+                lines.extend(['# HELP servicecatalogue_cosmosdb_throttled_total Calls that Cosmos DB throttled with a 429',
+                              '# TYPE servicecatalogue_cosmosdb_throttled_total counter',
+                              'servicecatalogue_cosmosdb_throttled_total ' + str(cosmosdb['throttled']),
+                              '# HELP servicecatalogue_cosmosdb_retries_total Throttled calls that were retried',
+                              '# TYPE servicecatalogue_cosmosdb_retries_total counter',
+                              'servicecatalogue_cosmosdb_retries_total ' + str(cosmosdb['retries']),
+                              '# HELP servicecatalogue_cosmosdb_shed_total Calls given up on because they could not be made in time',
+                              '# TYPE servicecatalogue_cosmosdb_shed_total counter'])
+                for kind, count in sorted(cosmosdb['shed'].items()):
+                    lines.append('servicecatalogue_cosmosdb_shed_total{priority="' + kind + '"} ' + str(count))
+                lines.extend(['# HELP servicecatalogue_cosmosdb_concurrency_limit Calls to Cosmos DB that may be made at once by all of the workers',
+                              '# TYPE servicecatalogue_cosmosdb_concurrency_limit gauge',
+                              'servicecatalogue_cosmosdb_concurrency_limit ' + str(cosmosdb['limit'])])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def collect():
+    '''Returns the metrics of this worker added to those that the other workers have saved in METRICS_DIRECTORY
+    (see save), which are up to METRICS_SAVE_INTERVAL seconds old'''
+    total = Metrics()
+    total.merge(metrics.snapshot())
+    directory = config_cosmos.METRICS_DIRECTORY
+    if directory:
+        own = str(os.getpid()) + '.json'
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith('.json') and file_name != own:
+                snapshot = read_snapshot(os.path.join(directory, file_name))
+                if snapshot is not None:
+                    total.merge(snapshot, running=file_name != ARCHIVE)
+    return total
+
+
+def read_snapshot(path):
+    '''Returns a saved snapshot, or None if it has gone (its worker stopped) or can't be read'''
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(path, snapshot):
+    # written to a temporary file and moved into place so that another worker never reads half a file
+    temp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+    with open(temp_path, 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.replace(temp_path, path)
+
+
+def save():
+    '''Saves this worker's metrics to METRICS_DIRECTORY so that the other workers can add them to theirs'''
+    try:
+        write_snapshot(os.path.join(config_cosmos.METRICS_DIRECTORY, str(os.getpid()) + '.json'), metrics.snapshot())
+    except OSError as e:
+        print("unable to save the metrics: " + str(e))
+
+
+def start_saving():
+    '''Starts a thread that saves this worker's metrics every METRICS_SAVE_INTERVAL seconds. Called in each worker'''
+    def run():
+        while True:
+            time.sleep(config_cosmos.METRICS_SAVE_INTERVAL)
+            save()
+    save()
+    threading.Thread(target=run, name='metrics-saver', daemon=True).start()
+
+
+def worker_stopped(pid):
+    '''Adds the counters of a worker that has stopped to the ARCHIVE and removes its file, so that the totals don't
+    go down when workers are replaced. Called in the master, which is the only process that writes the ARCHIVE'''
+    path = os.path.join(config_cosmos.METRICS_DIRECTORY, str(pid) + '.json')
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        return
+    archive_path = os.path.join(config_cosmos.METRICS_DIRECTORY, ARCHIVE)
+    archive = Metrics()
+    archived = read_snapshot(archive_path)
+    if archived is not None:
+        archive.merge(archived, running=False)
+    archive.merge(snapshot, running=False)
+    archived = archive.snapshot()
+    if archive.cosmosdb is not None:
+        archived['cosmosdb'] = archive.cosmosdb
+    archived['cache'] = archive.cache_stats
+    write_snapshot(archive_path, archived)
+    os.remove(path)
+
+
+def add_to_account(calls=0, documents=0, charge=0.0):
+    '''Adds to the account of the Processor method that is running, if there is one'''
+    account = current_account.get()
+    if account is not None:
+        account.add(calls, documents, charge)
+
+
+def submit(executor, function, *args):
+    '''Runs function on the executor in a copy of the current context so that its backend calls are accounted to
+    the Processor method that submitted it'''
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def cosmos_response(response, *args, **kwargs):
+    '''requests response hook for the Cosmos DB client. Query and feed responses say how many documents they
+    hold and a successful point read is one document'''
+    item_count = response.headers.get('x-ms-item-count')
+    if item_count is not None:
+        documents = int(item_count)
+    else:
+        documents = 1 if response.request.method == 'GET' and response.status_code == 200 else 0
+    charge = float(response.headers.get('x-ms-request-charge', 0))
+    add_to_account(1, documents, charge)
+    classes.tracing.record('cosmosdb', response.request.method + ' ' + urllib.parse.unquote(urllib.parse.urlsplit(response.url).path),
+                           response.elapsed.total_seconds(), status=response.status_code, documents=documents, charge=charge)
+
+
+def sqlite_statement(statement):
+    '''sqlite3 trace callback that counts the statements run'''
+    add_to_account(calls=1)
+    classes.tracing.record('sqlite', statement[:200])
+
+
+def instrument(processor, backend):
+    '''Replaces the Processor's interface methods on the instance with versions that record their latency and
+    what they did in the backend. A method called from within another one is counted as part of the outer one'''
+    for name in PROCESSOR_METHODS:
+        method = getattr(processor, name)
+        if name.startswith('iter_'):
+            setattr(processor, name, instrument_iterator(method, backend, name))
+        else:
+            setattr(processor, name, instrument_method(method, backend, name))
+
+
+def instrument_method(method, backend, name):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if current_account.get() is not None:
+            if classes.tracing.current_trace.get() is None:
+                return method(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                classes.tracing.record('processor', name, time.perf_counter() - start, nested=True)
+        account = Account()
+        token = current_account.set(account)
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            metrics.observe_backend(backend, name, duration, account)
+            current_account.reset(token)
+            classes.tracing.record('processor', name, duration, nested=False, calls=account.calls,
+                                   documents=account.documents, charge=account.charge)
+    return wrapper
+
+
+def instrument_iterator(method, backend, name):
+    '''As instrument_method but for methods that return an iterator that does its backend calls as it is used.
+    Only the time spent getting each item is counted, not the time the caller spends between items'''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if current_account.get() is not None:
+            return method(*args, **kwargs)
+        return accounted_iterator(lambda: method(*args, **kwargs), backend, name)
+    return wrapper
+
+
+def accounted_iterator(create, backend, name):
+    account = Account()
+    elapsed = 0.0
+    iterator = None
+    try:
+        while True:
+            token = current_account.set(account)
+            start = time.perf_counter()
+            try:
+                if iterator is None:
+                    iterator = iter(create())   # creating it may already run the query
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - start
+                current_account.reset(token)
+            yield item
+    finally:
+        metrics.observe_backend(backend, name, elapsed, account)
+        classes.tracing.record('processor', name, elapsed, nested=False, calls=account.calls,
+                               documents=account.documents, charge=account.charge)
@@ -0,0 +1,19 @@
+import config_cosmos
+
+
+def create_processor():
+    '''Returns a Processor for the storage backend chosen by STORAGE_BACKEND in the config.
+    The backend modules are only imported when chosen so that e.g. SQLite can be used without pydocumentdb installed'''
+    if config_cosmos.STORAGE_BACKEND == 'cosmosdb':
+        import classes.cosmosdbprocessor
+        return classes.cosmosdbprocessor.Processor()
+    elif config_cosmos.STORAGE_BACKEND == 'sqlite':
+        import classes.sqliteprocessor
+        return classes.sqliteprocessor.Processor()
+    elif config_cosmos.STORAGE_BACKEND == 'memory':
+        import classes.memoryprocessor
+        import classes.seedloader
+        catalogue = classes.seedloader.read_seed(config_cosmos.MEMORY_SEED) if config_cosmos.MEMORY_SEED else None
+        return classes.memoryprocessor.Processor(catalogue)
+    else:
+        raise ValueError('Unknown STORAGE_BACKEND ' + str(config_cosmos.STORAGE_BACKEND))
@@ -0,0 +1,66 @@
+import collections
+import hashlib
+import threading
+import time
+
+
+class ResponseCache():
+    '''In-process cache of serialised listing responses, keyed per collection. Entries expire after ttl seconds,
+    only max_entries are kept (least recently used are dropped first) and every entry for a collection is
+    dropped when that collection is written to. Each entry carries a strong ETag of its body'''
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()     # (collection, key) -> entry dict
+        self.generations = collections.Counter()     # collection -> number of times it has been invalidated
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def get(self, collection, key):
+        '''Returns the cached entry or None. The entry is a dict with body, etag, headers and expires keys'''
+        with self.lock:
+            entry = self.entries.get((collection, key))
+            if entry is None or entry['expires'] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end((collection, key))
+            self.hits += 1
+            return entry
+
+
+    def generation(self, collection):
+        '''Returns the current generation of a collection. Read this before going to the backend and pass it to
+        put so that a response built from data that was changed in the meantime is not cached'''
+        with self.lock:
+            return self.generations[collection]
+
+
+    def put(self, collection, key, generation, body, headers=None):
+        '''Caches a response body and returns the entry'''
+        entry = {'body': body,
+                 'etag': hashlib.sha1(body).hexdigest(),
+                 'headers': headers or {},
+                 'expires': time.monotonic() + self.ttl}
+        with self.lock:
+            if generation == self.generations[collection]:
+                self.entries[(collection, key)] = entry
+                self.entries.move_to_end((collection, key))
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+
+    def invalidate(self, collection):
+        '''Drops every cached response for a collection'''
+        with self.lock:
+            self.generations[collection] += 1
+            for cache_key in [cache_key for cache_key in self.entries if cache_key[0] == collection]:
+                del self.entries[cache_key]
+
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
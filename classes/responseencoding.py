@@ -0,0 +1,36 @@
+import gzip
+import json
+import zlib
+import config_cosmos
+
+# orjson is optional. If it is installed and FAST_JSON is turned on it is used to serialise the listings
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    '''Serialises obj to JSON bytes. Keys are sorted to match the output of Flask's jsonify'''
+    if config_cosmos.FAST_JSON and orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def compress(body, encoding):
+    '''Compresses a whole response body'''
+    if encoding == 'gzip':
+        return gzip.compress(body, config_cosmos.COMPRESSION_LEVEL)
+    return zlib.compress(body, config_cosmos.COMPRESSION_LEVEL)
+
+
+def compress_stream(chunks, encoding):
+    '''Generator that compresses a streamed response as it goes. Output is only produced once zlib has
+    a block ready so the compression ratio is about the same as for a whole body'''
+    # wbits of 31 writes a gzip header and trailer, 15 writes the zlib format used by deflate
+    compressor = zlib.compressobj(config_cosmos.COMPRESSION_LEVEL, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+    for chunk in chunks:
+        data = compressor.compress(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
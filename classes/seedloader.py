@@ -0,0 +1,220 @@
+import concurrent.futures
+import json
+import random
+import time
+import config_cosmos
+from netaddr import IPNetwork
+from classes.ipallocator import SubnetBitmap, build_bitmap
+
+# A catalogue is a dict of subnets (list of subnet strings), vms and rules (lists of documents in the form the service
+# stores them). Loading one is idempotent: every document has a fixed id and is upserted, the id counters are only
+# ever moved forwards and addresses that are in use by VMs created since the last load are left alone
+
+
+def read_seed(path):
+    '''Reads a catalogue from a JSON seed file'''
+    with open(path) as seed_file:
+        seed = json.load(seed_file)
+    return {'subnets': seed.get('subnets', []), 'vms': seed.get('vms', []), 'rules': seed.get('rules', [])}
+
+
+def generate_catalogue(vm_count, subnet_count, prefix, rule_count, seed=0):
+    '''Generates a catalogue of subnet_count subnets of the given prefix length, vm_count VMs with addresses in them
+    (every fifth VM has a second address in another subnet) and rule_count firewall rules followed by a default deny'''
+    rng = random.Random(seed)
+    subnets = [str(IPNetwork('10.0.0.0/' + str(prefix)).next(index)) for index in range(subnet_count)]
+    free = {subnet: iter(IPNetwork(subnet).iter_hosts()) for subnet in subnets}
+
+    vms = list()
+    for number in range(1, vm_count + 1):
+        vm_subnets = [subnets[number % subnet_count]]
+        if number % 5 == 0 and subnet_count > 1:
+            vm_subnets.append(subnets[(number + 1) % subnet_count])
+        vms.append({'id': 'vm-' + str(number),
+                    'name': 'vm' + str(number),
+                    'ip': [str(next(free[subnet])) for subnet in vm_subnets],
+                    'state': rng.choice(('on', 'off'))})
+
+    rules = list()
+    for number in range(1, rule_count + 1):
+        source = str(next(IPNetwork(rng.choice(subnets)).subnet(rng.randint(prefix, 28))))
+        if rng.random() < 0.5:
+            destination = rng.choice(vms)['id'] if vms else '0.0.0.0/0'
+        else:
+            destination = rng.choice(rng.choice(vms)['ip']) if vms else '0.0.0.0/0'
+        rules.append({'id': 'fw-' + str(number), 'name': 'rule ' + str(number), 'from': source, 'to': destination,
+                      'action': rng.choice(('allow', 'deny'))})
+    rules.append({'id': 'fw-' + str(rule_count + 1), 'name': 'default rule', 'from': '0.0.0.0/0', 'to': '0.0.0.0/0',
+                  'action': 'deny'})
+    return {'subnets': subnets, 'vms': vms, 'rules': rules}
+
+
+def next_id(documents):
+    '''Returns the number after the highest numbered id, e.g. 5 if the highest is vm-4'''
+    return max([int(document['id'].split('-')[1]) for document in documents] + [0]) + 1
+
+
+def owners(catalogue):
+    '''Returns a dict of IP address -> vmid for every address used by a VM in the catalogue'''
+    return {ipaddress: vm['id'] for vm in catalogue['vms'] for ipaddress in vm['ip']}
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def load_sqlite(catalogue, database=None):
+    '''Loads a catalogue into the SQLite database, creating it if needed'''
+    import classes.sqliteprocessor
+    processor = classes.sqliteprocessor.Processor(database)
+    seed_owners = owners(catalogue)
+    for subnet in catalogue['subnets']:
+        processor.add_subnet(subnet, [str(ipaddress) for ipaddress in IPNetwork(subnet).iter_hosts()])
+
+    with processor.transaction() as db:
+        db.executemany('INSERT OR REPLACE INTO virtualmachines (id, name, ip, state) VALUES (?, ?, ?, ?)',
+                       [(vm['id'], vm['name'], json.dumps(vm['ip']), vm['state']) for vm in catalogue['vms']])
+        db.executemany('UPDATE ipaddresses SET usedby = ? WHERE id = ?',
+                       [(vmid, ipaddress) for ipaddress, vmid in seed_owners.items()])
+        db.executemany('INSERT OR REPLACE INTO firewallrules (id, name, "from", "to", action) VALUES (?, ?, ?, ?, ?)',
+                       [(rule['id'], rule['name'], rule['from'], rule['to'], rule['action']) for rule in catalogue['rules']])
+
+        # clients syncing with ?since= are sent the loaded documents as changes
+        now = time.time()
+        db.executemany('INSERT OR REPLACE INTO changes (collection, id, deleted, time) VALUES (?, ?, 0, ?)',
+                       [('virtualmachines', vm['id'], now) for vm in catalogue['vms']] +
+                       [('firewallrules', rule['id'], now) for rule in catalogue['rules']])
+
+        # vmids and fwids are not reused so the counters only move forwards
+        db.execute("UPDATE counters SET next = MAX(next, ?) WHERE id = 'vmid'", (next_id(catalogue['vms']),))
+        db.execute("UPDATE counters SET next = MAX(next, ?) WHERE id = 'fwid'", (next_id(catalogue['rules']),))
+
+        # Start from what is already in use so that VMs created since the last load keep their addresses (a new
+        # subnet's bitmap is built from the ipaddresses table), and save the bitmaps so they aren't built again
+        for subnet in catalogue['subnets']:
+            bitmap = processor.load_bitmap(db, subnet)
+            bitmap.reserve([bitmap.offset(ipaddress) for ipaddress in seed_owners if ipaddress in bitmap])
+            processor.save_bitmap(db, bitmap)
+
+
+class CosmosDBLoader():
+    '''Loads a catalogue into Cosmos DB, creating the database and collections if they don't exist.
+
+    Documents are written in batches of COSMOSDB_SEED_BATCH_SIZE, COSMOSDB_CONCURRENCY batches at a time. A batch of
+    documents in the same partition is written with a single call to the bulkWrite stored procedure, otherwise each
+    document is upserted on its own. A subnet document is only written (with its bitmap and seeded set) once all of
+    its IP address documents are, so if a load is interrupted then running it again carries on from the subnets
+    that were not finished'''
+
+    def __init__(self):
+        import pydocumentdb.errors
+        import classes.cosmosdbprocessor
+        self.errors = pydocumentdb.errors
+        self.client = classes.cosmosdbprocessor.get_client()
+        self.create_collections()
+        self.processor = classes.cosmosdbprocessor.Processor()
+        self.executor = concurrent.futures.ThreadPoolExecutor(config_cosmos.COSMOSDB_CONCURRENCY)
+
+
+    def create_collections(self):
+        '''Creates the database and collections (see classes.cosmosdbprocessor.collection_definition)'''
+        import classes.cosmosdbprocessor
+        db_link = 'dbs/' + config_cosmos.COSMOSDB_DATABASE
+        self.create_if_missing(lambda: self.client.CreateDatabase({'id': config_cosmos.COSMOSDB_DATABASE}))
+        for collection_name in (config_cosmos.COSMOSDB_COLLECTION_VM, config_cosmos.COSMOSDB_COLLECTION_VMID,
+                                config_cosmos.COSMOSDB_COLLECTION_IP, config_cosmos.COSMOSDB_COLLECTION_FW,
+                                config_cosmos.COSMOSDB_COLLECTION_FWID, config_cosmos.COSMOSDB_COLLECTION_SUBNET,
+                                config_cosmos.COSMOSDB_COLLECTION_TOMBSTONE, config_cosmos.COSMOSDB_COLLECTION_JOB):
+            definition = classes.cosmosdbprocessor.collection_definition(collection_name)
+            self.create_if_missing(lambda: self.client.CreateCollection(db_link, definition))
+
+
+    def create_if_missing(self, create):
+        try:
+            create()
+        except self.errors.HTTPFailure as e:
+            if e.status_code != 409:   # 409 Conflict means it already exists
+                raise
+
+
+    def partition_value(self, collection_name, document):
+        '''Returns the value of the document's partition key, or None if the collection isn't partitioned'''
+        if not config_cosmos.COSMOSDB_PARTITIONED or collection_name not in config_cosmos.COSMOSDB_PARTITION_KEYS:
+            return None
+        return document[config_cosmos.COSMOSDB_PARTITION_KEYS[collection_name].lstrip('/')]
+
+
+    def write_all(self, collection_name, documents):
+        '''Upserts the documents in batches of documents from the same partition, running the batches at the same time'''
+        groups = dict()
+        for document in documents:
+            groups.setdefault(self.partition_value(collection_name, document), []).append(document)
+
+        futures = list()
+        for key, group in groups.items():
+            for batch in chunks(group, config_cosmos.COSMOSDB_SEED_BATCH_SIZE):
+                futures.append(self.executor.submit(self.write_partition_batch, collection_name, key, batch))
+        for future in futures:
+            future.result()   # raises the first error, if any
+
+
+    def write_partition_batch(self, collection_name, partition_key, documents):
+        options = self.processor.partition_options(collection_name, partition_key)
+        if config_cosmos.COSMOSDB_USE_STORED_PROCEDURES and len(documents) > 1:
+            from classes.unitofwork import UnitOfWork
+            operations = [{'kind': 'upsert', 'document': document} for document in documents]
+            UnitOfWork(self.processor).write_transaction(collection_name, options.get('partitionKey'), operations)
+        else:
+            for document in documents:
+                self.client.UpsertDocument(self.processor.collection_link(collection_name), document, options)
+
+
+    def load_subnet(self, subnet, seed_owners):
+        '''Writes the IP address documents of a subnet and then its document with the bitmap'''
+        existing = list(self.processor.query_documents(self.processor.collection_subnet, 'c.subnet = @subnet', {'@subnet': subnet}))
+        document = existing[0] if existing else {'id': 'subnet-' + subnet.replace('/', '-'), 'subnet': subnet}
+
+        # Start from what is already in use so that VMs created since the last load keep their addresses
+        bitmap = SubnetBitmap.from_document(document)
+        if bitmap is None:
+            used = [doc['id'] for doc in self.processor.query_documents(
+                self.processor.collection_ip, 'c.subnet = @subnet AND c.usedby != ""', {'@subnet': subnet}, subnet)]
+            bitmap = build_bitmap(subnet, used)
+
+        ip_documents = list()
+        for offset in range(bitmap.size):
+            ipaddress = bitmap.address(offset)
+            if ipaddress in seed_owners:
+                ip_documents.append({'id': ipaddress, 'subnet': subnet, 'usedby': seed_owners[ipaddress]})
+                bitmap.reserve([offset])
+            elif not bitmap.is_used(offset) and not document.get('seeded'):
+                # free addresses only need writing the first time the subnet is loaded
+                ip_documents.append({'id': ipaddress, 'subnet': subnet, 'usedby': ""})
+        self.write_all(config_cosmos.COSMOSDB_COLLECTION_IP, ip_documents)
+
+        bitmap.to_document(document)
+        document['seeded'] = True
+        self.client.UpsertDocument(self.processor.collection_link(config_cosmos.COSMOSDB_COLLECTION_SUBNET), document)
+
+
+    def move_counter(self, collection_name, key, prefix, next_number):
+        '''Moves the counter document on to next_number unless it is already past it'''
+        collection_link = self.processor.collection_link(collection_name)
+        document = next(iter(self.client.ReadDocuments(collection_link)), None)
+        if document is None:
+            self.client.CreateDocument(collection_link, {key: prefix + str(next_number)})
+        elif int(document[key][len(prefix):]) < next_number:
+            document[key] = prefix + str(next_number)
+            self.client.ReplaceDocument(document['_self'], document)
+
+
+    def load(self, catalogue):
+        seed_owners = owners(catalogue)
+        for subnet in catalogue['subnets']:
+            network = IPNetwork(subnet)
+            self.load_subnet(subnet, {ipaddress: vmid for ipaddress, vmid in seed_owners.items() if ipaddress in network})
+        self.write_all(config_cosmos.COSMOSDB_COLLECTION_VM, catalogue['vms'])
+        self.write_all(config_cosmos.COSMOSDB_COLLECTION_FW, catalogue['rules'])
+        self.move_counter(config_cosmos.COSMOSDB_COLLECTION_VMID, 'nextvmid', 'vm-', next_id(catalogue['vms']))
+        self.move_counter(config_cosmos.COSMOSDB_COLLECTION_FWID, 'nextfwid', 'fw-', next_id(catalogue['rules']))
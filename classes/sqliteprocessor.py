@@ -0,0 +1,393 @@
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+import config_cosmos
+import classes.metrics
+from classes.baseprocessor import BaseProcessor, SyncTokenExpired, encode_cursor, decode_cursor, VM_FIELDS, RULE_FIELDS
+from classes.idallocator import IDBlockAllocator
+from classes.ipallocator import IPAllocator, SubnetBitmap, build_bitmap, distribute, reconcile
+from collections import Counter
+
+# The tables mirror the Cosmos DB collections. The VM ip list is held as a JSON array
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS virtualmachines (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    ip TEXT NOT NULL,
+    state TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS ipaddresses (
+    id TEXT PRIMARY KEY,
+    subnet TEXT NOT NULL,
+    usedby TEXT NOT NULL DEFAULT '');
+CREATE INDEX IF NOT EXISTS ipaddresses_usedby ON ipaddresses (usedby);
+CREATE INDEX IF NOT EXISTS ipaddresses_subnet ON ipaddresses (subnet);
+CREATE TABLE IF NOT EXISTS subnets (
+    subnet TEXT PRIMARY KEY,
+    bitmap TEXT,
+    used INTEGER NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS firewallrules (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    "from" TEXT NOT NULL,
+    "to" TEXT NOT NULL,
+    action TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS counters (
+    id TEXT PRIMARY KEY,
+    next INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters (id, next) VALUES ('vmid', 1), ('fwid', 1), ('pruned', 0);
+CREATE TABLE IF NOT EXISTS changes (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    time REAL NOT NULL,
+    UNIQUE (collection, id));
+CREATE INDEX IF NOT EXISTS changes_deleted ON changes (deleted, time);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    document TEXT NOT NULL,
+    created REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created);
+'''
+
+# changes holds the latest change to each VM and rule, so a write replaces the row with one at a new position.
+# Deleted documents are kept there as tombstones for SYNC_RETENTION seconds and the counter 'pruned' holds the
+# position of the newest tombstone that has been removed; syncing from before it would miss that deletion
+RECORD_CHANGE = 'INSERT OR REPLACE INTO changes (collection, id, deleted, time) VALUES (?, ?, ?, ?)'
+
+
+class Processor(BaseProcessor):
+    '''Creates an object to perform all of the interactions with a local SQLite database'''
+
+    def __init__(self, database=None):
+        BaseProcessor.__init__(self)
+        self.database = database or config_cosmos.SQLITE_DATABASE
+        self.local = threading.local()    # each thread gets its own connection
+        db = self.connection()
+        db.execute('PRAGMA journal_mode=WAL')   # lets readers carry on while a write is in progress
+        db.executescript(SCHEMA)
+
+        # vmids and fwids are handed out from blocks leased from the counters table
+        self.vmids = IDBlockAllocator(lambda size: self.lease_ids('vmid', size), config_cosmos.ID_BLOCK_SIZE)
+        self.fwids = IDBlockAllocator(lambda size: self.lease_ids('fwid', size), config_cosmos.ID_BLOCK_SIZE)
+
+        # subnet -> ((bitmap, used), capacity) of the bitmap last reported on by get_subnets, so that a subnet's largest
+        # free block is only worked out again once its bitmap has changed
+        self.capacities = dict()
+
+
+    def connection(self):
+        '''Returns the connection for the current thread, opening it if needed'''
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            # isolation_level=None stops the sqlite3 module from opening transactions itself
+            db = sqlite3.connect(self.database, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.set_trace_callback(classes.metrics.sqlite_statement)   # counts the statements run for /metrics
+            self.local.db = db
+        return db
+
+
+    def before_fork(self):
+        '''SQLite connections must not be carried across a fork, so the master closes its own'''
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+        self.local = threading.local()
+
+
+    def after_fork(self):
+        self.local = threading.local()
+        self.vmids.discard()
+        self.fwids.discard()
+
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''Runs the block in a write transaction. BEGIN IMMEDIATE takes the write lock up front so that
+        concurrent processes queue rather than fail part way through'''
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+
+    def lease_ids(self, counter, block_size):
+        '''Reserves a block of IDs by moving the counter on by block_size. Returns the first ID in the block'''
+        with self.transaction() as db:
+            first_id = db.execute('SELECT next FROM counters WHERE id = ?', (counter,)).fetchone()['next']
+            db.execute('UPDATE counters SET next = next + ? WHERE id = ?', (block_size, counter))
+        return first_id
+
+
+    def add_subnet(self, subnet, addresses):
+        '''Adds a subnet and its list of usable IP addresses'''
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO subnets (subnet) VALUES (?)', (subnet,))
+            db.executemany("INSERT OR IGNORE INTO ipaddresses (id, subnet, usedby) VALUES (?, ?, '')",
+                           [(ipaddress, subnet) for ipaddress in addresses])
+
+
+    def load_bitmap(self, db, subnet):
+        '''Reads the bitmap for a subnet, building it from the ipaddresses table if it has not been created yet.
+        Returns None if the subnet does not exist'''
+        row = db.execute('SELECT subnet, bitmap, used FROM subnets WHERE subnet = ?', (subnet,)).fetchone()
+        if row is None:
+            return None
+        return self.row_bitmap(db, row)
+
+
+    def row_bitmap(self, db, row):
+        if row['bitmap'] is None:
+            used_addresses = [r['id'] for r in db.execute("SELECT id FROM ipaddresses WHERE subnet = ? AND usedby != ''", (row['subnet'],))]
+            return build_bitmap(row['subnet'], used_addresses)
+        return SubnetBitmap(row['subnet'], row['bitmap'], row['used'])
+
+
+    def save_bitmap(self, db, bitmap):
+        document = bitmap.to_document({})
+        db.execute('UPDATE subnets SET bitmap = ?, used = ? WHERE subnet = ?', (document['bitmap'], document['used'], bitmap.subnet))
+
+
+    def row_document(self, row):
+        '''Turns a row into the same document the Cosmos DB backend would return'''
+        classes.metrics.add_to_account(documents=1)
+        document = {key: row[key] for key in row.keys() if key != 'rowid'}
+        if 'ip' in document:
+            document['ip'] = json.loads(document['ip'])
+        return document
+
+
+    def columns(self, fields):
+        # quoted as "from" and "to" are SQL keywords. The fields are only ever the fixed names from VM_FIELDS/RULE_FIELDS
+        return ', '.join('"' + field + '"' for field in fields)
+
+
+    def get_all_vms(self):
+        '''Returns all VMs from the table'''
+        return [self.row_document(row) for row in self.connection().execute('SELECT * FROM virtualmachines')]
+
+
+    def query_page(self, table, limit, cursor, fields):
+        '''Returns a page of rows in insertion order. The cursor holds the rowid of the last row returned'''
+        after = 0 if cursor is None else int(decode_cursor(cursor))
+        rows = self.connection().execute('SELECT rowid, ' + self.columns(fields) + ' FROM ' + table +
+                                         ' WHERE rowid > ? ORDER BY rowid LIMIT ?', (after, limit)).fetchall()
+        if len(rows) < limit:
+            return [self.row_document(row) for row in rows], None
+        return [self.row_document(row) for row in rows], encode_cursor(rows[-1]['rowid'])
+
+
+    def get_vms_page(self, limit, cursor=None, fields=VM_FIELDS):
+        '''Returns a page of VMs from the table'''
+        return self.query_page('virtualmachines', limit, cursor, fields)
+
+
+    def iter_vms(self, fields=VM_FIELDS):
+        '''Returns all VMs from the table, reading the rows as they are used'''
+        return (self.row_document(row) for row in self.connection().execute('SELECT ' + self.columns(fields) + ' FROM virtualmachines'))
+
+
+    def add_vm(self, name, subnets):
+        '''Adds a new row to the virtualmachines table'''
+        return self.add_vms([(name, subnets)])[0]
+
+
+    def add_vms(self, specs):
+        '''Adds many new rows to the virtualmachines table in a single transaction'''
+        demand = Counter(subnet for name, subnets in specs for subnet in subnets)
+
+        # The vmids are taken before the transaction starts as leasing a new block needs its own transaction.
+        # The vmids of any VMs that cannot be created are simply never used
+        vmids = iter(self.vmids.next_ids(len(specs)))
+
+        with self.transaction() as db:
+            # Reserve as many of the addresses needed from each subnet as are free. Subnets that are not
+            # in the database are left out so the VMs that asked for them fail
+            bitmaps = dict()
+            reserved = dict()
+            for subnet, count in demand.items():
+                bitmap = self.load_bitmap(db, subnet)
+                if bitmap is not None:
+                    bitmaps[subnet] = bitmap
+                    reserved[subnet] = bitmap.allocate(min(count, bitmap.free()))
+            allocations, unused = distribute(specs, reserved)
+            for bitmap in bitmaps.values():
+                bitmap.release([bitmap.offset(ipaddress) for ipaddress in unused if ipaddress in bitmap])
+
+            results = list()
+            new_vms = list()
+            ip_rows = list()
+            for (name, subnets), ipaddresses in zip(specs, allocations):
+                vmid = "vm-" + str(next(vmids))
+                if ipaddresses is None:
+                    results.append(False)
+                    continue
+                new_vms.append({'id': vmid, 'name': name, 'ip': ipaddresses, 'state': "off"})
+                ip_rows.extend((ipaddress, subnet, vmid) for subnet, ipaddress in zip(subnets, ipaddresses))
+                results.append(vmid)
+
+            for bitmap in bitmaps.values():
+                self.save_bitmap(db, bitmap)
+            db.executemany('INSERT OR REPLACE INTO ipaddresses (id, subnet, usedby) VALUES (?, ?, ?)', ip_rows)
+            db.executemany('INSERT INTO virtualmachines (id, name, ip, state) VALUES (?, ?, ?, ?)',
+                           [(vm['id'], vm['name'], json.dumps(vm['ip']), vm['state']) for vm in new_vms])
+            db.executemany(RECORD_CHANGE, [('virtualmachines', vm['id'], 0, time.time()) for vm in new_vms])
+
+        for vm in new_vms:
+            self.notify(config_cosmos.COSMOSDB_COLLECTION_VM, 'created', vm)
+        return results
+
+
+    def delete_vm(self, vm_id):
+        '''Deletes a VM from the database'''
+        with self.transaction() as db:
+            vm_row = db.execute('SELECT * FROM virtualmachines WHERE id = ?', (vm_id,)).fetchone()
+            if vm_row is None:
+                return False
+
+            # Free up any IP addresses it holds
+            held = dict()
+            for row in db.execute('SELECT id, subnet FROM ipaddresses WHERE usedby = ?', (vm_id,)):
+                held.setdefault(row['subnet'], []).append(row['id'])
+            for subnet, ipaddresses in held.items():
+                bitmap = self.load_bitmap(db, subnet)
+                if bitmap is not None:
+                    bitmap.release([bitmap.offset(ipaddress) for ipaddress in ipaddresses])
+                    self.save_bitmap(db, bitmap)
+            db.execute("UPDATE ipaddresses SET usedby = '' WHERE usedby = ?", (vm_id,))
+
+            db.execute('DELETE FROM virtualmachines WHERE id = ?', (vm_id,))
+            db.execute(RECORD_CHANGE, ('virtualmachines', vm_id, 1, time.time()))
+            self.prune_tombstones(db)
+        self.notify(config_cosmos.COSMOSDB_COLLECTION_VM, 'deleted', self.row_document(vm_row))
+        return True
+
+
+    def restart_vm(self, vm_id):
+        '''Restart a VM'''
+        row = self.connection().execute('SELECT state FROM virtualmachines WHERE id = ?', (vm_id,)).fetchone()
+        if row is None:
+            return 'notfound'
+        elif row['state'] == "on":
+            return 'success'
+        else:
+            return 'off'
+
+
+    def get_all_rules(self):
+        '''Retrieve all of the firewall rules'''
+        return [self.row_document(row) for row in self.connection().execute('SELECT * FROM firewallrules')]
+
+
+    def get_rules_page(self, limit, cursor=None, fields=RULE_FIELDS):
+        '''Returns a page of firewall rules from the table'''
+        return self.query_page('firewallrules', limit, cursor, fields)
+
+
+    def iter_rules(self, fields=RULE_FIELDS):
+        '''Returns all firewall rules from the table, reading the rows as they are used'''
+        return (self.row_document(row) for row in self.connection().execute('SELECT ' + self.columns(fields) + ' FROM firewallrules'))
+
+
+    def add_rule(self, name, destination, target, action):
+        '''Adds a new row to the firewallrules table'''
+        fwid = "fw-" + str(self.fwids.next_id())
+        with self.transaction() as db:
+            db.execute('INSERT INTO firewallrules (id, name, "from", "to", action) VALUES (?, ?, ?, ?, ?)',
+                       (fwid, name, destination, target, action))
+            db.execute(RECORD_CHANGE, ('firewallrules', fwid, 0, time.time()))
+        self.notify(config_cosmos.COSMOSDB_COLLECTION_FW, 'created',
+                    {'id': fwid, 'name': name, 'from': destination, 'to': target, 'action': action})
+        return fwid
+
+
+    def get_subnets(self):
+        db = self.connection()
+        capacities = list()
+        for row in db.execute('SELECT subnet, bitmap, used FROM subnets ORDER BY subnet'):
+            cached = self.capacities.get(row['subnet'])
+            if cached is None or row['bitmap'] is None or cached[0] != (row['bitmap'], row['used']):
+                cached = self.capacities[row['subnet']] = ((row['bitmap'], row['used']), self.row_bitmap(db, row).capacity())
+            capacities.append(cached[1])
+        return capacities
+
+
+    def reconcile_subnets(self, confirmed=()):
+        with self.transaction() as db:
+            allocator = IPAllocator()
+            for row in db.execute('SELECT subnet, bitmap, used FROM subnets ORDER BY subnet').fetchall():
+                allocator.subnets[row['subnet']] = self.row_bitmap(db, row)
+            held = allocator.group_by_subnet(ipaddress for row in db.execute('SELECT ip FROM virtualmachines')
+                                             for ipaddress in json.loads(row['ip']))
+            reports = list()
+            for subnet, bitmap in allocator.subnets.items():
+                reports.append(reconcile(bitmap, held.get(subnet, ()), confirmed))
+                if reports[-1]['repaired']:
+                    self.save_bitmap(db, bitmap)
+        return reports
+
+
+    def prune_tombstones(self, db):
+        '''Removes the tombstones older than SYNC_RETENTION'''
+        cutoff = time.time() - config_cosmos.SYNC_RETENTION
+        newest = db.execute('SELECT MAX(position) AS position FROM changes WHERE deleted = 1 AND time < ?', (cutoff,)).fetchone()
+        if newest['position'] is not None:
+            db.execute("UPDATE counters SET next = MAX(next, ?) WHERE id = 'pruned'", (newest['position'],))
+            db.execute('DELETE FROM changes WHERE deleted = 1 AND time < ?', (cutoff,))
+
+
+    def sync_token(self):
+        # the newest changes may be tombstones that have been pruned, and a token from before them would have expired
+        return self.connection().execute("SELECT MAX((SELECT COALESCE(MAX(position), 0) FROM changes), "
+                                         "(SELECT next FROM counters WHERE id = 'pruned')) AS position").fetchone()['position']
+
+
+    def query_changes(self, table, since, fields):
+        '''Returns the changes to the table after the position since. The documents are read in the same statement
+        so that they are the versions the positions refer to'''
+        db = self.connection()
+        if since < db.execute("SELECT next FROM counters WHERE id = 'pruned'").fetchone()['next']:
+            raise SyncTokenExpired('Deletions since ' + str(since) + ' are no longer known')
+        rows = db.execute('SELECT changes.position, changes.id AS change_id, changes.deleted, ' +
+                          ', '.join('t."' + field + '"' for field in fields) + ' FROM changes LEFT JOIN ' + table +
+                          ' AS t ON t.id = changes.id WHERE changes.collection = ? AND changes.position > ? '
+                          'ORDER BY changes.position', (table, since))
+        changes = list()
+        for row in rows:
+            if row['deleted']:
+                classes.metrics.add_to_account(documents=1)
+                changes.append((row['position'], {'id': row['change_id'], 'deleted': True}))
+            else:
+                document = self.row_document(row)
+                for key in ('position', 'change_id', 'deleted'):
+                    del document[key]
+                changes.append((row['position'], document))
+        return changes
+
+
+    def get_vm_changes(self, since, fields=VM_FIELDS):
+        return self.query_changes('virtualmachines', since, fields)
+
+
+    def get_rule_changes(self, since, fields=RULE_FIELDS):
+        return self.query_changes('firewallrules', since, fields)
+
+
+    def save_job(self, job):
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO jobs (id, document, created) VALUES (?, ?, ?)', (job['id'], json.dumps(job), job['created']))
+            if job['status'] == 'queued':
+                db.execute('DELETE FROM jobs WHERE created < ?', (time.time() - config_cosmos.JOB_RETENTION,))
+
+
+    def get_job(self, job_id):
+        row = self.connection().execute('SELECT document FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row['document']) if row is not None else None
@@ -0,0 +1,59 @@
+import datetime
+import io
+import json
+import threading
+import time
+import requests
+import requests.adapters
+
+DEFAULT_CHARGE = 1.0    # request units taken for a response that doesn't say what it cost
+
+
+class ThrottlingTransport(requests.adapters.BaseAdapter):
+    '''For testing: a requests transport adapter that behaves like a Cosmos DB account provisioned with throughput
+    RU/s. Calls are passed on to transport (e.g. the Cosmos DB Emulator, or any stand-in adapter) while the account
+    has request units left, and answered with 429 and an x-ms-retry-after-ms header when it doesn't, as Cosmos DB
+    does. Set COSMOSDB_SIMULATED_THROUGHPUT to put it under the governor'''
+
+    def __init__(self, transport, throughput):
+        requests.adapters.BaseAdapter.__init__(self)
+        self.transport = transport
+        self.throughput = throughput
+        self.tokens = float(throughput)
+        self.refilled = time.monotonic()
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.throughput, self.tokens + (now - self.refilled) * self.throughput)
+            self.refilled = now
+            if self.tokens <= 0:
+                self.throttled += 1
+                return self.throttled_response(request, (-self.tokens + 1) / self.throughput)
+        response = self.transport.send(request, **kwargs)
+        with self.lock:
+            self.tokens -= float(response.headers.get('x-ms-request-charge', DEFAULT_CHARGE))
+        return response
+
+
+    def throttled_response(self, request, retry_after):
+        response = requests.Response()
+        response.status_code = 429
+        response.reason = 'Too Many Requests'
+        response.headers['Content-Type'] = 'application/json'
+        response.headers['x-ms-retry-after-ms'] = str(int(retry_after * 1000) + 1)
+        response.headers['x-ms-request-charge'] = '0'
+        response._content = json.dumps({'code': 'TooManyRequests', 'message': 'Request rate is large'}).encode('utf-8')
+        response.raw = io.BytesIO(response._content)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+
+    def close(self):
+        self.transport.close()
@@ -0,0 +1,110 @@
+import collections
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+import config_cosmos
+
+# The Trace of the request being handled, or None if it isn't being traced. Checking this is all that tracing costs
+# when it is turned off
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+log_lock = threading.Lock()
+
+
+class Trace():
+    '''Records what one request did: each Processor method it called and each call those made to the backend,
+    with their timings. Optionally also profiles the request with cProfile'''
+
+    def __init__(self, method, path, profile=False):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.events = list()
+        self.lock = threading.Lock()    # backend calls can be recorded from the processor's thread pool
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+
+    def add(self, kind, name, duration=None, **details):
+        '''Records an event. kind is 'processor' for a Processor method or the backend for a backend call.
+        at_ms is when it was recorded, which for events with a duration is when they finished'''
+        event = {'kind': kind, 'name': name, 'at_ms': round((time.perf_counter() - self.start) * 1000, 3)}
+        if duration is not None:
+            event['duration_ms'] = round(duration * 1000, 3)
+        event.update(details)
+        with self.lock:
+            self.events.append(event)
+
+
+    def finish(self, status):
+        '''Stops profiling and returns the trace as a document'''
+        duration = time.perf_counter() - self.start
+        document = {'id': self.id,
+                    'time': self.started,
+                    'method': self.method,
+                    'path': self.path,
+                    'status': status,
+                    'duration_ms': round(duration * 1000, 3),
+                    'backend_ms': round(self.backend_time() * 1000, 3),
+                    'events': self.events}
+        if self.profiler is not None:
+            self.profiler.disable()
+            summary = io.StringIO()
+            pstats.Stats(self.profiler, stream=summary).sort_stats('cumulative').print_stats(config_cosmos.TRACE_PROFILE_LINES)
+            document['profile'] = summary.getvalue()
+        return document
+
+
+    def backend_time(self):
+        '''Total time spent in the top level Processor methods'''
+        return sum(event['duration_ms'] for event in self.events
+                   if event['kind'] == 'processor' and not event['nested']) / 1000
+
+
+def record(kind, name, duration=None, **details):
+    '''Adds an event to the current trace, if there is one'''
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(kind, name, duration, **details)
+
+
+def write(document):
+    '''Appends a finished trace to the trace log as one line of JSON. A log that would go over TRACE_LOG_MAX_BYTES is
+    first moved to TRACE_LOG + '.1', replacing the one that was there, so the two never hold more than twice that'''
+    line = json.dumps(document) + '\n'
+    with log_lock:
+        try:
+            if os.path.getsize(config_cosmos.TRACE_LOG) + len(line.encode('utf-8')) > config_cosmos.TRACE_LOG_MAX_BYTES:
+                os.replace(config_cosmos.TRACE_LOG, config_cosmos.TRACE_LOG + '.1')
+        except FileNotFoundError:
+            pass
+        with open(config_cosmos.TRACE_LOG, 'a') as log_file:
+            log_file.write(line)
+
+
+def query(limit=20, min_ms=0, path=None):
+    '''Returns the most recent traces from the trace logs that took at least min_ms and whose path starts with path'''
+    matches = collections.deque(maxlen=limit)
+    for log_path in (config_cosmos.TRACE_LOG + '.1', config_cosmos.TRACE_LOG):
+        try:
+            with open(log_path) as log_file:
+                for line in log_file:
+                    try:
+                        document = json.loads(line)
+                    except ValueError:
+                        continue   # another worker is part way through writing it
+                    if document['duration_ms'] >= min_ms and (path is None or document['path'].startswith(path)):
+                        matches.append(document)
+        except FileNotFoundError:
+            pass
+    return list(reversed(matches))
@@ -0,0 +1,147 @@
+import collections
+import classes.metrics
+import config_cosmos
+import pydocumentdb.errors as errors
+
+BULK_WRITE_SPROC = 'bulkWrite'
+
+# Stored procedure that makes a list of writes to one collection (and one partition) as a single transaction.
+# Throwing at any point rolls back everything it has written
+BULK_WRITE_JS = '''
+function bulkWrite(operations) {
+    var collection = getContext().getCollection();
+    var index = 0;
+    writeNext();
+
+    function writeNext() {
+        if (index >= operations.length) {
+            getContext().getResponse().setBody(index);
+            return;
+        }
+        var operation = operations[index];
+        var accepted;
+        if (operation.kind === 'create') {
+            accepted = collection.createDocument(collection.getSelfLink(), operation.document, written);
+        } else if (operation.kind === 'upsert') {
+            accepted = collection.upsertDocument(collection.getSelfLink(), operation.document, written);
+        } else {
+            accepted = collection.deleteDocument(collection.getAltLink() + '/docs/' + operation.document.id, written);
+        }
+        // not accepted means the procedure has run out of time
+        if (!accepted) throw new Error('bulkWrite was not able to finish within its time limit');
+    }
+
+    function written(err) {
+        if (err) throw err;
+        index++;
+        writeNext();
+    }
+}
+'''
+
+
+class UnitOfWork():
+    '''Collects the document writes that make up one change (e.g. creating a VM) so that they are committed together.
+
+    Writes to the same collection and partition are made with one call to the bulkWrite stored procedure, which
+    Cosmos DB runs as a transaction. A transaction cannot span collections so if a later group fails then the groups
+    already written are undone (compensated). With COSMOSDB_USE_STORED_PROCEDURES turned off the writes in each group
+    are made in parallel instead and undone in the same way if any of them fail'''
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.groups = collections.OrderedDict()    # (collection name, partition key) -> list of operations
+
+
+    def add(self, kind, collection_name, document, partition_key, previous):
+        # unpartitioned collections go in one group whatever partition key was passed
+        partition_key = self.processor.partition_options(collection_name, partition_key).get('partitionKey')
+        self.groups.setdefault((collection_name, partition_key), []).append(
+            {'kind': kind, 'collection': collection_name, 'partition_key': partition_key,
+             'document': document, 'previous': previous})
+
+
+    def create(self, collection_name, document, partition_key=None):
+        self.add('create', collection_name, document, partition_key, None)
+
+
+    def upsert(self, collection_name, document, partition_key=None, previous=None):
+        '''Writes the document. previous is what to put back if the unit of work has to be undone, or None
+        if the document did not exist before'''
+        self.add('upsert', collection_name, document, partition_key, previous)
+
+
+    def delete(self, collection_name, document, partition_key=None):
+        self.add('delete', collection_name, document, partition_key, document)
+
+
+    def commit(self):
+        '''Makes all of the writes. If any of them fail then the ones that were made are undone and the error is raised'''
+        done = list()    # operations that have been written, in order, so that they can be undone
+        try:
+            for (collection_name, partition_key), operations in self.groups.items():
+                if config_cosmos.COSMOSDB_USE_STORED_PROCEDURES:
+                    self.write_transaction(collection_name, partition_key, operations)
+                    done.extend(operations)
+                else:
+                    self.write_parallel(operations, done)
+        except errors.HTTPFailure:
+            self.undo(done)
+            raise
+
+
+    def write_transaction(self, collection_name, partition_key, operations):
+        '''Runs the bulkWrite stored procedure, creating it the first time it is used in a collection'''
+        sproc_link = self.processor.collection_link(collection_name) + '/sprocs/' + BULK_WRITE_SPROC
+        payload = [{'kind': operation['kind'], 'document': operation['document']} for operation in operations]
+        options = self.processor.partition_options(collection_name, partition_key)
+        try:
+            return self.processor.client.ExecuteStoredProcedure(sproc_link, [payload], options)
+        except errors.HTTPFailure as e:
+            if e.status_code != 404:
+                raise
+        self.processor.client.CreateStoredProcedure(self.processor.collection_link(collection_name),
+                                                    {'id': BULK_WRITE_SPROC, 'body': BULK_WRITE_JS})
+        return self.processor.client.ExecuteStoredProcedure(sproc_link, [payload], options)
+
+
+    def write_parallel(self, operations, done):
+        '''Makes the writes at the same time. Every write is waited for before the first error (if any) is raised
+        so that done holds everything that needs undoing'''
+        futures = [(operation, classes.metrics.submit(self.processor.executor, self.write, operation)) for operation in operations]
+        failure = None
+        for operation, future in futures:
+            try:
+                future.result()
+                done.append(operation)
+            except errors.HTTPFailure as e:
+                failure = failure or e
+        if failure is not None:
+            raise failure
+
+
+    def write(self, operation):
+        client = self.processor.client
+        options = self.processor.partition_options(operation['collection'], operation['partition_key'])
+        collection_link = self.processor.collection_link(operation['collection'])
+        if operation['kind'] == 'create':
+            return client.CreateDocument(collection_link, operation['document'], options)
+        elif operation['kind'] == 'upsert':
+            return client.UpsertDocument(collection_link, operation['document'], options)
+        else:
+            return client.DeleteDocument(self.processor.document_link(operation['collection'], operation['document']['id']), options)
+
+
+    def undo(self, done):
+        '''Reverses the writes that were made, most recent first. This is best effort: a failure is reported and
+        the rest are still undone'''
+        for operation in reversed(done):
+            if operation['kind'] == 'delete' or operation['previous'] is not None:
+                previous = {key: value for key, value in operation['previous'].items() if key[:1] != '_'}
+                undo_operation = dict(operation, kind='create' if operation['kind'] == 'delete' else 'upsert', document=previous)
+            else:
+                undo_operation = dict(operation, kind='delete')
+            try:
+                self.write(undo_operation)
+            except errors.HTTPFailure as e:
+                print("unable to undo " + operation['kind'] + " of " + operation['document']['id'] + ": " + str(e))
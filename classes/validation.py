@@ -0,0 +1,115 @@
+import collections
+import enum
+import functools
+import netaddr
+import config_cosmos
+
+
+class Network(str):
+    '''A subnet or IP address from a request along with its parsed form. It is still the string that was sent
+    so it can be stored, compared and used as a key exactly as before without being parsed again'''
+
+    def __new__(cls, text):
+        network = netaddr.IPNetwork(text)
+        self = str.__new__(cls, text)
+        self.first = network.first
+        self.prefixlen = network.prefixlen
+        self.version = network.version
+        return self
+
+
+class VMId(str):
+    '''A vmid from a request along with its number'''
+
+    def __new__(cls, text, number):
+        self = str.__new__(cls, text)
+        self.number = number
+        return self
+
+
+class Action(enum.Enum):
+    ALLOW = 'allow'
+    DENY = 'deny'
+
+
+NewVM = collections.namedtuple('NewVM', ['name', 'subnets'])
+NewRule = collections.namedtuple('NewRule', ['name', 'source', 'destination', 'action'])
+
+
+@functools.lru_cache(maxsize=config_cosmos.VALIDATION_CACHE_SIZE)
+def parse_cached_network(text):
+    return Network(text)
+
+
+def parse_network(value):
+    '''Parses a subnet or IP address. The same few subnets turn up again and again so the parsed form is remembered.
+    Raises ValueError if it is not valid'''
+    if isinstance(value, Network):
+        return value
+    if not isinstance(value, str):
+        raise ValueError('Expected a subnet or IP address but got ' + repr(value))
+    try:
+        return parse_cached_network(value)
+    except (netaddr.core.AddrFormatError, ValueError, TypeError):
+        raise ValueError('Invalid subnet or IP address ' + value)
+
+
+def parse_vmid(value):
+    '''Parses a vmid, which is "vm-" followed by a number. Note that this does not confirm that the VM exists'''
+    if isinstance(value, VMId):
+        return value
+    if not isinstance(value, str) or not value.startswith('vm-') or not value[3:].isdigit():
+        raise ValueError('Invalid vmid ' + repr(value))
+    return VMId(value, int(value[3:]))
+
+
+def parse_endpoint(value):
+    '''Parses the "from" or "to" of a firewall rule, which is a vmid, a subnet or an IP address'''
+    if isinstance(value, str) and value.startswith('vm-'):
+        return parse_vmid(value)
+    return parse_network(value)
+
+
+def parse_name(value):
+    if not isinstance(value, str):
+        raise ValueError('Expected a name but got ' + repr(value))
+    return value
+
+
+def parse_subnets(value):
+    '''Parses a list of subnets, checking every one of them'''
+    if not isinstance(value, list) or not value:
+        raise ValueError('Expected a list of subnets')
+    return tuple(parse_network(subnet) for subnet in value)
+
+
+def parse_action(value):
+    try:
+        return Action(value)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid action ' + repr(value))
+
+
+# Each schema lists the fields of the payload in the order of the type they are parsed into, with the function
+# that parses each one
+NEW_VM_SCHEMA = (NewVM, (('name', parse_name), ('ipaddresses', parse_subnets)))
+NEW_RULE_SCHEMA = (NewRule, (('name', parse_name), ('from', parse_endpoint), ('to', parse_endpoint), ('action', parse_action)))
+
+
+def parse(payload, schema):
+    '''Parses a request payload into the schema's type. Raises ValueError if a field is missing or not valid'''
+    result_type, fields = schema
+    if not isinstance(payload, dict):
+        raise ValueError('Expected a JSON object')
+    try:
+        return result_type(*[parser(payload[field]) for field, parser in fields])
+    except KeyError as e:
+        raise ValueError('Missing field ' + str(e))
+
+
+def parse_new_vm(payload):
+    return parse(payload, NEW_VM_SCHEMA)
+
+
+def parse_new_rule(payload):
+    return parse(payload, NEW_RULE_SCHEMA)
@@ -0,0 +1,147 @@
+import bisect
+import threading
+import time
+import config_cosmos
+from classes.baseprocessor import SyncTokenExpired
+from classes.firewallengine import ip_to_int, MASKS
+
+
+class VMIndex():
+    '''Secondary indexes over the VMs so that they can be searched by name prefix, state and IP address or subnet
+    without reading the whole collection:
+
+    - names holds (name, vmid) sorted, so the VMs whose names start with a prefix are one contiguous slice
+    - states maps each state to the set of vmids in it
+    - addresses holds every IP address in use as an integer, sorted, so the addresses in a subnet are one contiguous
+      slice, and owners maps each of them to the VM using it
+
+    It is loaded on first use and then kept up to date by the processor's listener for writes made by this process,
+    and by applying the changes made by other workers (from get_vm_changes) every VM_INDEX_REFRESH seconds'''
+
+    def __init__(self):
+        self.vms = dict()          # vmid -> document
+        self.names = list()
+        self.states = dict()
+        self.addresses = list()
+        self.owners = dict()
+        self.position = None       # sync position that the other workers' changes have been applied up to
+        self.checked = 0.0         # time.monotonic() of the last check for their changes
+        self.loaded = False
+        self.lock = threading.Lock()
+
+
+    def load(self, position, vms):
+        '''Builds the indexes from every VM. position is the sync token taken before the VMs were read'''
+        with self.lock:
+            self.vms = dict()
+            self.names = list()
+            self.states = dict()
+            self.addresses = list()
+            self.owners = dict()
+            for vm in vms:
+                self.vms[vm['id']] = vm
+                self.names.append((vm['name'], vm['id']))
+                self.states.setdefault(vm['state'], set()).add(vm['id'])
+                for ipaddress in vm['ip']:
+                    self.owners[ip_to_int(ipaddress)] = vm['id']
+            self.names.sort()
+            self.addresses = sorted(self.owners)
+            self.position = position
+            self.checked = time.monotonic()
+            self.loaded = True
+
+
+    def handle_change(self, collection, change, document):
+        '''Processor listener that updates the indexes as VMs are created and deleted'''
+        if not self.loaded or collection != config_cosmos.COSMOSDB_COLLECTION_VM:
+            return
+        with self.lock:
+            if change == 'created':
+                self.add(document)
+            else:
+                self.remove(document['id'])
+
+
+    def refresh(self, get_changes):
+        '''Applies the changes made since the last refresh, if it was more than VM_INDEX_REFRESH seconds ago.
+        If they are no longer available the index is marked as not loaded so that it gets built again'''
+        with self.lock:
+            if not self.loaded or time.monotonic() - self.checked < config_cosmos.VM_INDEX_REFRESH:
+                return
+            self.checked = time.monotonic()
+            position = self.position
+        try:
+            changes = get_changes(position)
+        except SyncTokenExpired:
+            self.loaded = False
+            return
+        with self.lock:
+            for change_position, document in changes:
+                if document.get('deleted'):
+                    self.remove(document['id'])
+                else:
+                    self.add(document)
+                self.position = max(self.position, change_position)
+
+
+    def add(self, vm):
+        '''Adds (or replaces) a VM in the indexes. Called with the lock held'''
+        self.remove(vm['id'])
+        self.vms[vm['id']] = vm
+        bisect.insort(self.names, (vm['name'], vm['id']))
+        self.states.setdefault(vm['state'], set()).add(vm['id'])
+        for ipaddress in vm['ip']:
+            address = ip_to_int(ipaddress)
+            if address not in self.owners:
+                bisect.insort(self.addresses, address)
+            self.owners[address] = vm['id']
+
+
+    def remove(self, vmid):
+        '''Removes a VM from the indexes if it is there. Called with the lock held'''
+        vm = self.vms.pop(vmid, None)
+        if vm is None:
+            return
+        del self.names[bisect.bisect_left(self.names, (vm['name'], vmid))]
+        self.states[vm['state']].discard(vmid)
+        for ipaddress in vm['ip']:
+            address = ip_to_int(ipaddress)
+            if self.owners.get(address) == vmid:
+                del self.owners[address]
+                del self.addresses[bisect.bisect_left(self.addresses, address)]
+
+
+    def search(self, name=None, prefix=False, state=None, network=None):
+        '''Returns the VMs matching all of the criteria given, ordered by vmid. name matches the whole name, or the
+        start of it if prefix is set. network is a parsed IPv4 subnet or address from classes.validation'''
+        with self.lock:
+            matches = list()
+            if name is not None:
+                if prefix:
+                    start = bisect.bisect_left(self.names, (name,))
+                    end = bisect.bisect_left(self.names, (name + '\U0010ffff',))
+                else:
+                    start = bisect.bisect_left(self.names, (name,))
+                    end = bisect.bisect_left(self.names, (name, '\U0010ffff'))
+                matches.append({vmid for _, vmid in self.names[start:end]})
+            if state is not None:
+                matches.append(self.states.get(state, set()))
+            if network is not None:
+                first = network.first & MASKS[network.prefixlen]
+                last = first | (~MASKS[network.prefixlen] & 0xffffffff)
+                start = bisect.bisect_left(self.addresses, first)
+                end = bisect.bisect_right(self.addresses, last)
+                matches.append({self.owners[address] for address in self.addresses[start:end]})
+
+            # intersect starting from the smallest set
+            matches.sort(key=len)
+            vmids = set(matches[0]) if matches else set(self.vms)
+            for other in matches[1:]:
+                vmids &= other
+            return [self.vms[vmid] for vmid in sorted(vmids, key=lambda vmid: int(vmid[3:]))]
+
+
+    def owner(self, ipaddress):
+        '''Returns the vmid of the VM using a parsed IPv4 address, or None if it isn't in use'''
+        with self.lock:
+            return self.owners.get(ipaddress.first)
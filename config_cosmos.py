@@ -1,6 +1,108 @@
 CSRF_ENABLED = True
 SECRET_KEY = 'xxxx'
 
+# Which storage backend the service uses. Either 'cosmosdb', 'sqlite' or 'memory'. The memory backend keeps
+# everything in the process (nothing is saved) and starts with the catalogue in the MEMORY_SEED file, if set
+STORAGE_BACKEND = 'cosmosdb'
+MEMORY_SEED = None
+
+# How many vmids/fwids each process leases from the counter at a time. Larger blocks mean fewer counter
+# writes but bigger gaps in the IDs when processes restart
+ID_BLOCK_SIZE = 100
+
+# Most VMs that can be created in one POST to /api/vms/batch
+MAX_BATCH_SIZE = 1000
+
+# Use orjson (if it is installed) to serialise the listings, which is several times faster than the json module
+FAST_JSON = False
+
+# Listing responses at least this many bytes long are gzip/deflate compressed for clients that accept it
+COMPRESS_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+
+# Most flows that can be checked in one POST to /api/network/firewall/evaluate
+MAX_FLOW_BATCH_SIZE = 100000
+
+# Number of documents fetched from the backend at a time when streaming a full listing, and the largest
+# ?limit= a client can ask for on the listing routes
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# How many seconds a cached GET listing is served for and how many listings are cached. Writes made through
+# this process drop the cache straight away; the TTL bounds how stale it can be after writes by other processes
+LISTING_CACHE_TTL = 5
+LISTING_CACHE_MAX_ENTRIES = 256
+
+# The VM searches (?name=, ?state=, ?ip=) and IP address lookups are answered from indexes held by each process.
+# Writes made through this process update them straight away; the changes made by other processes are applied at
+# most every VM_INDEX_REFRESH seconds
+VM_INDEX_REFRESH = 5
+
+# Flows are checked against firewall rules compiled by each process. Writes made through this process update them
+# straight away; the rules and VMs changed by other processes are applied at most every FIREWALL_REFRESH seconds
+FIREWALL_REFRESH = 5
+
+# Warm up the processor in the background as soon as the app is loaded. /api/ready returns 503 until it has finished
+WARM_UP_ON_START = True
+
+# VM operations sent with a Prefer: respond-async header (or all of them, if JOBS_BY_DEFAULT is set) are queued as
+# jobs and answered straight away with 202 Accepted and the job, whose progress can then be read from /api/jobs/<id>.
+# Each process runs JOB_WORKERS jobs at once and holds up to JOB_QUEUE_SIZE waiting ones (503 after that). Jobs are
+# kept in the backend for JOB_RETENTION seconds
+JOBS_BY_DEFAULT = False
+JOB_WORKERS = 4
+JOB_QUEUE_SIZE = 1000
+JOB_RETENTION = 24 * 60 * 60
+
+# A subnet reconciliation (POST /api/network/subnets/reconcile) only frees an address that is marked used but not held
+# by any VM if it is still like that this many seconds later, so that a VM being created at the time is left alone
+SUBNET_RECONCILE_GRACE = 60
+
+# Used when serving with gunicorn (see gunicorn.conf.py). SERVER_WORKERS processes are forked from a master that
+# has already warmed up the processor (None means two per CPU plus one) and each handles up to SERVER_THREADS
+# requests at once. A worker is replaced after about SERVER_MAX_REQUESTS requests (0 for never) and is given
+# SERVER_GRACEFUL_TIMEOUT seconds to finish the requests it is handling whenever it is stopped
+SERVER_BIND = '0.0.0.0:8080'
+SERVER_WORKERS = None
+SERVER_THREADS = 8
+SERVER_MAX_REQUESTS = 10000
+SERVER_GRACEFUL_TIMEOUT = 30
+
+# Each worker keeps its own metrics. So that /metrics and /api/cache/stats can add up those of every worker, each one
+# saves them to a file in METRICS_DIRECTORY every METRICS_SAVE_INTERVAL seconds. None to only report the worker that
+# answers. gunicorn.conf.py uses a new temporary directory if this is None and there is more than one worker
+METRICS_DIRECTORY = None
+METRICS_SAVE_INTERVAL = 5
+
+# Used when serving through asgi.py. ASYNC_WORKER_THREADS requests can be running in the app at once and
+# ASYNC_STREAM_BUFFER chunks of a streamed response are held while waiting for a slow client
+ASYNC_WORKER_THREADS = 32
+ASYNC_STREAM_BUFFER = 16
+
+# Deleted VMs and rules are remembered for SYNC_RETENTION seconds so that ?since= syncs can report them. A client
+# whose sync token is older than that gets 410 Gone and has to fetch the full listing again. /api/changes/stream
+# checks the backend for writes made by other workers every CHANGE_STREAM_POLL_INTERVAL seconds (writes made by
+# this process are sent straight away)
+SYNC_RETENTION = 7 * 24 * 60 * 60
+CHANGE_STREAM_POLL_INTERVAL = 5
+
+# Requests sent with an X-Trace header holding TRACE_TOKEN are traced: each Processor method and backend call they
+# make is written with its timing to TRACE_LOG, and X-Trace-Profile: 1 adds a cProfile summary of TRACE_PROFILE_LINES
+# lines. TRACE_SAMPLE_RATE is the fraction of all other requests to trace (without profiling). Tracing is off when
+# TRACE_TOKEN is None and TRACE_SAMPLE_RATE is 0. GET /api/traces with the header returns the recent traces. Once
+# TRACE_LOG reaches TRACE_LOG_MAX_BYTES it is moved to TRACE_LOG.1 (replacing the older traces) and started again
+TRACE_TOKEN = None
+TRACE_SAMPLE_RATE = 0.0
+TRACE_LOG = 'traces.log'
+TRACE_LOG_MAX_BYTES = 10 * 1024 * 1024
+TRACE_PROFILE_LINES = 25
+
+# How many distinct subnets and IP addresses from requests are kept already parsed
+VALIDATION_CACHE_SIZE = 4096
+
+# Database file used by the sqlite backend. Run setup.py --backend sqlite to create and load it
+SQLITE_DATABASE = 'servicecatalogue.db'
+
 COSMOSDB_HOST = 'https://xxx:443/'
 COSMOSDB_KEY = 'xxxx'
 
@@ -10,4 +112,53 @@ COSMOSDB_COLLECTION_VMID = 'vmid'
 COSMOSDB_COLLECTION_IP = 'ipaddresses'
 COSMOSDB_COLLECTION_FW = 'firewallrules'
 COSMOSDB_COLLECTION_FWID = 'fwid'
-COSMOSDB_COLLECTION_SUBNET = 'subnets'
\ No newline at end of file
+COSMOSDB_COLLECTION_SUBNET = 'subnets'
+COSMOSDB_COLLECTION_TOMBSTONE = 'tombstones'   # deleted VMs, kept for SYNC_RETENTION seconds. Created if missing
+COSMOSDB_COLLECTION_JOB = 'jobs'               # kept for JOB_RETENTION seconds. Created if missing
+
+# Multi-document writes (creating or deleting a VM) to one collection are made as a transaction with the bulkWrite
+# stored procedure, which is created automatically. If turned off the writes are made in parallel. Either way the
+# writes are undone if a later part of the change fails
+COSMOSDB_USE_STORED_PROCEDURES = True
+
+# Number of documents setup.py writes to Cosmos DB in one batch
+COSMOSDB_SEED_BATCH_SIZE = 100
+
+# How many calls to Cosmos DB one worker makes at the same time (e.g. reserving addresses in several subnets).
+# The pool of kept-alive connections is the same size
+COSMOSDB_CONCURRENCY = 8
+
+# Every call to Cosmos DB goes through a governor (see classes/governor.py) that keeps within the throughput:
+# - COSMOSDB_THROUGHPUT is the request units per second the service may use, e.g. the provisioned RU/s. None for no
+#   limit other than the 429s Cosmos DB sends. Each of the COSMOSDB_THROUGHPUT_SHARED_BY processes gets an equal share
+# - the calls made at once start at COSMOSDB_CONCURRENCY, halve when Cosmos DB throttles (429) and then grow back
+# - a throttled call is retried after the x-ms-retry-after-ms Cosmos DB asks for, up to COSMOSDB_MAX_RETRIES times
+#   or COSMOSDB_MAX_RETRY_WAIT seconds of waiting, and everything else waits as well
+# - a read waits at most COSMOSDB_READ_WAIT seconds to be made and a write (including the reads it needs) at most
+#   COSMOSDB_WRITE_WAIT, after which the request gets a 503 with a Retry-After, so that reads are shed first
+COSMOSDB_THROUGHPUT = None
+COSMOSDB_THROUGHPUT_SHARED_BY = 1    # gunicorn.conf.py sets this to the number of workers
+COSMOSDB_MAX_RETRIES = 9
+COSMOSDB_MAX_RETRY_WAIT = 30
+COSMOSDB_READ_WAIT = 1
+COSMOSDB_WRITE_WAIT = 10
+
+# For testing the above: if set, calls are throttled as if the account were provisioned with this many RU/s
+# (see classes/throttlesimulator.py), e.g. to load test against the Cosmos DB Emulator. Split between the processes
+# in the same way as COSMOSDB_THROUGHPUT
+COSMOSDB_SIMULATED_THROUGHPUT = None
+
+# If set, the collection metadata read from Cosmos DB is saved to this file and reused by later runs so that a new
+# instance doesn't have to read it again. Delete the file if the collections are recreated
+COSMOSDB_METADATA_CACHE = None
+
+# Partition key path for each collection. The VM and firewall rule documents are looked up by id and the
+# IP address documents are grouped by the subnet they belong to. Set COSMOSDB_PARTITIONED to True if the
+# collections were created with these partition keys (setup.py does this) so that reads go to a single partition
+COSMOSDB_PARTITIONED = False
+COSMOSDB_PARTITION_KEYS = {
+    COSMOSDB_COLLECTION_VM: '/id',
+    COSMOSDB_COLLECTION_IP: '/subnet',
+    COSMOSDB_COLLECTION_FW: '/id',
+    COSMOSDB_COLLECTION_TOMBSTONE: '/id',
+    COSMOSDB_COLLECTION_JOB: '/id'}
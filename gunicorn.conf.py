@@ -0,0 +1,86 @@
+'''
+Settings for serving the API in production with gunicorn:
+
+    gunicorn -c gunicorn.conf.py main:app
+
+The app is loaded and the processor warmed up once in the master, and then the workers are forked from it so that
+they all start with the collection metadata and subnet bitmaps already loaded. Each worker opens its own
+connections to the backend. Sending the master HUP (or a worker reaching SERVER_MAX_REQUESTS) starts new workers
+before the old ones are stopped, and a stopped worker finishes the requests it has in flight first. As the app is
+preloaded, HUP does not pick up new code: for that start a new master with USR2 and then stop the old one with QUIT.
+
+Each worker gets an equal share of COSMOSDB_THROUGHPUT, and saves its metrics to METRICS_DIRECTORY so that whichever
+worker answers /metrics reports the totals. The counters of workers that have stopped are kept in the totals
+'''
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import config_cosmos
+
+# the master warms up the processor itself in on_starting, before any workers exist
+config_cosmos.WARM_UP_ON_START = False
+
+bind = config_cosmos.SERVER_BIND
+workers = config_cosmos.SERVER_WORKERS or multiprocessing.cpu_count() * 2 + 1
+if config_cosmos.STORAGE_BACKEND == 'memory':
+    workers = 1    # each worker would have its own separate catalogue
+worker_class = 'gthread'
+threads = config_cosmos.SERVER_THREADS
+preload_app = True
+max_requests = config_cosmos.SERVER_MAX_REQUESTS
+max_requests_jitter = max_requests // 10    # so that the workers aren't all replaced at the same moment
+graceful_timeout = config_cosmos.SERVER_GRACEFUL_TIMEOUT
+
+# the throughput is for the whole service, so the workers split it between them
+config_cosmos.COSMOSDB_THROUGHPUT_SHARED_BY = workers
+
+# gunicorn runs this file again when it is sent HUP, by which time the directory has already been made
+TEMPORARY_METRICS_PREFIX = 'servicecatalogue-metrics-'
+if config_cosmos.METRICS_DIRECTORY is None and workers > 1:
+    config_cosmos.METRICS_DIRECTORY = tempfile.mkdtemp(prefix=TEMPORARY_METRICS_PREFIX)
+
+
+def on_starting(server):
+    import main
+    if config_cosmos.METRICS_DIRECTORY:
+        # the totals start again from zero with the server, so drop anything left from the last time it ran
+        os.makedirs(config_cosmos.METRICS_DIRECTORY, exist_ok=True)
+        for file_name in os.listdir(config_cosmos.METRICS_DIRECTORY):
+            if file_name.endswith('.json'):
+                os.remove(os.path.join(config_cosmos.METRICS_DIRECTORY, file_name))
+    main.warm_up()
+
+
+def pre_fork(server, worker):
+    import main
+    if main.processor is not None:
+        main.processor.before_fork()
+
+
+def post_fork(server, worker):
+    import main
+    if main.processor is not None:
+        main.processor.after_fork()
+    if config_cosmos.METRICS_DIRECTORY:
+        import classes.metrics
+        classes.metrics.start_saving()
+
+
+def worker_exit(server, worker):
+    if config_cosmos.METRICS_DIRECTORY:
+        import classes.metrics
+        classes.metrics.save()    # so that nothing since the last save is lost
+
+
+def child_exit(server, worker):
+    if config_cosmos.METRICS_DIRECTORY:
+        import classes.metrics
+        classes.metrics.worker_stopped(worker.pid)
+
+
+def on_exit(server):
+    directory = config_cosmos.METRICS_DIRECTORY
+    if directory and os.path.basename(directory).startswith(TEMPORARY_METRICS_PREFIX):
+        shutil.rmtree(directory, ignore_errors=True)
@@ -1,84 +1,280 @@
 import flask
-import classes.cosmosdbprocessor
+import classes.processorfactory
+import classes.responsecache
+import classes.firewallengine
+import classes.responseencoding
+import classes.validation
+import classes.changenotifier
+import classes.jobqueue
+import classes.vmindex
+import classes.metrics
+import time
+import classes.tracing
+import hmac
+import math
+import atexit
+import random
+from classes.baseprocessor import VM_FIELDS, RULE_FIELDS, SyncTokenExpired, BackendBusy, encode_cursor, decode_cursor
+import config_cosmos
 import json
-from flask import jsonify, request, abort
-import netaddr
+import threading
+from flask import jsonify, request, abort, Response
 
 
 app = flask.Flask(__name__)
 
-def is_valid_subnet(subnet):
-    try:
-        netaddr.IPNetwork(subnet)
-        return True
-    except (netaddr.core.AddrFormatError, ValueError):
-        return False
-
-
-def validate_new_vm(parms):
-    '''Does some  validation of the parameters being passed in'''
-
-    if all (elements in parms for elements in ("name", "ipaddresses")):  # checks that there is a "name" and "ipaddresses" key
-        if isinstance(parms["ipaddresses"], list):   # checks that it's a list even if a single IP
-            # check format of IP subnets to ensure correct        
-            for subnet in parms["ipaddresses"]:
-                if is_valid_subnet(subnet):
-                    return True
-                else:
-                    return False
-        else:
-            return False
+# Serialised listing responses, dropped whenever the processor writes to the collection they came from
+listing_cache = classes.responsecache.ResponseCache(config_cosmos.LISTING_CACHE_TTL, config_cosmos.LISTING_CACHE_MAX_ENTRIES)
+classes.metrics.metrics.cache = listing_cache
+
+# Compiled firewall rules used to answer flow checks. Built on the first check and kept up to date by the processor
+firewall_engine = classes.firewallengine.FirewallEngine()
+
+# Indexes over the VMs used to answer searches and IP address lookups. Built on the first one and kept up to date
+# by the processor
+vm_index = classes.vmindex.VMIndex()
+
+# Wakes the change streams when this process writes something
+change_notifier = classes.changenotifier.ChangeNotifier()
+
+def stream_json_array(documents):
+    '''Generator that produces a JSON array one document at a time so the whole listing is never held in memory'''
+    yield b'['
+    for index, document in enumerate(documents):
+        yield (b',' if index else b'') + classes.responseencoding.dumps(document)
+    yield b']'
+
+
+def list_documents(collection, allowed_fields, get_page, iterate, get_changes):
+    '''Builds the response for a listing route. If ?limit= is given a single page is returned with the cursor for
+    the next page in the X-Next-Cursor header. ?format=stream streams the JSON array and ?format=ndjson streams
+    one document per line, so that full exports do not have to be built in memory. ?fields=id,name returns just
+    those fields and is passed on to the backend so that nothing else is fetched.
+    Plain JSON responses are cached and carry an ETag so that a client that already has the latest listing
+    gets a 304 Not Modified without the backend being touched. Large responses are compressed if the client accepts it.
+    The first page (or the whole listing) carries an X-Sync-Token header that can be passed back as ?since= to get
+    just what has changed since (see list_changes)'''
+    limit = request.args.get('limit', type=int)
+    output_format = request.args.get('format', 'json')
+    if output_format not in ('json', 'stream', 'ndjson'):
+        return abort(400)
+    if limit is not None and (limit < 1 or limit > config_cosmos.MAX_PAGE_SIZE):
+        return abort(400)
+    fields = allowed_fields
+    if request.args.get('fields'):
+        fields = tuple(dict.fromkeys(request.args.get('fields').split(',')))   # removes duplicates but keeps the order
+        if not all(field in allowed_fields for field in fields):
+            return abort(400)
+    if request.args.get('since') is not None:
+        if limit is not None or request.args.get('cursor') is not None or output_format != 'json':
+            return abort(400)
+        return list_changes(get_changes, request.args.get('since'), fields)
+    encoding = request.accept_encodings.best_match(['gzip', 'deflate'])
+
+    cache_key = request.query_string
+    if output_format == 'json':
+        entry = listing_cache.get(collection, cache_key)
+        if entry is not None:
+            return cached_response(entry, encoding)
+        generation = listing_cache.generation(collection)
+
+    # taken before reading so that anything written while the listing is read is picked up by the next sync
+    sync_token = encode_cursor(processor.sync_token()) if request.args.get('cursor') is None else None
+    next_cursor = None
+    if limit is not None:
+        try:
+            documents, next_cursor = get_page(limit, request.args.get('cursor'), fields)
+        except ValueError:
+            return abort(400)   # the cursor was not one that we handed out
     else:
-        return False
-
-
-def is_valid_vmid_format(vmid):
-    '''Checks to see whether the argument passed in conforms to vmid format.
-    Note that this does not confirm that the VMID exists'''
-    if len(vmid.split("-")) != 2:
-        return False
-    if vmid.split("-")[0] != "vm":
-        return False
+        documents = iterate(fields)
+
+    if output_format == 'json':
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else {}
+        if sync_token is not None:
+            headers['X-Sync-Token'] = sync_token
+        body = classes.responseencoding.dumps(list(documents))
+        return cached_response(listing_cache.put(collection, cache_key, generation, body, headers), encoding)
+
+    if output_format == 'stream':
+        chunks = stream_json_array(documents)
+        mimetype = 'application/json'
+    else:
+        chunks = (classes.responseencoding.dumps(document) + b'\n' for document in documents)
+        mimetype = 'application/x-ndjson'
+    if encoding is not None:
+        response = Response(classes.responseencoding.compress_stream(chunks, encoding), mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = Response(chunks, mimetype=mimetype)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = next_cursor
+    if sync_token is not None:
+        response.headers['X-Sync-Token'] = sync_token
+    return response, 200
+
+
+def list_changes(get_changes, since, fields):
+    '''Builds the response for ?since=<sync token>: the documents created or changed since the token was handed out
+    and a tombstone {"id": ..., "deleted": true} for each one deleted, oldest first. X-Sync-Token holds the token to
+    pass next time. A change may be sent more than once so clients should apply them by id. Returns 410 Gone if the
+    token is older than deletions are remembered for, in which case the client has to fetch the full listing again'''
     try:
-        int(vmid.split("-")[1])
+        position = int(decode_cursor(since))
+        changes = get_changes(position, fields)
+    except SyncTokenExpired:
+        return abort(410)
     except ValueError:
-        return False
-
-    # if get this far then passed the format tests so it looks like a VMID
-    return True
-
-
-def validate_new_rule(parms):
-    '''Basic validation of the arguments being passed in.
-    Consequently it will catch blatant errors in arguments but more subtle ones will be missed and
-    can generate an error in the code'''
-    
-    if all (elements in parms for elements in ("name", "from", "to", "action")):  # confirms that the 4 required arguments exist in the parms blob
-        # check to see if the "from" and "to" are either IPs, subnets or vmids
-        if not netaddr.valid_ipv4(parms["from"]):
-            if not is_valid_subnet(parms["from"]):
-                # not a valid IP or subnet so check for valid vmid
-                if not is_valid_vmid_format(parms["from"]):
-                    return False
-
-        if not netaddr.valid_ipv4(parms["to"]):
-            if not is_valid_subnet(parms["to"]):
-                # not a valid IP or subnet so check for valid vmid
-                if not is_valid_vmid_format(parms["to"]):
-                    return False
-
-        if parms["action"] != 'allow' and parms["action"] != 'deny':
-            return False
-
-        return True
+        return abort(400)   # not a token that we handed out
+    response = Response(classes.responseencoding.dumps([document for change_position, document in changes]),
+                        mimetype='application/json')
+    response.headers['X-Sync-Token'] = encode_cursor(changes[-1][0] if changes else position)
+    return response, 200
+
+
+def cached_response(entry, encoding):
+    '''Turns a cache entry into a response, or a 304 if the client already has this version. Bodies over
+    COMPRESS_MIN_SIZE are compressed if the client accepts it and the compressed copy is kept with the entry'''
+    if encoding is not None and len(entry['body']) >= config_cosmos.COMPRESS_MIN_SIZE:
+        if encoding not in entry:
+            entry[encoding] = classes.responseencoding.compress(entry['body'], encoding)
+        body = entry[encoding]
+        etag = entry['etag'] + '-' + encoding    # each encoding is a different representation so needs its own strong ETag
+    else:
+        encoding = None
+        body = entry['body']
+        etag = entry['etag']
+
+    if etag in request.if_none_match:
+        response = Response(status=304)
     else:
-        return False
+        response = Response(body, mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers.extend(entry['headers'])
+    return response
+
+
+processor = None
+processor_lock = threading.Lock()
+job_queue = None    # runs the operations that are sent as jobs, created along with the processor
+warming_up = threading.Event()   # set while a warm up is running
 
 
 @app.before_first_request
 def createprocessor():
-    global cosmos_processor
-    cosmos_processor = classes.cosmosdbprocessor.Processor()   # create a new Cosmos DB processor object
+    with processor_lock:
+        if processor is None:
+            use_processor(classes.processorfactory.create_processor())   # create a processor for the configured storage backend
+
+
+def use_processor(new_processor):
+    '''Connects a processor to the listing cache, firewall engine and metrics and makes the routes use it. Either
+    called by createprocessor or, to supply a processor of your own (as main-stub.py does), before serving starts'''
+    global processor
+    new_processor.add_listener(lambda collection, change, document: listing_cache.invalidate(collection))
+    new_processor.add_listener(firewall_engine.handle_change)
+    new_processor.add_listener(vm_index.handle_change)
+    new_processor.add_listener(change_notifier.handle_change)
+    classes.metrics.instrument(new_processor, config_cosmos.STORAGE_BACKEND)
+    global job_queue
+    job_queue = classes.jobqueue.JobQueue(new_processor.save_job,
+                                          {'add_vm': run_add_vms, 'delete_vm': run_delete_vm, 'restart_vm': run_restart_vm,
+                                           'reconcile_subnets': run_reconcile_subnets},
+                                          coalesce=('add_vm',))
+    processor = new_processor
+
+
+@atexit.register
+def finish_jobs():
+    '''Gives the queued jobs a chance to finish before the process exits'''
+    if job_queue is not None:
+        job_queue.wait(config_cosmos.SERVER_GRACEFUL_TIMEOUT)
+
+
+@app.before_request
+def start_request_metrics():
+    # the route pattern (e.g. /api/vms/vm/<string:vmid>) rather than the path so that there is one series per route
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    request.environ['servicecatalogue.metrics'] = (route, time.perf_counter())
+    classes.metrics.metrics.request_started(route)
+
+
+@app.after_request
+def record_request_metrics(response):
+    route, start = request.environ['servicecatalogue.metrics']
+    classes.metrics.metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - start)
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exception):
+    if 'servicecatalogue.metrics' in request.environ:
+        classes.metrics.metrics.request_finished(request.environ['servicecatalogue.metrics'][0])
+
+
+def trace_requested():
+    '''True if the request has the X-Trace header with the TRACE_TOKEN from the config'''
+    return (config_cosmos.TRACE_TOKEN is not None and
+            hmac.compare_digest(request.headers.get('X-Trace', ''), config_cosmos.TRACE_TOKEN))
+
+
+@app.before_request
+def start_trace():
+    '''Traces the request if it asks to be traced or is picked by TRACE_SAMPLE_RATE. Sending X-Trace-Profile: 1
+    as well profiles it with cProfile'''
+    requested = trace_requested()
+    if requested or (config_cosmos.TRACE_SAMPLE_RATE and random.random() < config_cosmos.TRACE_SAMPLE_RATE):
+        trace = classes.tracing.Trace(request.method, request.full_path.rstrip('?'),
+                                      profile=requested and request.headers.get('X-Trace-Profile') == '1')
+        request.environ['servicecatalogue.trace'] = (trace, classes.tracing.current_trace.set(trace))
+
+
+@app.after_request
+def finish_trace(response):
+    if 'servicecatalogue.trace' in request.environ:
+        trace, token = request.environ['servicecatalogue.trace']
+        document = trace.finish(response.status_code)
+        classes.tracing.write(document)
+        response.headers['X-Trace-Id'] = trace.id
+        response.headers['Server-Timing'] = 'app;dur=' + str(document['duration_ms']) + ', backend;dur=' + str(document['backend_ms'])
+    return response
+
+
+@app.teardown_request
+def end_trace(exception):
+    if 'servicecatalogue.trace' in request.environ:
+        classes.tracing.current_trace.reset(request.environ.pop('servicecatalogue.trace')[1])
+
+
+@app.errorhandler(BackendBusy)
+def backend_busy(e):
+    '''The backend could not take the calls needed in time (e.g. Cosmos DB is throttling), so ask the client to come back'''
+    response = jsonify({"response": "The service is busy, try again later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+
+def warm_up():
+    '''Creates and warms up the processor. A failure (e.g. the database can't be reached) leaves the service
+    cold and the next readiness check tries again'''
+    try:
+        createprocessor()
+        processor.warm_up()
+    except Exception as e:
+        print("warm up failed: " + str(e))
+    finally:
+        warming_up.clear()
+
+
+def start_warm_up():
+    if not warming_up.is_set():
+        warming_up.set()
+        threading.Thread(target=warm_up, daemon=True).start()
 
 
 @app.route('/api/test', methods=['GET'])
@@ -87,23 +283,163 @@ def testapi():
     return jsonify({"response": "Welcome to the Service Catalogue API"}), 200
 
 
+@app.route('/api/ready', methods=['GET'])
+def readiness():
+    '''Readiness check for the load balancer. Returns 200 once the processor has been warmed up and 503 until then'''
+    if processor is not None and processor.warm:
+        return jsonify({"state": "warm"}), 200
+    start_warm_up()
+    return jsonify({"state": "cold"}), 503
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    '''Request latency and backend usage in the Prometheus text format, added up across the workers'''
+    return Response(classes.metrics.collect().render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/traces', methods=['GET'])
+def traces():
+    '''Returns the most recent traces from the trace log. Needs the X-Trace header. ?min_ms= only returns requests
+    that took at least that long, ?path= only those whose path starts with it and ?limit= sets how many (default 20)'''
+    if not trace_requested():
+        return abort(403)
+    try:
+        limit = int(request.args.get('limit', 20))
+        min_ms = float(request.args.get('min_ms', 0))
+    except ValueError:
+        return abort(400)
+    if limit < 0:
+        return abort(400)
+    return jsonify(classes.tracing.query(limit, min_ms, request.args.get('path'))), 200
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    '''Returns the hit and miss counts of the listing cache, added up across the workers'''
+    return jsonify(classes.metrics.collect().cache_stats), 200
+
+
+def changes_since(position):
+    '''Returns the VM and firewall rule changes after position as (position, event name, document), oldest first'''
+    changes = [(change_position, 'vm', document) for change_position, document in processor.get_vm_changes(position)]
+    changes.extend((change_position, 'rule', document) for change_position, document in processor.get_rule_changes(position))
+    return sorted(changes, key=lambda change: change[0])
+
+
+def change_key(change):
+    '''Identifies a change for the stream. A VM created and deleted within the same second has the same position and
+    id for both on Cosmos DB, so whether it is a deletion is part of the key'''
+    return (change[0], change[1], change[2]['id'], change[2].get('deleted', False))
+
+
+def stream_changes(position, changes, version):
+    '''Generator that produces the Server-Sent Events for changes and then for each change after them. It waits
+    for this process to write something or for CHANGE_STREAM_POLL_INTERVAL, whichever is sooner, before checking
+    again and sends a comment when there was nothing new so that dropped connections are noticed'''
+    sent = set()   # the changes at position that have been sent, as Cosmos DB returns those again
+    while True:
+        new_changes = [change for change in changes if change_key(change) not in sent]
+        for change_position, event, document in new_changes:
+            yield (b'id: ' + encode_cursor(change_position).encode('ascii') + b'\nevent: ' + event.encode('ascii') +
+                   b'\ndata: ' + classes.responseencoding.dumps(document) + b'\n\n')
+        if new_changes:
+            position = new_changes[-1][0]
+            sent = {key for key in sent | {change_key(change) for change in new_changes} if key[0] == position}
+        else:
+            yield b': keepalive\n\n'
+        version = change_notifier.wait(version, config_cosmos.CHANGE_STREAM_POLL_INTERVAL)
+        try:
+            changes = changes_since(position)
+        except SyncTokenExpired:
+            return    # the client reconnects, gets a 410 and does a full sync
+
+
+@app.route('/api/changes/stream', methods=['GET'])
+def change_stream():
+    '''Server-Sent Events stream of the changes to VMs ("vm" events) and firewall rules ("rule" events) as they happen.
+    The data of each event is the document, or a tombstone if it was deleted, and its id is a sync token. A client
+    that reconnects with Last-Event-ID (or ?since=) carries on from where it was, otherwise the stream starts now'''
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    version = change_notifier.version
+    try:
+        position = processor.sync_token() if since is None else int(decode_cursor(since))
+        changes = changes_since(position)
+    except SyncTokenExpired:
+        return abort(410)
+    except ValueError:
+        return abort(400)
+    response = Response(stream_changes(position, changes, version), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'    # stops nginx holding the events back
+    return response
+
+
+def run_add_vms(jobs):
+    '''Job handler that creates the VMs of all of the waiting add_vm jobs in one go'''
+    new_vmids = processor.add_vms([(job['parameters']['name'], job['parameters']['ipaddresses']) for job in jobs])
+    return [(new_vmid, 201) if new_vmid else ("Unable to allocate the requested ipaddresses", 400) for new_vmid in new_vmids]
+
+
+def run_delete_vm(jobs):
+    return [(None, 204) if processor.delete_vm(jobs[0]['vmid']) else (None, 404)]
+
+
+def run_restart_vm(jobs):
+    return [restart_result(jobs[0]['vmid'], processor.restart_vm(jobs[0]['vmid']))]
+
+
+def run_reconcile_subnets(jobs):
+    '''Repairs the subnets. Addresses found marked used but not held by any VM are only freed if they are still like
+    that SUBNET_RECONCILE_GRACE seconds later, by when any VM that was being created with them exists'''
+    passes = [processor.reconcile_subnets()]
+    leaked = [ipaddress for report in passes[0] for ipaddress in report['leaked']]
+    if leaked:
+        time.sleep(config_cosmos.SUBNET_RECONCILE_GRACE)
+        passes.append(processor.reconcile_subnets(set(leaked)))
+    return [({"passes": passes}, 200)]
+
+
+def wants_job():
+    '''True if the operation should be queued as a job rather than run straight away'''
+    return config_cosmos.JOBS_BY_DEFAULT or 'respond-async' in request.headers.get('Prefer', '')
+
+
+def submit_job(operation, vmid=None, parameters=None):
+    '''Queues an operation and returns 202 Accepted with the job, or 503 if too many jobs are waiting'''
+    try:
+        job = job_queue.submit(operation, vmid, parameters)
+    except classes.jobqueue.QueueFull:
+        response = jsonify({"response": "Too many operations are waiting, try again later"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    response = jsonify(job)
+    response.status_code = 202
+    response.headers['Location'] = '/api/jobs/' + job['id']
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response
+
+
+@app.route('/api/jobs/<string:job_id>', methods=['GET'])
+def get_job(job_id):
+    '''Returns a job. Once its status is "finished" its result holds the status and body that the operation
+    would have returned had it not been sent as a job'''
+    job = processor.get_job(job_id)
+    if job is None:
+        return '', 404
+    return jsonify(job), 200
+
+
 @app.route('/api/vms/vm', methods=['GET', 'POST'])
 def virtualmachines():
     '''This either retrieves all VMs or creates a new one'''
 
     if flask.request.method == 'GET':
-        results = cosmos_processor.get_all_vms()
-
-        # remove the system-defined properties (those that begin with "_")
-        updated_results = []         # new list to hold all of the updated documents
-        for document in results:
-            updated_document = {}        # new dict to hold the results without the system defined properties
-            for key in document.keys():
-                if key[:1] != '_':   # checks to see if first character is "_"
-                    updated_document[key] = document[key]
-            updated_results.append(updated_document)
-
-        return jsonify(updated_results), 200
+        if any(request.args.get(criterion) is not None for criterion in ('name', 'state', 'ip')):
+            return search_vms()
+        return list_documents(config_cosmos.COSMOSDB_COLLECTION_VM, VM_FIELDS, processor.get_vms_page, processor.iter_vms,
+                              processor.get_vm_changes)
 
     else:
         # They are making a post request so trying to create a new VM
@@ -111,21 +447,99 @@ def virtualmachines():
         # note that if there isn't a header of content-type = "application/json" in the post request it will 
         # not be interpreted as json regardless of whether it is formatted as such
         
-        if validate_new_vm(post_data):
-            new_vmid = cosmos_processor.add_vm(post_data['name'], post_data['ipaddresses'])
-            if not new_vmid:
-                return abort(400)
-            else:
-                return jsonify(new_vmid), 201
-        else:
+        try:
+            new_vm = classes.validation.parse_new_vm(post_data)
+        except ValueError:
             # the data being passed in has failed the validation so return a 400
             return abort(400)
 
+        if wants_job():
+            return submit_job('add_vm', parameters={'name': new_vm.name, 'ipaddresses': list(new_vm.subnets)})
+        new_vmid = processor.add_vm(new_vm.name, new_vm.subnets)
+        if not new_vmid:
+            return abort(400)
+        else:
+            return jsonify(new_vmid), 201
+
+
+def current_vm_index():
+    '''Returns the VM index, building it first if need be and bringing in the changes made by other processes'''
+    vm_index.refresh(processor.get_vm_changes)
+    if not vm_index.loaded:
+        position = processor.sync_token()    # taken first so that anything written while the VMs are read is applied later
+        vm_index.load(position, processor.iter_vms())
+    return vm_index
+
+
+def search_vms():
+    '''Returns the VMs matching ?name= (a trailing * matches names starting with the rest), ?state= and ?ip= (an IP
+    address, or a subnet to find the VMs with an address in it). When more than one is given a VM has to match them all.
+    ?fields= works as it does for the full listing'''
+    fields = VM_FIELDS
+    if request.args.get('fields'):
+        fields = tuple(dict.fromkeys(request.args.get('fields').split(',')))
+        if not all(field in VM_FIELDS for field in fields):
+            return abort(400)
+    if any(request.args.get(other) is not None for other in ('limit', 'cursor', 'since', 'format')):
+        return abort(400)
+    name = request.args.get('name')
+    prefix = name is not None and name.endswith('*')
+    if prefix:
+        name = name[:-1]
+    network = None
+    if request.args.get('ip') is not None:
+        try:
+            network = classes.validation.parse_network(request.args.get('ip'))
+        except ValueError:
+            return abort(400)
+        if network.version != 4:
+            return abort(400)
+
+    vms = current_vm_index().search(name, prefix, request.args.get('state'), network)
+    return Response(classes.responseencoding.dumps([{field: vm[field] for field in fields} for vm in vms]),
+                    mimetype='application/json'), 200
+
+
+@app.route('/api/vms/batch', methods=['POST'])
+def virtualmachines_batch():
+    '''This creates many VMs in one request. Each VM is reported separately so some can fail while the rest are created'''
+    post_data = request.get_json()
+    if not isinstance(post_data, list) or len(post_data) == 0:
+        return abort(400)
+    if len(post_data) > config_cosmos.MAX_BATCH_SIZE:
+        return abort(413)
+
+    # validate everything up front and only pass the valid VMs on to be created
+    new_vms = []
+    for spec in post_data:
+        try:
+            new_vms.append(classes.validation.parse_new_vm(spec))
+        except ValueError:
+            new_vms.append(None)
+    created = iter(processor.add_vms([new_vm for new_vm in new_vms if new_vm is not None]))
+
+    results = []
+    for index, new_vm in enumerate(new_vms):
+        new_vmid = next(created) if new_vm is not None else False
+        if new_vmid:
+            results.append({"index": index, "status": 201, "vmid": new_vmid})
+        elif new_vm is not None:
+            results.append({"index": index, "status": 400, "response": "Unable to allocate the requested ipaddresses"})
+        else:
+            results.append({"index": index, "status": 400, "response": "Failed validation"})
+
+    if all(result["status"] == 201 for result in results):
+        return jsonify(results), 201
+    else:
+        return jsonify(results), 207   # Multi-Status as some of the VMs were not created
+
 
 @app.route('/api/vms/vm/<string:vmid>', methods=['DELETE'])
 def delete_vm(vmid):
     '''This deletes a specific VM'''
-    if cosmos_processor.delete_vm(vmid):
+    if wants_job():
+        return submit_job('delete_vm', vmid)
+    if processor.delete_vm(vmid):
         return '', 204
     else:
         return '', 404
@@ -134,31 +548,28 @@ def delete_vm(vmid):
 @app.route('/api/service-operations/restart-vm/<string:vmid>', methods=['POST'])
 def restart_vm(vmid):
     '''This restarts a VM'''
-    restart_vm = cosmos_processor.restart_vm(vmid)
+    if wants_job():
+        return submit_job('restart_vm', vmid)
+    body, status = restart_result(vmid, processor.restart_vm(vmid))
+    return (jsonify(body) if body is not None else ''), status
+
+
+def restart_result(vmid, restart_vm):
+    '''Returns the body and status for the outcome of restarting a VM'''
     if restart_vm == 'success':
-        return jsonify({"response": "Successfully restarted " + vmid}), 200
+        return {"response": "Successfully restarted " + vmid}, 200
     elif restart_vm == 'off':
-        return jsonify({"response": "Unable to restart " + vmid + ". Machine is turned off"}), 200
+        return {"response": "Unable to restart " + vmid + ". Machine is turned off"}, 200
     else:
-        return '', 404
+        return None, 404
 
 
 @app.route('/api/network/firewall/rules/rule', methods=['GET', 'POST'])
 def firewall_rules():
     '''This either gets all firewall rules or adds a new one'''
     if flask.request.method == 'GET':
-        results = cosmos_processor.get_all_rules()
-
-        # remove the system-defined properties (those that begin with "_")
-        updated_results = []         # new list to hold all of the updated documents
-        for document in results:
-            updated_document = {}        # new dict to hold the results without the system defined properties
-            for key in document.keys():
-                if key[:1] != '_':   # checks to see if first character is "_"
-                    updated_document[key] = document[key]
-            updated_results.append(updated_document)
-
-        return jsonify(updated_results), 200
+        return list_documents(config_cosmos.COSMOSDB_COLLECTION_FW, RULE_FIELDS, processor.get_rules_page, processor.iter_rules,
+                              processor.get_rule_changes)
 
     else:
         # this must be a POST request so want to create a new firewall rule
@@ -166,14 +577,67 @@ def firewall_rules():
         # note that if there isn't a header of content-type = "application/json" in the post request it will 
         # not be interpreted as json regardless of whether it is formatted as such
 
-        if validate_new_rule(post_data):
-            print("passed rule validation")
-            new_fwid = cosmos_processor.add_rule(post_data['name'], post_data['from'], post_data['to'], post_data['action'])
-            return jsonify(new_fwid), 201
-        else:
+        try:
+            new_rule = classes.validation.parse_new_rule(post_data)
+        except ValueError:
             # the data being passed in has failed the validation so return a 400
             return abort(400)
 
+        new_fwid = processor.add_rule(new_rule.name, new_rule.source, new_rule.destination, new_rule.action.value)
+        return jsonify(new_fwid), 201
+
+
+@app.route('/api/network/ipaddresses/<string:ipaddress>', methods=['GET'])
+def ipaddress_owner(ipaddress):
+    '''This returns the VM using an IP address, or 404 if no VM is using it'''
+    try:
+        network = classes.validation.parse_network(ipaddress)
+    except ValueError:
+        return abort(400)
+    if network.version != 4 or network.prefixlen != 32:
+        return abort(400)
+    vmid = current_vm_index().owner(network)
+    if vmid is None:
+        return '', 404
+    return jsonify({"id": ipaddress, "usedby": vmid}), 200
+
+
+@app.route('/api/network/subnets', methods=['GET'])
+def subnets():
+    '''This returns the total, used and free addresses of every subnet and its largest block of free addresses'''
+    return jsonify(processor.get_subnets()), 200
+
+
+@app.route('/api/network/subnets/reconcile', methods=['POST'])
+def reconcile_subnets():
+    '''This checks the subnet counts and bitmaps against the addresses the VMs hold and repairs any drift. It can take
+    a while so it is always run as a job, whose result reports what was found and repaired in each subnet'''
+    return submit_job('reconcile_subnets')
+
+
+@app.route('/api/network/firewall/evaluate', methods=['POST'])
+def evaluate_flows():
+    '''This checks whether each of a batch of flows is allowed by the firewall rules. Each flow has a "from" and a "to"
+    which are IP addresses or vmids. Returns the action and the rule that decided it for each flow in order, or an
+    error for a flow whose address is not valid or whose VM does not exist'''
+    post_data = request.get_json()
+    if not isinstance(post_data, list) or len(post_data) > config_cosmos.MAX_FLOW_BATCH_SIZE:
+        return abort(400)
+    if not all(isinstance(flow, dict) and isinstance(flow.get("from"), str) and isinstance(flow.get("to"), str) for flow in post_data):
+        return abort(400)
+
+    firewall_engine.refresh(processor.get_rule_changes, processor.get_vm_changes)
+    if not firewall_engine.loaded:
+        position = processor.sync_token()    # taken first so that anything written while they are read is applied later
+        firewall_engine.load(position, processor.iter_rules(), processor.iter_vms())
+    results = firewall_engine.evaluate([(flow["from"], flow["to"]) for flow in post_data])
+
+    return jsonify([{"action": action, "rule": fwid} if error is None else {"action": None, "rule": None, "error": error}
+                    for action, fwid, error in results]), 200
+
+
+if config_cosmos.WARM_UP_ON_START:
+    start_warm_up()
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=8080)   # ensures that it doesn't just bind on 127.0.0.1 which is the default
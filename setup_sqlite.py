@@ -0,0 +1,9 @@
+'''
+Creates and loads the SQLite database used when STORAGE_BACKEND = 'sqlite' with the catalogue in seed.json.
+This is the same as running setup.py --backend sqlite
+'''
+
+import classes.seedloader
+
+
+classes.seedloader.load_sqlite(classes.seedloader.read_seed('seed.json'))
@@ -0,0 +1,46 @@
+'''Tests for the Server-Sent Events change stream in main:
+
+    python -m unittest discover tests
+'''
+
+import unittest
+import unittest.mock
+import config_cosmos
+
+config_cosmos.WARM_UP_ON_START = False    # nothing here needs a backend
+import main
+
+
+class ChangeStreamTest(unittest.TestCase):
+
+    def test_delete_in_the_same_second_as_the_create_is_sent(self):
+        created = (100, 'vm', {'id': 'vm-1', 'name': 'one', 'ip': ['10.0.0.1'], 'state': 'on'})
+        deleted = (100, 'vm', {'id': 'vm-1', 'deleted': True})
+        stream = main.stream_changes(100, [created], 0)
+        with unittest.mock.patch.object(main, 'changes_since', return_value=[created, deleted]), \
+                unittest.mock.patch.object(main.change_notifier, 'wait', return_value=0):
+            first = next(stream)
+            second = next(stream)
+            # the create comes back again from the backend but isn't sent again
+            third = next(stream)
+        self.assertIn(b'"name":"one"', first.replace(b' ', b''))
+        self.assertIn(b'"deleted":true', second.replace(b' ', b''))
+        self.assertEqual(third, b': keepalive\n\n')
+
+
+    def test_changes_at_the_last_position_are_not_sent_twice(self):
+        first = (100, 'vm', {'id': 'vm-1', 'deleted': True})
+        second = (101, 'rule', {'id': 'fw-1', 'name': 'rule', 'from': 'vm-2', 'to': '0.0.0.0/0', 'action': 'allow'})
+        stream = main.stream_changes(100, [first], 0)
+        # the backend returns the changes at the position asked for as well as those after it
+        polls = [[first, second], [second]]
+        with unittest.mock.patch.object(main, 'changes_since', side_effect=polls), \
+                unittest.mock.patch.object(main.change_notifier, 'wait', return_value=0):
+            events = [next(stream), next(stream), next(stream)]
+        self.assertIn(b'event: vm', events[0])
+        self.assertIn(b'event: rule', events[1])
+        self.assertEqual(events[2], b': keepalive\n\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+'''Tests for classes.cosmosdbprocessor against stand-ins for Cosmos DB:
+
+    python -m unittest discover tests
+'''
+
+import collections
+import contextlib
+import copy
+import io
+import re
+import threading
+import unittest
+import uuid
+import pydocumentdb.errors as errors
+import config_cosmos
+import classes.cosmosdbprocessor
+from classes.ipallocator import SubnetBitmap
+
+SUBNET = '10.0.0.0/24'
+
+
+class SubnetStore():
+    '''Holds one subnet document. A replace fails with 412 if its If-Match _etag is out of date, and the next
+    failures replaces fail with status instead, as if each call had failed after its write was made'''
+
+    def __init__(self, document):
+        self.document = document
+        self.failures = 0
+        self.status = 503
+        self.conflicts = 0    # replaces that failed with 412
+        self.lock = threading.Lock()
+
+
+    def ReadDocument(self, link, options=None):
+        with self.lock:
+            return copy.deepcopy(self.document)
+
+
+    def ReplaceDocument(self, link, document, options=None):
+        with self.lock:
+            if options and options['accessCondition']['condition'] != self.document['_etag']:
+                self.conflicts += 1
+                raise errors.HTTPFailure(412, 'Precondition Failed')
+            self.document = copy.deepcopy(document)
+            self.document['_etag'] = uuid.uuid4().hex
+            if self.failures:
+                self.failures -= 1
+                raise errors.HTTPFailure(self.status, 'Service Unavailable')
+            return copy.deepcopy(self.document)
+
+
+class PartitionedCollections():
+    '''Holds the documents of collections that are partitioned on /id. As Cosmos DB does, a query that doesn't say it
+    may span partitions fails with 400. Only the listing queries (TOP, c.id > @after, ORDER BY c.id and SELECT VALUE
+    projections) are understood'''
+
+    def __init__(self, documents):
+        self.documents = documents    # collection name -> list of documents
+        self.queries = 0
+
+
+    def ReadCollection(self, link):
+        return {'id': link.split('/')[-1], '_self': link}
+
+
+    def QueryDocuments(self, link, query, options=None):
+        if not (options or {}).get('enableCrossPartitionQuery'):
+            raise errors.HTTPFailure(400, 'Cross partition query is required but disabled')
+        self.queries += 1
+        parameters = {parameter['name']: parameter['value'] for parameter in query.get('parameters', [])}
+        documents = sorted(self.documents[link.split('/')[-1]], key=lambda document: document['id'])
+        if '@after' in parameters:
+            documents = [document for document in documents if document['id'] > parameters['@after']]
+        if '@limit' in parameters:
+            documents = documents[:parameters['@limit']]
+        fields = re.findall(r'c\["(\w+)"\]', query['query'])
+        return iter([{field: document[field] for field in fields} for document in documents])
+
+
+class ListingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_client = classes.cosmosdbprocessor.shared_client
+        vms = [{'id': 'vm-' + str(number), 'name': 'vm' + str(number), 'ip': ['10.0.0.' + str(number)], 'state': 'on'}
+               for number in range(1, 26)]
+        rules = [{'id': 'fw-' + str(number), 'name': 'rule', 'from': '10.0.0.0/24', 'to': '0.0.0.0/0', 'action': 'allow'}
+                 for number in range(1, 6)]
+        self.store = classes.cosmosdbprocessor.shared_client = PartitionedCollections(
+            {config_cosmos.COSMOSDB_COLLECTION_VM: vms, config_cosmos.COSMOSDB_COLLECTION_FW: rules})
+        self.processor = classes.cosmosdbprocessor.Processor()
+
+
+    def tearDown(self):
+        classes.cosmosdbprocessor.shared_client = self.saved_client
+        self.processor.executor.shutdown()
+
+
+    def test_pages_span_partitions(self):
+        pages = list()
+        cursor = None
+        while True:
+            documents, cursor = self.processor.get_vms_page(10, cursor)
+            pages.append([document['id'] for document in documents])
+            if cursor is None:
+                break
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sorted(sum(pages, [])), sorted('vm-' + str(number) for number in range(1, 26)))
+        self.assertEqual(len(set(sum(pages, []))), 25)
+
+
+    def test_projected_page(self):
+        documents, cursor = self.processor.get_rules_page(3, None, ('name',))
+        self.assertEqual(documents, [{'name': 'rule'}] * 3)
+        self.assertIsNotNone(cursor)
+
+
+    def test_full_listings_span_partitions(self):
+        self.assertEqual(len(list(self.processor.iter_vms())), 25)
+        self.assertEqual(len(list(self.processor.iter_rules())), 5)
+
+
+class UpdateSubnetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_client = classes.cosmosdbprocessor.shared_client
+        document = SubnetBitmap(SUBNET).to_document({'id': 'subnet', 'subnet': SUBNET, '_self': 'subnet', '_etag': '1'})
+        self.store = classes.cosmosdbprocessor.shared_client = SubnetStore(document)
+        self.processors = [self.processor(), self.processor()]    # as if in two workers
+
+
+    def tearDown(self):
+        classes.cosmosdbprocessor.shared_client = self.saved_client
+        for processor in self.processors:
+            processor.executor.shutdown()
+
+
+    def processor(self):
+        processor = classes.cosmosdbprocessor.Processor()
+        processor.allocator.load(self.store.ReadDocument('subnet'))
+        processor.subnets_loaded = True
+        return processor
+
+
+    def saved_bitmap(self):
+        return SubnetBitmap.from_document(self.store.document)
+
+
+    def test_concurrent_allocations_are_unique(self):
+        allocated = list()
+        failures = list()
+
+        def allocate(processor):
+            for i in range(10):
+                try:
+                    allocated.extend(processor.update_subnet(SUBNET, lambda bitmap: bitmap.allocate(1)))
+                except Exception as e:
+                    failures.append(e)
+
+        # four threads in each of the two processes
+        threads = [threading.Thread(target=allocate, args=(processor,)) for processor in self.processors * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertEqual(len(allocated), 80)
+        self.assertEqual(len(set(allocated)), 80)
+        saved = self.saved_bitmap()
+        self.assertEqual(saved.used, 80)
+        self.assertEqual(saved.count_used(), 80)
+        self.assertEqual(sorted(saved.used_offsets()), sorted(set(saved.used_offsets())))
+
+
+    def test_conflict_is_retried_against_the_latest_bitmap(self):
+        first, second = self.processors
+        taken = first.update_subnet(SUBNET, lambda bitmap: bitmap.allocate(1))
+        # second still holds the bitmap from before, so its write fails with 412 and is made again
+        again = second.update_subnet(SUBNET, lambda bitmap: bitmap.allocate(1))
+        self.assertNotEqual(taken, again)
+        self.assertEqual(self.saved_bitmap().used, 2)
+        self.assertEqual(second.allocator.get(SUBNET).used, 2)
+
+
+    def test_reserve_addresses_retries_on_stale_etag(self):
+        first, second = self.processors
+        taken = first.reserve_addresses(collections.Counter({SUBNET: 3}))[SUBNET]
+        reserved = second.reserve_addresses(collections.Counter({SUBNET: 2}))[SUBNET]
+        self.assertEqual(self.store.conflicts, 1)
+        self.assertEqual(reserved, ['10.0.0.4', '10.0.0.5'])
+        self.assertFalse(set(taken) & set(reserved))
+        self.assertEqual(self.saved_bitmap().used, 5)
+
+
+    def test_reserve_and_release_addresses_round_trip(self):
+        first, second = self.processors
+        reserved = first.reserve_addresses(collections.Counter({SUBNET: 4, '192.168.0.0/24': 1}))
+        self.assertEqual(list(reserved), [SUBNET])    # subnets that don't exist are left out
+        second.release_addresses(reserved[SUBNET][1:3] + ['192.168.0.1'])
+        saved = self.saved_bitmap()
+        self.assertEqual((saved.used, saved.count_used()), (2, 2))
+        self.assertEqual(first.reserve_addresses(collections.Counter({SUBNET: 2}))[SUBNET], reserved[SUBNET][1:3])
+
+
+    def test_reserve_from_a_full_subnet(self):
+        processor = self.processors[0]
+        self.assertEqual(len(processor.reserve_addresses(collections.Counter({SUBNET: 300}))[SUBNET]), 254)
+        self.assertEqual(processor.reserve_addresses(collections.Counter({SUBNET: 1}))[SUBNET], [])
+        self.assertEqual(self.saved_bitmap().used, 254)
+
+
+    def test_nothing_is_written_when_no_addresses_are_taken(self):
+        processor = self.processors[0]
+        processor.reserve_addresses(collections.Counter({SUBNET: 254}))
+        etag = self.store.document['_etag']
+        self.assertEqual(processor.reserve_addresses(collections.Counter({SUBNET: 1}))[SUBNET], [])
+        self.assertEqual(self.store.document['_etag'], etag)
+        self.assertEqual(self.store.conflicts, 0)
+
+
+    def test_subnet_that_looks_full_is_reread(self):
+        first, second = self.processors
+        taken = first.reserve_addresses(collections.Counter({SUBNET: 254}))[SUBNET]
+        second.reload_subnet('subnet')
+        first.release_addresses(taken[:1])
+        # second still holds the full bitmap
+        self.assertEqual(second.reserve_addresses(collections.Counter({SUBNET: 1}))[SUBNET], taken[:1])
+        self.assertEqual(self.store.conflicts, 0)
+
+
+    def test_failed_write_leaves_no_reservation_behind(self):
+        processor = self.processors[0]
+        self.store.failures = 1
+        self.store.status = 500
+        with self.assertRaises(errors.HTTPFailure):
+            processor.update_subnet(SUBNET, lambda bitmap: bitmap.allocate(1))
+        # the write was made before the call failed, so what is held is reread rather than guessed
+        self.assertEqual(processor.allocator.get(SUBNET).used, self.saved_bitmap().used)
+        self.assertEqual(processor.allocator.documents[SUBNET]['_etag'], self.store.document['_etag'])
+        processor.update_subnet(SUBNET, lambda bitmap: bitmap.allocate(1))
+        self.assertEqual(self.saved_bitmap().count_used(), 2)
+
+
+    def test_change_is_not_applied_to_the_held_bitmap_until_saved(self):
+        processor = self.processors[0]
+        held = processor.allocator.get(SUBNET)
+
+        def change(bitmap):
+            self.assertIsNot(bitmap, held)
+            return bitmap.allocate(1)
+
+        processor.update_subnet(SUBNET, change)
+        self.assertEqual(held.used, 0)
+        self.assertEqual(processor.allocator.get(SUBNET).used, 1)
+
+
+    def test_release_after_commit_only_logs_a_failure(self):
+        processor = self.processors[0]
+        reserved = processor.reserve_addresses(collections.Counter({SUBNET: 1}))[SUBNET]
+        self.store.failures = 1
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            processor.release_after_commit(reserved)
+        self.assertIn("unable to release 10.0.0.1", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+'''Tests for the compiled firewall rules in classes.firewallengine:
+
+    python -m unittest discover tests
+'''
+
+import unittest
+import unittest.mock
+import config_cosmos
+from classes.baseprocessor import SyncTokenExpired
+from classes.firewallengine import FirewallEngine
+
+VMS = config_cosmos.COSMOSDB_COLLECTION_VM
+RULES = config_cosmos.COSMOSDB_COLLECTION_FW
+
+
+def rule(number, source, destination, action):
+    return {'id': 'fw-' + str(number), 'name': 'rule' + str(number), 'from': source, 'to': destination, 'action': action}
+
+
+def vm(number, *ipaddresses):
+    return {'id': 'vm-' + str(number), 'name': 'vm' + str(number), 'ip': list(ipaddresses), 'state': 'on'}
+
+
+class FirewallEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FirewallEngine()
+        self.engine.load(10, [
+            rule(1, '0.0.0.0/0', '0.0.0.0/0', 'deny'),
+            rule(2, '10.0.0.0/8', '0.0.0.0/0', 'allow'),
+            rule(3, '10.1.0.0/16', '192.168.1.0/24', 'deny'),
+            rule(4, '10.1.2.0/24', '192.168.0.0/16', 'allow'),    # as specific as rule 5, which comes later
+            rule(5, '10.1.0.0/16', '192.168.0.0/24', 'deny'),
+            rule(6, 'vm-1', '172.16.0.0/12', 'allow'),
+        ], [vm(1, '10.5.0.1', '10.5.0.2'), vm(2, '10.6.0.1')])
+
+
+    def check(self, source, destination):
+        action, fwid, error = self.engine.evaluate([(source, destination)])[0]
+        self.assertIsNone(error)
+        return action, fwid
+
+
+    def test_most_specific_rule_wins(self):
+        self.assertEqual(self.check('10.9.9.9', '8.8.8.8'), ('allow', 'fw-2'))
+        self.assertEqual(self.check('10.1.9.9', '192.168.1.1'), ('deny', 'fw-3'))
+        self.assertEqual(self.check('11.0.0.1', '8.8.8.8'), ('deny', 'fw-1'))
+
+
+    def test_tie_goes_to_the_earliest_rule(self):
+        # /24 + /16 and /16 + /24 are as specific as each other
+        self.assertEqual(self.check('10.1.2.3', '192.168.0.1'), ('allow', 'fw-4'))
+
+
+    def test_no_matching_rule_is_denied(self):
+        engine = FirewallEngine()
+        engine.load(0, [rule(1, '10.0.0.0/8', '10.0.0.0/8', 'allow')], [])
+        self.assertEqual(engine.evaluate([('11.0.0.1', '10.0.0.1')]), [('deny', None, None)])
+
+
+    def test_rule_networks_are_masked(self):
+        engine = FirewallEngine()
+        engine.load(0, [rule(1, '10.0.0.77/24', '10.1.0.0/16', 'allow')], [])
+        self.assertEqual(engine.evaluate([('10.0.0.1', '10.1.2.3')]), [('allow', 'fw-1', None)])
+
+
+    def test_vmids_expand_to_every_address(self):
+        self.assertEqual(self.check('10.5.0.2', '172.16.1.1'), ('allow', 'fw-6'))
+        self.assertEqual(self.check('vm-1', '172.16.1.1'), ('allow', 'fw-6'))
+        # vm-2 is only allowed by the 10.0.0.0/8 rule
+        self.assertEqual(self.check('vm-2', '172.16.1.1'), ('allow', 'fw-2'))
+
+
+    def test_vm_flow_needs_every_address_allowed(self):
+        self.engine.load(10, [rule(1, '10.5.0.1/32', '0.0.0.0/0', 'allow')], [vm(1, '10.5.0.1', '10.5.0.2')])
+        self.assertEqual(self.check('vm-1', '8.8.8.8'), ('deny', None))
+
+
+    def test_bad_endpoints_are_reported_per_flow(self):
+        results = self.engine.evaluate([('vm-99', '8.8.8.8'), ('10.9.9.9', '8.8.8.8'), ('nonsense', '8.8.8.8')])
+        self.assertEqual(results[0], (None, None, 'Unknown VM vm-99'))
+        self.assertEqual(results[1], ('allow', 'fw-2', None))
+        self.assertEqual(results[2][:2], (None, None))
+        self.assertIn('nonsense', results[2][2])
+
+
+    def test_ipv6_rules_never_match(self):
+        self.engine.handle_change(RULES, 'created', rule(7, '2001:db8::/64', '0.0.0.0/0', 'allow'))
+        self.assertEqual(self.check('11.0.0.1', '8.8.8.8'), ('deny', 'fw-1'))
+
+
+    def test_rule_created(self):
+        self.engine.handle_change(RULES, 'created', rule(7, '10.9.0.0/16', '8.8.8.8/32', 'deny'))
+        self.assertEqual(self.check('10.9.9.9', '8.8.8.8'), ('deny', 'fw-7'))
+        self.assertEqual(self.check('10.8.9.9', '8.8.8.8'), ('allow', 'fw-2'))
+
+
+    def test_rule_deleted(self):
+        self.engine.handle_change(RULES, 'deleted', {'id': 'fw-4'})
+        self.assertEqual(self.check('10.1.2.3', '192.168.0.1'), ('deny', 'fw-5'))
+        self.engine.handle_change(RULES, 'deleted', {'id': 'fw-5'})
+        self.assertEqual(self.check('10.1.2.3', '192.168.0.1'), ('allow', 'fw-2'))
+
+
+    def test_vm_created_and_deleted(self):
+        self.engine.handle_change(RULES, 'created', rule(7, 'vm-3', '8.8.8.8/32', 'deny'))
+        self.assertEqual(self.check('10.7.0.1', '8.8.8.8'), ('allow', 'fw-2'))
+        self.engine.handle_change(VMS, 'created', vm(3, '10.7.0.1'))
+        self.assertEqual(self.check('10.7.0.1', '8.8.8.8'), ('deny', 'fw-7'))
+        self.engine.handle_change(VMS, 'deleted', {'id': 'vm-3'})
+        self.assertEqual(self.check('10.7.0.1', '8.8.8.8'), ('allow', 'fw-2'))
+        self.assertEqual(self.engine.evaluate([('vm-3', '8.8.8.8')])[0][2], 'Unknown VM vm-3')
+
+
+    def test_vm_addresses_changed(self):
+        self.engine.handle_change(VMS, 'created', vm(1, '10.5.0.9'))
+        self.assertEqual(self.check('10.5.0.1', '172.16.1.1'), ('allow', 'fw-2'))
+        self.assertEqual(self.check('10.5.0.9', '172.16.1.1'), ('allow', 'fw-6'))
+
+
+    def test_changes_applied_twice(self):
+        created = rule(7, '10.9.0.0/16', '8.8.8.8/32', 'deny')
+        self.engine.handle_change(RULES, 'created', created)
+        self.engine.handle_change(RULES, 'created', created)
+        self.engine.handle_change(RULES, 'deleted', {'id': 'fw-7'})
+        self.assertEqual(self.check('10.9.9.9', '8.8.8.8'), ('allow', 'fw-2'))
+
+
+    def test_refresh_applies_changes_from_other_workers(self):
+        rule_changes = [(11, rule(7, '10.9.0.0/16', '8.8.8.8/32', 'deny')), (12, {'id': 'fw-6', 'deleted': True})]
+        vm_changes = [(13, {'id': 'vm-2', 'deleted': True})]
+        get_rule_changes = unittest.mock.Mock(return_value=rule_changes)
+        get_vm_changes = unittest.mock.Mock(return_value=vm_changes)
+        with unittest.mock.patch.object(config_cosmos, 'FIREWALL_REFRESH', 0):
+            self.engine.refresh(get_rule_changes, get_vm_changes)
+        get_rule_changes.assert_called_once_with(10)
+        get_vm_changes.assert_called_once_with(10)
+        self.assertEqual(self.check('10.9.9.9', '8.8.8.8'), ('deny', 'fw-7'))
+        self.assertEqual(self.check('vm-1', '172.16.1.1'), ('allow', 'fw-2'))
+        self.assertEqual(self.engine.evaluate([('vm-2', '8.8.8.8')])[0][2], 'Unknown VM vm-2')
+        self.assertEqual(self.engine.positions, {RULES: 12, VMS: 13})
+
+
+    def test_refresh_waits_for_the_interval(self):
+        get_changes = unittest.mock.Mock(return_value=[])
+        with unittest.mock.patch.object(config_cosmos, 'FIREWALL_REFRESH', 60):
+            self.engine.refresh(get_changes, get_changes)
+        get_changes.assert_not_called()
+
+
+    def test_expired_changes_mark_it_for_reloading(self):
+        with unittest.mock.patch.object(config_cosmos, 'FIREWALL_REFRESH', 0):
+            self.engine.refresh(unittest.mock.Mock(side_effect=SyncTokenExpired()), unittest.mock.Mock(return_value=[]))
+        self.assertFalse(self.engine.loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
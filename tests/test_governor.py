@@ -0,0 +1,176 @@
+'''Tests for classes.governor, run through classes.throttlesimulator as they would be with COSMOSDB_SIMULATED_THROUGHPUT:
+
+    python -m unittest discover tests
+'''
+
+import io
+import threading
+import time
+import unittest
+import unittest.mock
+import requests
+import requests.adapters
+import config_cosmos
+from classes.governor import Governor, GovernedAdapter, Overloaded
+from classes.throttlesimulator import ThrottlingTransport
+
+
+class StubTransport(requests.adapters.BaseAdapter):
+    '''Stands in for Cosmos DB. Every call costs charge request units and is answered with status'''
+
+    def __init__(self, charge, status=200, retry_after_ms=None):
+        requests.adapters.BaseAdapter.__init__(self)
+        self.charge = charge
+        self.status = status
+        self.retry_after_ms = retry_after_ms
+        self.sent = list()
+        self.lock = threading.Lock()
+
+
+    def send(self, request, **kwargs):
+        with self.lock:
+            self.sent.append(request.method)
+        response = requests.Response()
+        response.status_code = self.status
+        response.headers['x-ms-request-charge'] = str(self.charge)
+        if self.retry_after_ms is not None:
+            response.headers['x-ms-retry-after-ms'] = str(self.retry_after_ms)
+        response._content = b'{}'
+        response.raw = io.BytesIO(response._content)
+        response.request = request
+        return response
+
+
+    def close(self):
+        pass
+
+
+def read_request():
+    return requests.Request('GET', 'https://localhost/dbs/db/colls/coll/docs/1').prepare()
+
+
+def write_request():
+    return requests.Request('PUT', 'https://localhost/dbs/db/colls/coll/docs/1', data='{}').prepare()
+
+
+class GovernedAdapterTest(unittest.TestCase):
+
+    def adapter(self, stub, throughput, max_limit=8, read_wait=0.2, write_wait=5):
+        '''Returns a GovernedAdapter whose governor and simulated account both have throughput RU/s'''
+        self.governor = Governor(throughput, max_limit, read_wait, write_wait)
+        self.simulator = ThrottlingTransport(stub, throughput)
+        return GovernedAdapter(self.governor, self.simulator)
+
+
+    def test_call_within_throughput(self):
+        stub = StubTransport(charge=1)
+        adapter = self.adapter(stub, 100)
+        for i in range(10):
+            self.assertEqual(adapter.send(read_request()).status_code, 200)
+        self.assertEqual(len(stub.sent), 10)
+        self.assertEqual(self.simulator.throttled, 0)
+        self.assertEqual(self.governor.throttled, 0)
+
+
+    def test_reads_shed_before_writes(self):
+        # the first write leaves the bucket half a second in debt, which is longer than a read may wait
+        stub = StubTransport(charge=150)
+        adapter = self.adapter(stub, 100, read_wait=0.2, write_wait=5)
+        adapter.send(write_request())
+        with self.assertRaises(Overloaded) as raised:
+            adapter.send(read_request())
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertEqual(adapter.send(write_request()).status_code, 200)
+        self.assertEqual(stub.sent, ['PUT', 'PUT'])
+        self.assertEqual(self.governor.shed, {'read': 1, 'write': 0})
+        self.assertEqual(self.simulator.throttled, 0)
+
+
+    def test_waiting_writes_go_first(self):
+        stub = StubTransport(charge=150)
+        adapter = self.adapter(stub, 100, max_limit=1, read_wait=5, write_wait=5)
+        adapter.send(read_request())
+        # both now wait for the bucket, and the read was asked for first
+        reader = threading.Thread(target=adapter.send, args=(read_request(),))
+        reader.start()
+        time.sleep(0.1)
+        adapter.send(write_request())
+        reader.join()
+        self.assertEqual(stub.sent, ['GET', 'PUT', 'GET'])
+
+
+    def test_throttled_call_is_retried_and_halves_the_limit(self):
+        # the governor has no bucket so only finds out about the throughput from the simulated 429
+        stub = StubTransport(charge=110)
+        self.governor = Governor(None, 8, 0.2, 5)
+        self.simulator = ThrottlingTransport(stub, 100)
+        adapter = GovernedAdapter(self.governor, self.simulator)
+        adapter.send(write_request())
+        start = time.monotonic()
+        self.assertEqual(adapter.send(write_request()).status_code, 200)
+        # waited out the x-ms-retry-after-ms that the simulator sent
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(self.simulator.throttled, 1)
+        self.assertEqual((self.governor.throttled, self.governor.retries), (1, 1))
+        self.assertEqual(int(self.governor.limit), 4)
+        self.assertEqual(len(stub.sent), 2)
+
+
+    def test_retries_are_capped_by_count(self):
+        stub = StubTransport(charge=0, status=429, retry_after_ms=5)
+        adapter = self.adapter(stub, 100)
+        with unittest.mock.patch.object(config_cosmos, 'COSMOSDB_MAX_RETRIES', 3):
+            with self.assertRaises(Overloaded):
+                adapter.send(write_request())
+        self.assertEqual(len(stub.sent), 4)
+        self.assertEqual((self.governor.throttled, self.governor.retries), (4, 3))
+
+
+    def test_retries_are_capped_by_wait(self):
+        # the first call leaves the simulated account in debt for far longer than COSMOSDB_MAX_RETRY_WAIT
+        stub = StubTransport(charge=10 * 60)
+        adapter = self.adapter(stub, 10)
+        self.governor.throughput = None    # so that only the simulator knows
+        adapter.send(write_request())
+        start = time.monotonic()
+        with self.assertRaises(Overloaded) as raised:
+            adapter.send(write_request())
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertGreater(raised.exception.retry_after, config_cosmos.COSMOSDB_MAX_RETRY_WAIT)
+        self.assertEqual((self.governor.throttled, self.governor.retries), (1, 0))
+        self.assertEqual(len(stub.sent), 1)
+
+
+class GovernorTest(unittest.TestCase):
+
+    def test_calls_throttled_together_halve_the_limit_once(self):
+        governor = Governor(None, 8, 1, 1)
+        governor.acquire(False)
+        governor.acquire(False)
+        governor.release(retry_after=0.01)
+        governor.release(retry_after=0.01)
+        self.assertEqual(governor.limit, 4)
+        self.assertEqual(governor.throttled, 2)
+
+
+    def test_limit_grows_back(self):
+        governor = Governor(None, 8, 1, 1)
+        governor.limit = 2.0
+        for i in range(40):
+            with governor.call(False):
+                pass
+        self.assertEqual(governor.limit, 8)
+
+
+    def test_limit_never_below_one(self):
+        governor = Governor(None, 8, 1, 1)
+        for i in range(5):
+            governor.acquire(True)
+            governor.paused_until = 0.0
+            governor.release(retry_after=0.0)
+        self.assertEqual(governor.limit, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+'''Tests for the subnet bitmaps in classes.ipallocator:
+
+    python -m unittest discover tests
+'''
+
+import unittest
+from classes.ipallocator import SubnetBitmap, IPAllocator, build_bitmap, reconcile
+
+
+class SubnetBitmapTest(unittest.TestCase):
+
+    def test_usable_addresses(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        self.assertEqual(bitmap.size, 254)
+        self.assertEqual(bitmap.address(0), '10.0.0.1')
+        self.assertEqual(bitmap.address(253), '10.0.0.254')
+        self.assertIn('10.0.0.1', bitmap)
+        self.assertNotIn('10.0.0.0', bitmap)
+        self.assertNotIn('10.0.0.255', bitmap)
+        self.assertNotIn('10.0.1.1', bitmap)
+
+
+    def test_find_free_does_not_reserve(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        self.assertEqual(bitmap.find_free(3), [0, 1, 2])
+        self.assertEqual(bitmap.find_free(3), [0, 1, 2])
+        self.assertEqual(bitmap.used, 0)
+
+
+    def test_find_free_skips_used_addresses(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        bitmap.reserve(list(range(0, 20)) + [21, 23])
+        self.assertEqual(bitmap.find_free(3), [20, 22, 24])
+
+
+    def test_find_free_ignores_the_padding_bits(self):
+        # a /29 has 6 usable addresses so the last 2 bits of its byte aren't addresses
+        bitmap = SubnetBitmap('10.0.0.0/29')
+        bitmap.reserve(range(5))
+        self.assertEqual(bitmap.find_free(1), [5])
+        self.assertEqual(bitmap.find_free(2), [])
+
+
+    def test_allocate_and_release_round_trip(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        first = bitmap.allocate(10)
+        self.assertEqual(first, ['10.0.0.' + str(number) for number in range(1, 11)])
+        self.assertEqual((bitmap.used, bitmap.count_used()), (10, 10))
+        bitmap.release([bitmap.offset(ipaddress) for ipaddress in first[2:5]])
+        self.assertEqual((bitmap.used, bitmap.count_used()), (7, 7))
+        # the freed addresses are the first ones handed out again
+        self.assertEqual(bitmap.allocate(4), ['10.0.0.3', '10.0.0.4', '10.0.0.5', '10.0.0.11'])
+        self.assertEqual((bitmap.used, bitmap.count_used()), (11, 11))
+
+
+    def test_reserve_and_release_are_idempotent(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        bitmap.reserve([5, 5])
+        bitmap.reserve([5])
+        self.assertEqual(bitmap.used, 1)
+        bitmap.release([5, 5])
+        bitmap.release([6])
+        self.assertEqual(bitmap.used, 0)
+
+
+    def test_full_subnet(self):
+        bitmap = SubnetBitmap('10.0.0.0/28')
+        self.assertEqual(len(bitmap.allocate(14)), 14)
+        self.assertEqual(bitmap.free(), 0)
+        self.assertEqual(bitmap.allocate(1), [])
+        self.assertEqual(bitmap.used, 14)
+        self.assertIsNone(bitmap.capacity()['largest_free_block'])
+        bitmap.release([7])
+        self.assertEqual(bitmap.allocate(1), ['10.0.0.8'])
+
+
+    def test_more_than_is_free(self):
+        bitmap = SubnetBitmap('10.0.0.0/29')
+        bitmap.allocate(4)
+        # nothing is reserved unless all of them can be
+        self.assertEqual(bitmap.allocate(3), [])
+        self.assertEqual(bitmap.used, 4)
+
+
+    def test_subnets_without_usable_addresses(self):
+        for subnet in ('10.0.0.0/31', '10.0.0.1/32'):
+            bitmap = SubnetBitmap(subnet)
+            self.assertEqual(bitmap.size, 0)
+            self.assertEqual(bitmap.find_free(1), [])
+            self.assertEqual(bitmap.allocate(1), [])
+            self.assertEqual(bitmap.allocate(0), [])
+            self.assertEqual(bitmap.capacity(), {'subnet': subnet, 'total': 0, 'used': 0, 'free': 0, 'largest_free_block': None})
+            self.assertEqual(SubnetBitmap.from_document(bitmap.to_document({'subnet': subnet})).size, 0)
+
+
+    def test_used_count_out_of_step_with_the_bits(self):
+        bitmap = SubnetBitmap('10.0.0.0/29')
+        bitmap.reserve(range(6))
+        bitmap.used = 3
+        self.assertEqual(bitmap.find_free(1), [])
+
+
+    def test_document_round_trip(self):
+        bitmap = SubnetBitmap('10.0.0.0/23')
+        bitmap.allocate(300)
+        loaded = SubnetBitmap.from_document(bitmap.to_document({'subnet': '10.0.0.0/23'}))
+        self.assertEqual(loaded.used, 300)
+        self.assertEqual(loaded.used_offsets(), bitmap.used_offsets())
+        self.assertIsNone(SubnetBitmap.from_document({'subnet': '10.0.0.0/23'}))
+
+
+    def test_copy_is_independent(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        changed = bitmap.copy()
+        changed.allocate(2)
+        self.assertEqual(bitmap.used, 0)
+        self.assertEqual(bitmap.find_free(1), [0])
+
+
+    def test_largest_free_block(self):
+        bitmap = SubnetBitmap('10.0.0.0/28')
+        bitmap.reserve([0, 3, 10])
+        self.assertEqual(bitmap.largest_free(), (4, 6))
+        bitmap.reserve([6])
+        # the first of the blocks that are equally large
+        self.assertEqual(bitmap.largest_free(), (7, 3))
+        bitmap.release([3])
+        self.assertEqual(bitmap.largest_free(), (1, 5))
+
+
+class AllocatorTest(unittest.TestCase):
+
+    def test_group_by_subnet(self):
+        allocator = IPAllocator()
+        for subnet in ('10.0.0.0/24', '10.0.1.0/24'):
+            allocator.load(SubnetBitmap(subnet).to_document({'subnet': subnet}))
+        grouped = allocator.group_by_subnet(['10.0.0.5', '10.0.1.1', '10.0.0.6', '192.168.0.1'])
+        self.assertEqual(grouped, {'10.0.0.0/24': [4, 5], '10.0.1.0/24': [0]})
+
+
+    def test_build_bitmap(self):
+        bitmap = build_bitmap('10.0.0.0/24', ['10.0.0.1', '10.0.0.10', '10.0.5.1'])
+        self.assertEqual(bitmap.used_offsets(), {0, 9})
+        self.assertEqual(bitmap.used, 2)
+
+
+    def test_reconcile(self):
+        bitmap = SubnetBitmap('10.0.0.0/24')
+        bitmap.reserve([0, 1, 2])
+        bitmap.used = 5
+        report = reconcile(bitmap, held=[0, 3], confirmed=['10.0.0.2'])
+        self.assertEqual(report['missing'], ['10.0.0.4'])
+        self.assertEqual(report['leaked'], ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(report['freed'], ['10.0.0.2'])
+        self.assertTrue(report['repaired'])
+        self.assertEqual(bitmap.used_offsets(), {0, 2, 3})
+        self.assertEqual(bitmap.used, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
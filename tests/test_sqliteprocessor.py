@@ -0,0 +1,159 @@
+'''Tests for the SQLite backend in classes.sqliteprocessor, against a database in a temporary directory:
+
+    python -m unittest discover tests
+'''
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock
+import config_cosmos
+import classes.seedloader
+import classes.sqliteprocessor
+from classes.baseprocessor import SyncTokenExpired
+
+CATALOGUE = {
+    'subnets': ['10.0.0.0/29', '10.1.0.0/24'],
+    'vms': [{'id': 'vm-1', 'name': 'one', 'ip': ['10.0.0.1'], 'state': 'on'},
+            {'id': 'vm-2', 'name': 'two', 'ip': ['10.0.0.2', '10.1.0.1'], 'state': 'off'}],
+    'rules': [{'id': 'fw-1', 'name': 'rule', 'from': '0.0.0.0/0', 'to': 'vm-1', 'action': 'allow'}]}
+
+
+class SQLiteProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'test.db')
+        classes.seedloader.load_sqlite(CATALOGUE, self.database)
+        self.processor = classes.sqliteprocessor.Processor(self.database)
+        self.notifications = list()
+        self.processor.add_listener(lambda collection, change, document: self.notifications.append((change, document['id'])))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def subnet(self, subnet):
+        return next(capacity for capacity in self.processor.get_subnets() if capacity['subnet'] == subnet)
+
+
+    def test_seeded(self):
+        self.assertEqual(sorted(vm['id'] for vm in self.processor.get_all_vms()), ['vm-1', 'vm-2'])
+        self.assertEqual(self.processor.get_all_rules(), CATALOGUE['rules'])
+        self.assertEqual(self.subnet('10.0.0.0/29')['used'], 2)
+        self.assertEqual(self.processor.restart_vm('vm-1'), 'success')
+        self.assertEqual(self.processor.restart_vm('vm-2'), 'off')
+        self.assertEqual(self.processor.restart_vm('vm-9'), 'notfound')
+
+
+    def test_add_vm(self):
+        vmid = self.processor.add_vm('three', ['10.0.0.0/29', '10.1.0.0/24'])
+        self.assertEqual(vmid, 'vm-3')    # carries on from the seeded vmids
+        vm = next(vm for vm in self.processor.get_all_vms() if vm['id'] == vmid)
+        self.assertEqual(vm, {'id': vmid, 'name': 'three', 'ip': ['10.0.0.3', '10.1.0.2'], 'state': 'off'})
+        self.assertEqual(self.subnet('10.0.0.0/29')['used'], 3)
+        self.assertEqual(self.notifications, [('created', vmid)])
+
+
+    def test_add_vm_to_a_missing_or_full_subnet(self):
+        self.assertFalse(self.processor.add_vm('nowhere', ['192.168.0.0/24']))
+        for number in range(4):
+            self.assertTrue(self.processor.add_vm('fill', ['10.0.0.0/29']))
+        # the /29 has 6 addresses, and a VM that can't have all of its addresses takes none of them
+        self.assertFalse(self.processor.add_vm('full', ['10.1.0.0/24', '10.0.0.0/29']))
+        self.assertEqual(self.subnet('10.0.0.0/29')['used'], 6)
+        self.assertEqual(self.subnet('10.1.0.0/24')['used'], 1)
+
+
+    def test_add_vms(self):
+        results = self.processor.add_vms([('a', ['10.0.0.0/29']), ('b', ['10.0.0.0/29', '10.0.0.0/29']),
+                                          ('c', ['10.0.0.0/29', '10.0.0.0/29']), ('d', ['10.1.0.0/24'])])
+        # only 4 addresses were free in the /29, so c fails and what it would have had is released
+        self.assertEqual([bool(result) for result in results], [True, True, False, True])
+        vms = {vm['id']: vm for vm in self.processor.get_all_vms()}
+        self.assertEqual(vms[results[1]]['ip'], ['10.0.0.4', '10.0.0.5'])
+        self.assertEqual(self.subnet('10.0.0.0/29')['used'], 5)
+        self.assertEqual(len({ipaddress for vm in vms.values() for ipaddress in vm['ip']}),
+                         sum(len(vm['ip']) for vm in vms.values()))
+
+
+    def test_delete_vm(self):
+        self.assertTrue(self.processor.delete_vm('vm-2'))
+        self.assertFalse(self.processor.delete_vm('vm-2'))
+        self.assertEqual([vm['id'] for vm in self.processor.get_all_vms()], ['vm-1'])
+        self.assertEqual(self.subnet('10.0.0.0/29')['used'], 1)
+        self.assertEqual(self.subnet('10.1.0.0/24')['used'], 0)
+        self.assertEqual(self.notifications, [('deleted', 'vm-2')])
+        # its addresses are handed out again
+        vmid = self.processor.add_vm('again', ['10.0.0.0/29'])
+        self.assertEqual(next(vm for vm in self.processor.get_all_vms() if vm['id'] == vmid)['ip'], ['10.0.0.2'])
+
+
+    def test_pages_follow_insertion_order(self):
+        vmids = self.processor.add_vms([('vm' + str(number), ['10.1.0.0/24']) for number in range(7)])
+        pages = list()
+        cursor = None
+        while True:
+            documents, cursor = self.processor.get_vms_page(3, cursor, ('id',))
+            pages.append([document['id'] for document in documents])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [['vm-1', 'vm-2', vmids[0]], vmids[1:4], vmids[4:7], []])
+
+
+    def test_page_cursor_survives_deletes(self):
+        self.processor.add_vms([('vm' + str(number), ['10.1.0.0/24']) for number in range(3)])
+        first, cursor = self.processor.get_vms_page(2)
+        self.processor.delete_vm(first[-1]['id'])
+        self.processor.delete_vm('vm-3')
+        rest, cursor = self.processor.get_vms_page(10, cursor, ('id', 'name'))
+        self.assertEqual(rest, [{'id': 'vm-4', 'name': 'vm1'}, {'id': 'vm-5', 'name': 'vm2'}])
+        self.assertIsNone(cursor)
+
+
+    def test_changes_since(self):
+        position = self.processor.sync_token()
+        self.assertEqual(self.processor.get_vm_changes(position), [])
+        vmid = self.processor.add_vm('three', ['10.1.0.0/24'])
+        self.processor.delete_vm('vm-1')
+        fwid = self.processor.add_rule('new', '10.0.0.0/8', vmid, 'deny')
+        changes = self.processor.get_vm_changes(position)
+        self.assertEqual([document['id'] for change_position, document in changes], [vmid, 'vm-1'])
+        self.assertEqual(changes[1][1], {'id': 'vm-1', 'deleted': True})
+        self.assertLess(changes[0][0], changes[1][0])
+        self.assertEqual([document['id'] for change_position, document in self.processor.get_rule_changes(position)], [fwid])
+        self.assertEqual(self.processor.sync_token(), self.processor.get_rule_changes(position)[-1][0])
+        # a VM that is deleted after being created is only reported as deleted
+        self.processor.delete_vm(vmid)
+        self.assertEqual(self.processor.get_vm_changes(position)[-2:],
+                         [(changes[1][0], {'id': 'vm-1', 'deleted': True}), (self.processor.sync_token(), {'id': vmid, 'deleted': True})])
+
+
+    def test_projected_changes(self):
+        position = self.processor.sync_token()
+        vmid = self.processor.add_vm('three', ['10.1.0.0/24'])
+        self.assertEqual(self.processor.get_vm_changes(position, ('id', 'name')), [(self.processor.sync_token(), {'id': vmid, 'name': 'three'})])
+
+
+    def test_expired_tombstones(self):
+        position = self.processor.sync_token()
+        self.processor.delete_vm('vm-1')
+        with unittest.mock.patch.object(config_cosmos, 'SYNC_RETENTION', -1):
+            self.processor.delete_vm('vm-2')    # prunes both tombstones
+        with self.assertRaises(SyncTokenExpired):
+            self.processor.get_vm_changes(position)
+        self.assertEqual(self.processor.get_vm_changes(self.processor.sync_token()), [])
+
+
+    def test_jobs(self):
+        job = {'id': 'job-1', 'status': 'queued', 'created': time.time()}
+        self.processor.save_job(job)
+        self.assertEqual(self.processor.get_job('job-1'), job)
+        self.assertIsNone(self.processor.get_job('job-2'))
+
+
+if __name__ == '__main__':
+    unittest.main()